@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+'''Benchmark for the enhanced email templates
+
+Measures the cost of loading the templates the way a new notification process does (compiling from source compared
+to loading from the bytecode cache) and the render throughput of the HTML and plain text bodies.
+
+Usage: benchmarks/enhanced-mail-templates.py [iterations]
+'''
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import jinja2
+
+from lib.Templates import templateEnvironment
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src', 'templates')
+TEMPLATES = ['enhanced-mail.html.j2', 'enhanced-mail.txt.j2']
+
+
+class Netbox:
+    host = {'id': 1, 'name': 'switch01', 'site': {'name': 'Site 1', 'url': 'http://netbox/api/dcim/sites/1/'}, 'status': {'label': 'Active'}}
+    host_url = 'http://netbox/dcim/devices/1/'
+    ip = {'id': 2, 'address': '10.0.0.1/24', 'status': {'label': 'Active'}}
+    ip_url = 'http://netbox/ipam/ip-addresses/2/'
+
+    def getVal(self, obj, key1, key2=None):
+        try:
+            val = obj.get(key1, '')
+            if key2 is not None:
+                val = val.get(key2, '')
+        except Exception:
+            return ''
+        return str(val)
+
+    def getLink(self, obj, key1):
+        return self.getVal(obj, key1, 'url').replace('/api/', '/')
+
+
+def context():
+    config = types.SimpleNamespace(
+        notification_type='PROBLEM', host_name='switch01', host_address='10.0.0.1', host_state='DOWN', host_output='CRITICAL - 10.0.0.1: rta nan, lost 100%',
+        service_name='', service_display_name='', service_state='', service_output='', long_date_time='2024-01-01 00:00:00 +1000',
+        notification_author='', notification_comment='', performance_data='rta=0.0ms;3000;5000;0 pl=100%;80;100;0', table_width='640', column_width='144',
+        icinga=types.SimpleNamespace(url='http://icinga/icingaweb2'), grafana=types.SimpleNamespace(image_height='321'))
+    grafana = types.SimpleNamespace(png=None, unavailable=True, page_url='http://grafana/dashboard/db/icinga2', panelID='2')
+    perfdata = [types.SimpleNamespace(label='rta', value='0.0', uom='ms', warning='3000', critical='5000', minimum='0', maximum=''),
+                types.SimpleNamespace(label='pl', value='100', uom='%', warning='80', critical='100', minimum='0', maximum='')]
+    return dict(config=config, grafana=grafana, netbox=Netbox(), logo=True, perfdata=perfdata, remaining_width='496')
+
+
+def timeit(name, iterations, function):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<45} {elapsed / iterations * 1000000:10.1f} us/iteration")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    values = context()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def load_uncached():
+            environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_DIR), trim_blocks=True, lstrip_blocks=True)
+            for template in TEMPLATES:
+                environment.get_template(template)
+
+        def load_cached():
+            templateEnvironment.cache_clear()
+            environment = templateEnvironment(TEMPLATE_DIR, cache_dir)
+            for template in TEMPLATES:
+                environment.get_template(template)
+
+        # Fill the bytecode cache
+        load_cached()
+
+        timeit('load templates, compiled from source', iterations, load_uncached)
+        timeit('load templates, from the bytecode cache', iterations, load_cached)
+
+        environment = templateEnvironment(TEMPLATE_DIR, cache_dir)
+        html = environment.get_template('enhanced-mail.html.j2')
+        text = environment.get_template('enhanced-mail.txt.j2')
+        timeit('render html body', iterations, lambda: html.render(**values))
+        timeit('render plain text body', iterations, lambda: text.render(**values))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''Import time budget for the notification scripts
+
+Each script is imported (without running main) under `python -X importtime` and the time spent importing the modules
+the script pulls in is compared to its budget. Scripts that run as soon as they are imported are run with `--help`
+instead. Modules that should only be imported when they are used must not show up at all. The wall clock time is the
+best of a few runs without -X importtime. Exits 1 if any script is over budget or imports a deferred module.
+
+Usage: benchmarks/import-time.py [script ...]
+'''
+import os
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+
+# Imported on first use by every script
+DEFERRED = ['requests', 'urllib3', 'loguru', 'jinja2', 'smtplib', 'email.mime.multipart']
+
+# script -> (import budget in milliseconds, modules that must not be imported until they are used, arguments to run
+# the script with or None to import it without running main)
+SCRIPTS = {
+    'enhanced-mail-notification.py': (120, DEFERRED, ['--help']),
+    'netbox-mirror-sync.py': (100, DEFERRED, None),
+    'netbox-path-impact-notification.py': (100, DEFERRED, None),
+    'outbox-worker.py': (100, DEFERRED, None),
+    'pushover-notification.py': (100, DEFERRED, None),
+    'request-tracker-notification.py': (100, DEFERRED + ['rt.rest2', 'httpx2'], None),
+    'request-tracker-reconcile.py': (100, DEFERRED + ['rt.rest2', 'httpx2'], None),
+    'slack-notification.py': (100, DEFERRED, None),
+}
+WALL_RUNS = 5
+
+HARNESS = '''
+import importlib.util, sys
+sys.path.insert(0, {src!r})
+sys.argv = [{script!r}] + {argv!r}
+spec = importlib.util.spec_from_file_location('__main__' if {argv!r} else 'script', {script!r})
+if {load}:
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except SystemExit:
+        pass
+'''
+
+
+def harness(script, load, argv):
+    return HARNESS.format(src=SRC_DIR, script=os.path.join(SRC_DIR, script), load=load, argv=argv or [])
+
+
+def run(options, code):
+    env = dict(os.environ, NOTIFYD_DISABLE='1')
+    return subprocess.run([sys.executable] + options + ['-c', code], env=env, capture_output=True, text=True, check=True)
+
+
+def importTimes(script, load, argv=None):
+    '''Run the harness under -X importtime
+
+    Returns:
+        dict: top level module name -> cumulative import time in microseconds
+        set: every module imported
+    '''
+    result = run(['-X', 'importtime'], harness(script, load, argv))
+    top_level = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # Nested imports are indented under the module that imported them
+        if not name.startswith('  '):
+            top_level[name.strip()] = int(cumulative)
+    return top_level, modules
+
+
+def wallTime(script, argv=None):
+    '''Best wall clock time of the harness in milliseconds'''
+    code = harness(script, True, argv)
+    best = None
+    for _ in range(WALL_RUNS):
+        start = time.perf_counter()
+        run([], code)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    scripts = sys.argv[1:] or list(SCRIPTS)
+    failed = False
+    for script in scripts:
+        budget, deferred, argv = SCRIPTS.get(script, (None, [], None))
+        baseline, _ = importTimes(script, load=False)
+        top_level, modules = importTimes(script, load=True, argv=argv)
+        wall = wallTime(script, argv)
+        imported = {name: cumulative for name, cumulative in top_level.items() if name not in baseline}
+        total = sum(imported.values()) / 1000
+        eager = sorted(module for module in deferred if module in modules)
+
+        status = 'ok'
+        if budget is not None and total > budget:
+            status = f'over budget ({budget}ms)'
+            failed = True
+        if eager:
+            status = f"imports {', '.join(eager)}"
+            failed = True
+        print(f"{script:<45} {total:8.1f} ms import {wall:8.1f} ms wall  {status}")
+        for name, cumulative in sorted(imported.items(), key=lambda item: -item[1])[:5]:
+            print(f"    {name:<41} {cumulative / 1000:8.1f} ms")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+'''Benchmark for building the path impact notifications from a large synthetic impact assessment, eg. a core link
+
+Compares loading the whole response and building each message with += against streaming the response in chunks with
+the "+N more objects" cap, reporting the time and the peak memory of each.
+
+Usage: benchmarks/path-impact.py [paths] [objects per path] [contacts per path]
+'''
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+os.environ['NOTIFYD_DISABLE'] = '1'
+
+from lib.JsonStream import iterArray
+
+spec = importlib.util.spec_from_file_location('path_impact', os.path.join(SRC_DIR, 'netbox-path-impact-notification.py'))
+path_impact = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(path_impact)
+
+CHUNK_SIZE = 65536
+
+
+def synthetic(paths, objects, contacts):
+    return json.dumps([{
+        'name': f'Core path {p}',
+        'objects': [{
+            'name': f'object-{p}-{o}',
+            'type': 'dcim.interface',
+            'description': f'Uplink {o} of core path {p}',
+            'direction': '' if o % 3 else 'a',
+        } for o in range(objects)],
+        # Contacts overlap between neighbouring paths
+        'contacts': [{'name': f'Contact {p // 2 + c}', 'email': f'contact{p // 2 + c}@example.com'} for c in range(contacts)],
+    } for p in range(paths)]).encode('utf-8')
+
+
+def loadAll(payload):
+    '''The previous implementation, one message per path and contact'''
+    notifications = []
+    for path in json.loads(payload):
+        message = f"Impacted Path: {path['name']}\n"
+        for object in path['objects']:
+            if len(object['direction']) == 0:
+                message += f"Object: {object['name']} - {object['type']} - {object['description']}"
+        for contact in path['contacts']:
+            notifications.append((contact['email'], message))
+    return notifications
+
+
+def stream(payload, max_objects):
+    chunks = (payload[i:i + CHUNK_SIZE] for i in range(0, len(payload), CHUNK_SIZE))
+    return path_impact.group_contacts(iterArray(chunks), max_objects)
+
+
+def measure(name, function):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    # Measured separately, tracing the allocations slows everything down
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<45} {elapsed * 1000:10.1f} ms {peak / 1024 / 1024:10.1f} MB peak {len(result):6} notifications")
+    return result
+
+
+if __name__ == "__main__":
+    paths = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    objects = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    contacts = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    payload = synthetic(paths, objects, contacts)
+    print(f"{paths} paths with {objects} objects and {contacts} contacts, {len(payload) / 1024 / 1024:.1f} MB response")
+
+    measure('json.loads and message +=', lambda: loadAll(payload))
+    measure('streamed, all objects', lambda: stream(payload, 0))
+    measure('streamed, 50 objects per path', lambda: stream(payload, 50))
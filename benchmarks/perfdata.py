@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+'''Benchmark for the performance data parser with large check outputs, eg. SNMP interface tables
+
+Usage: benchmarks/perfdata.py [metrics]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from lib.Perfdata import parsePerfdata
+
+
+def synthetic(metrics):
+    parts = []
+    for i in range(metrics):
+        if i % 4 == 0:
+            parts.append(f"'eth{i} in'={i * 1234.5}c;;;0;")
+        elif i % 4 == 1:
+            parts.append(f"eth{i}_errors={i}c;10:;@20:30;0")
+        elif i % 4 == 2:
+            parts.append(f"'C:\\ Used {i}'={i % 100}GB;80;90;0;100")
+        else:
+            parts.append(f"latency_{i}={i}e-3s;~:5;10")
+    return ' '.join(parts)
+
+
+def timeit(name, iterations, function):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = function()
+    elapsed = (time.perf_counter() - start) / iterations
+    print(f"{name:<45} {elapsed * 1000:10.3f} ms/iteration")
+    return result
+
+
+if __name__ == "__main__":
+    metrics = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    perfdata = synthetic(metrics)
+    print(f"{metrics} metrics, {len(perfdata)} bytes of performance data")
+
+    parsed = timeit('parse all metrics', 20, lambda: list(parsePerfdata(perfdata)))
+    assert len(parsed) == metrics, f"parsed {len(parsed)} of {metrics} metrics"
+    timeit('parse the first 100 metrics', 20, lambda: list(parsePerfdata(perfdata, limit=100)))
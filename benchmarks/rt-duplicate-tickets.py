@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+'''Stress test for duplicate RT tickets from concurrent notifications for the same host and service
+
+Starts the RT and Icinga stand-in, launches the RT notifier many times at once for the same failing service and
+reports how many tickets were created, there should only be one.
+
+Usage: benchmarks/rt-duplicate-tickets.py [--invocations 50] [--no-lock] [--ticket-index]
+'''
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+SCRIPT = os.path.join(BENCHMARK_DIR, '..', 'src', 'request-tracker-notification.py')
+
+spec = importlib.util.spec_from_file_location('standin', os.path.join(BENCHMARK_DIR, 'rt-icinga-standin.py'))
+standin = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(standin)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Launch concurrent RT notifications for the same service')
+    parser.add_argument('--invocations', type=int, default=50)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds to delay each stand-in request')
+    parser.add_argument('--no-lock', action='store_true', help='disable the ticket lock to show the duplicates')
+    parser.add_argument('--ticket-index', action='store_true', help='use the local ticket index')
+    args = parser.parse_args()
+
+    server = standin.serve(args.port, args.latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_file = os.path.join(tmp_dir, 'request-tracker-notification.json')
+        with open(config_file, 'w') as file:
+            json.dump({
+                'rt': {'name': 'standin', 'queue': 'standin', 'url': f'http://127.0.0.1:{args.port}', 'username': 'rtbot', 'password': 'standin'},
+                'icinga': {'url': f'http://127.0.0.1:{args.port}', 'username': 'rtnotify', 'password': 'standin'},
+                'disable_log_file': True,
+                'lock_dir': '' if args.no_lock else os.path.join(tmp_dir, 'locks'),
+                'ticket_index_file': os.path.join(tmp_dir, 'index.db') if args.ticket_index else '',
+            }, file)
+
+        env = dict(os.environ, NOTIFYD_DISABLE='1')
+        command = [sys.executable, SCRIPT, '--config-file', config_file,
+                   '--host-name', 'switch01', '--host-displayname', 'switch01',
+                   '--service-name', 'ping', '--service-displayname', 'ping',
+                   '--service-state', 'CRITICAL', '--notification-type', 'PROBLEM']
+        start = time.perf_counter()
+        processes = [subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(args.invocations)]
+        codes = [process.wait() for process in processes]
+        elapsed = time.perf_counter() - start
+
+    stats = server.state.stats()
+    server.shutdown()
+    print(f"{args.invocations} concurrent notifications in {elapsed:.2f}s, {codes.count(0)} exited 0")
+    print(f"Tickets created: {len(stats['tickets'])}, Icinga comments: {len(stats['comments'])}")
+    for request, count in sorted(stats['requests'].items()):
+        print(f"  {request:<40} {count}")
+    sys.exit(0 if len(stats['tickets']) == 1 else 1)
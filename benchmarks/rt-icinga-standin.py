@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''Local stand-in for the RT REST2 and Icinga API endpoints used by request-tracker-notification.py
+
+Tickets and comments are kept in memory, every request is counted and can be delayed to simulate a remote server.
+GET /stats returns the request counts, tickets and comments as json.
+
+Usage: benchmarks/rt-icinga-standin.py [--port 8765] [--latency 0.05]
+    then point the RT and Icinga urls in the config at http://127.0.0.1:8765
+'''
+import argparse
+import collections
+import http.server
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+FILTER_REGEX = re.compile(r'(host\.name|service\.name|comment\.author|comment\.name)=="([^"]*)"')
+
+
+class State:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.tickets = {}
+        self.comments = {}
+        # (host, service) -> acknowledged for the hosts and services with problems, the service is empty for hosts
+        self.problems = {}
+        self.next_ticket = 1
+        self.next_comment = 1
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'tickets': self.tickets, 'comments': list(self.comments.values())}
+
+
+def matchFilter(comment, filters):
+    for field, value in FILTER_REGEX.findall(filters or ''):
+        key = {'host.name': 'host_name', 'service.name': 'service_name', 'comment.author': 'author', 'comment.name': '__name'}[field]
+        if comment['attrs'][key] != value:
+            return False
+    return True
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        data = self.rfile.read(length)
+        try:
+            return json.loads(data)
+        except ValueError:
+            return {}
+
+    def _send(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        state = self.server.state
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path.rstrip('/')
+        body = self._body()
+        with state.lock:
+            state.requests[f'{method} {re.sub(r"/[0-9]+(?=/|$)", "/N", path)}'] += 1
+        if path != '/stats' and state.latency:
+            time.sleep(state.latency)
+
+        if method == 'GET' and path == '/stats':
+            return self._send(200, state.stats())
+
+        with state.lock:
+            # RT REST2
+            if method == 'POST' and path == '/REST/2.0/ticket':
+                ticket_id = state.next_ticket
+                state.next_ticket += 1
+                state.tickets[str(ticket_id)] = {'id': str(ticket_id), 'Queue': body.get('Queue', ''), 'Subject': body.get('Subject', ''), 'Status': 'new', 'comments': 0}
+                return self._send(201, {'id': ticket_id, '_url': f'/REST/2.0/ticket/{ticket_id}'})
+            match = re.fullmatch(r'/REST/2\.0/ticket/([0-9]+)(/comment|/correspond)?', path)
+            if match:
+                ticket = state.tickets.get(match.group(1))
+                if ticket is None:
+                    return self._send(404, {'message': 'Resource does not exist'})
+                if method == 'POST' and match.group(2):
+                    ticket['comments'] += 1
+                    return self._send(201, ['Comments added'])
+                if method == 'PUT':
+                    ticket.update({key: value for key, value in body.items() if key in ['Subject', 'Status']})
+                    return self._send(200, [f"Ticket {ticket['id']}: Subject changed"])
+                if method == 'GET':
+                    return self._send(200, ticket)
+            if method in ['GET', 'POST'] and path == '/REST/2.0/tickets':
+                rt_query = body.get('query', '') if isinstance(body, dict) else ''
+                rt_query = rt_query or query.get('query', [''])[0]
+                queue = re.search(r"Queue\s*=\s*'([^']*)'", rt_query)
+                ids = re.findall(r"id\s*=\s*'?([0-9]+)", rt_query)
+                tickets = [ticket for ticket in state.tickets.values() if (queue is None or ticket['Queue'] == queue.group(1)) and (not ids or ticket['id'] in ids)]
+                if 'Status' in rt_query and '__Active__' in rt_query:
+                    tickets = [ticket for ticket in tickets if ticket['Status'] not in ['resolved', 'rejected', 'deleted']]
+                page = int(query.get('page', ['1'])[0])
+                per_page = int(query.get('per_page', ['20'])[0])
+                items = tickets[(page - 1) * per_page:page * per_page]
+                return self._send(200, {
+                    'count': len(items), 'page': page, 'per_page': per_page, 'total': len(tickets),
+                    'pages': max((len(tickets) + per_page - 1) // per_page, 1),
+                    'items': [{'id': ticket['id'], 'Subject': ticket['Subject'], 'Status': ticket['Status'], 'Queue': ticket['Queue']} for ticket in items],
+                })
+
+            # Icinga
+            if path == '/v1/objects/comments':
+                results = [comment for comment in state.comments.values() if matchFilter(comment, body.get('filter'))]
+                return self._send(200, {'results': results})
+            if path == '/v1/actions/add-comment':
+                name = f'standin-comment-{state.next_comment}'
+                state.next_comment += 1
+                names = dict(FILTER_REGEX.findall(body.get('filter', '')))
+                state.comments[name] = {'attrs': {
+                    '__name': name,
+                    'host_name': names.get('host.name', ''),
+                    'service_name': names.get('service.name', ''),
+                    'author': body.get('author', ''),
+                    'text': body.get('comment', ''),
+                }}
+                return self._send(200, {'results': [{'code': 200, 'name': name}]})
+            if path == '/v1/actions/remove-comment':
+                names = query.get('comment') or body.get('filter_vars', {}).get('names') or [name for name, comment in state.comments.items() if body.get('filter') and matchFilter(comment, body['filter'])]
+                for name in names:
+                    state.comments.pop(name, None)
+                return self._send(200, {'results': [{'code': 200, 'status': f'Successfully removed comment {name}'} for name in names]})
+            if path == '/v1/objects/hosts':
+                return self._send(200, {'results': [{'attrs': {'name': host, 'acknowledgement': int(acknowledged)}} for (host, service), acknowledged in state.problems.items() if not service]})
+            if path == '/v1/objects/services':
+                return self._send(200, {'results': [{'attrs': {'host_name': host, 'name': service, 'acknowledgement': int(acknowledged)}} for (host, service), acknowledged in state.problems.items() if service]})
+        self._send(404, {'message': f'No stand-in for {method} {path}'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+
+def serve(port=8765, latency=0.0):
+    '''Start the stand-in in a background thread
+
+    Returns:
+        http.server.ThreadingHTTPServer: the running server, call shutdown() to stop it
+    '''
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.state = State(latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local RT and Icinga API stand-in')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay each request')
+    args = parser.parse_args()
+    server = serve(args.port, args.latency)
+    print(f"Listening on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+'''Benchmark for loading the enhanced mail settings, the main Settings and its nested mail, icinga, netbox and grafana
+settings from the example config file, the same way the script does for every notification
+
+The script runs on import so the settings classes are taken from its source.
+
+Usage: benchmarks/settings.py [iterations]
+'''
+import ast
+import os
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+SCRIPT = os.path.join(SRC_DIR, 'enhanced-mail-notification.py')
+sys.path.insert(0, SRC_DIR)
+
+# A typical notification command line
+ARGUMENTS = [
+    '--config-file', os.path.join(SRC_DIR, 'config', 'enhanced-mail-notification.json'),
+    '--notification-type', 'PROBLEM', '--host-name', 'switch01', '--host-displayname', 'switch01',
+    '--host-address', '192.0.2.1', '--service-name', 'ping', '--service-displayname', 'ping',
+    '--service-state', 'CRITICAL', '--service-output', 'PING CRITICAL - Packet loss = 100%',
+    '--long-date-time', '2024-01-01 00:00:00', '--email-to', 'noc@example.com',
+]
+
+
+def settingsClasses():
+    '''Execute the imports and the Settings classes of the script without running it'''
+    tree = ast.parse(open(SCRIPT).read())
+    body = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)) and not (isinstance(node, ast.ImportFrom) and node.module == 'lib.Notifyd')]
+    body += [node for node in tree.body if isinstance(node, ast.ClassDef) and node.name.startswith('Settings')]
+    body += [node for node in tree.body if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'DIGEST_FIELDS' for target in node.targets)]
+    namespace = {'__file__': SCRIPT}
+    exec(compile(ast.Module(body=body, type_ignores=[]), SCRIPT, 'exec'), namespace)
+    return namespace
+
+
+def load(classes):
+    config = classes['Settings']()
+    config.mail = classes['SettingsMail'](_config_dict=config._config_dict)
+    config.icinga = classes['SettingsIcinga'](_config_dict=config._config_dict)
+    config.netbox = classes['SettingsNetbox'](_config_dict=config._config_dict)
+    config.grafana = classes['SettingsGrafana'](_config_dict=config._config_dict, image_width=config.table_width)
+    return config
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    classes = settingsClasses()
+    sys.argv = [SCRIPT] + ARGUMENTS
+
+    start = time.perf_counter()
+    load(classes)
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        load(classes)
+    elapsed = (time.perf_counter() - start) / iterations
+    print(f"{'first settings load':<45} {first * 1000000:10.1f} us")
+    print(f"{'settings load':<45} {elapsed * 1000000:10.1f} us/iteration")
@@ -7,6 +7,10 @@ NETBOX_PATH=false
 REQUEST_TRACKER=false
 SLACK=false
 PUSHOVER=false
+NOTIFYD=false
+OUTBOX=false
+NETBOX_MIRROR=false
+LOG_COLLECTOR=false
 REQUIREMENTS=false
 # default icinga2 user
 ICINGA2_USER="nagios"
@@ -43,6 +47,22 @@ while [[ "$#" -gt 0 ]]; do
         PUSHOVER=true
         shift # Remove --pushover from processing
         ;;
+        -d|--notifyd)
+        NOTIFYD=true
+        shift # Remove --notifyd from processing
+        ;;
+        -o|--outbox)
+        OUTBOX=true
+        shift # Remove --outbox from processing
+        ;;
+        -m|--netbox-mirror)
+        NETBOX_MIRROR=true
+        shift # Remove --netbox-mirror from processing
+        ;;
+        -l|--log-collector)
+        LOG_COLLECTOR=true
+        shift # Remove --log-collector from processing
+        ;;
         -p|--requirements)
         REQUIREMENTS=true
         shift # Remove --requirements from processing
@@ -104,9 +124,25 @@ deploy_config() {
     fi
 }
 
+deploy_template() {
+    file=$1
+    file_name=$(basename "$file")
+    mkdir -p "$ICINGA2_SCRIPT_DIR/templates/"
+    if [[ ! -f "$ICINGA2_SCRIPT_DIR/templates/$file_name" ]]; then
+        echo "  copying $file to $ICINGA2_SCRIPT_DIR/templates/$file_name"
+        cp "$file" "$ICINGA2_SCRIPT_DIR/templates/"
+        chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/templates" -R
+    else
+        echo "  template $file_name exists in $ICINGA2_SCRIPT_DIR/templates/"
+    fi
+}
+
 deploy_enhanced_email() {
     deploy_library
     deploy_config ./src/config/enhanced-mail-notification.json
+    for template in ./src/templates/enhanced-mail*; do
+        deploy_template "$template"
+    done
     cp ./src/enhanced-mail-notification.py "$ICINGA2_SCRIPT_DIR" 
     chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/enhanced-mail-notification.py"
     chmod +x "$ICINGA2_SCRIPT_DIR/enhanced-mail-notification.py"
@@ -124,6 +160,9 @@ deploy_request_tracker() {
     cp ./src/request-tracker-notification.py "$ICINGA2_SCRIPT_DIR" 
     chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/request-tracker-notification.py"
     chmod +x "$ICINGA2_SCRIPT_DIR/request-tracker-notification.py"
+    cp ./src/request-tracker-reconcile.py "$ICINGA2_SCRIPT_DIR"
+    chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/request-tracker-reconcile.py"
+    chmod +x "$ICINGA2_SCRIPT_DIR/request-tracker-reconcile.py"
 }
 
 deploy_slack() {
@@ -138,6 +177,46 @@ deploy_pushover() {
     chmod +x "$ICINGA2_SCRIPT_DIR/pushover-notification.py"
 }
 
+deploy_notifyd() {
+    cp ./src/notifyd.py "$ICINGA2_SCRIPT_DIR"
+    chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/notifyd.py"
+    chmod +x "$ICINGA2_SCRIPT_DIR/notifyd.py"
+    if [[ -d /etc/systemd/system ]]; then
+        echo "  copying ./systemd/icinga2-notifyd.service to /etc/systemd/system/"
+        sed "s/^User=.*/User=$ICINGA2_USER/; s/^Group=.*/Group=$ICINGA2_USER/; /^ExecStart=/s| /etc/icinga2/scripts/| $ICINGA2_SCRIPT_DIR/|" ./systemd/icinga2-notifyd.service > /etc/systemd/system/icinga2-notifyd.service
+        systemctl daemon-reload
+    fi
+}
+
+deploy_outbox() {
+    cp ./src/outbox-worker.py "$ICINGA2_SCRIPT_DIR"
+    chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/outbox-worker.py"
+    chmod +x "$ICINGA2_SCRIPT_DIR/outbox-worker.py"
+    if [[ -d /etc/systemd/system ]]; then
+        echo "  copying ./systemd/icinga2-notification-outbox.service to /etc/systemd/system/"
+        sed "s/^User=.*/User=$ICINGA2_USER/; s/^Group=.*/Group=$ICINGA2_USER/; /^ExecStart=/s| /etc/icinga2/scripts/| $ICINGA2_SCRIPT_DIR/|" ./systemd/icinga2-notification-outbox.service > /etc/systemd/system/icinga2-notification-outbox.service
+        systemctl daemon-reload
+    fi
+}
+
+deploy_log_collector() {
+    cp ./src/log-collector.py "$ICINGA2_SCRIPT_DIR"
+    chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/log-collector.py"
+    chmod +x "$ICINGA2_SCRIPT_DIR/log-collector.py"
+    if [[ -d /etc/systemd/system ]]; then
+        echo "  copying ./systemd/icinga2-log-collector.service to /etc/systemd/system/"
+        sed "s/^User=.*/User=$ICINGA2_USER/; s/^Group=.*/Group=$ICINGA2_USER/; /^ExecStart=/s| /etc/icinga2/scripts/| $ICINGA2_SCRIPT_DIR/|" ./systemd/icinga2-log-collector.service > /etc/systemd/system/icinga2-log-collector.service
+        systemctl daemon-reload
+    fi
+}
+
+deploy_netbox_mirror() {
+    deploy_config ./src/config/netbox-mirror-sync.json
+    cp ./src/netbox-mirror-sync.py "$ICINGA2_SCRIPT_DIR"
+    chown $ICINGA2_USER:$ICINGA2_USER "$ICINGA2_SCRIPT_DIR/netbox-mirror-sync.py"
+    chmod +x "$ICINGA2_SCRIPT_DIR/netbox-mirror-sync.py"
+}
+
 if $ALL || $ENHANCED_EMAIL; then
     echo "Deploying Enhanced Email Notifications"
     deploy_enhanced_email
@@ -178,7 +257,27 @@ if $ALL || $PUSHOVER; then
     fi
 fi
 
-if $ALL || $ENHANCED_EMAIL || $NETBOX_PATH || $REQUEST_TRACKER || $SLACK || $PUSHOVER; then
+if $ALL || $NOTIFYD; then
+    echo "Deploying notifyd"
+    deploy_notifyd
+fi
+
+if $ALL || $OUTBOX; then
+    echo "Deploying notification outbox worker"
+    deploy_outbox
+fi
+
+if $ALL || $NETBOX_MIRROR; then
+    echo "Deploying Netbox mirror sync"
+    deploy_netbox_mirror
+fi
+
+if $ALL || $LOG_COLLECTOR; then
+    echo "Deploying log collector"
+    deploy_log_collector
+fi
+
+if $ALL || $ENHANCED_EMAIL || $NETBOX_PATH || $REQUEST_TRACKER || $SLACK || $PUSHOVER || $NOTIFYD || $OUTBOX || $NETBOX_MIRROR || $LOG_COLLECTOR; then
     deploy_library
     if $REQUIREMENTS; then
         install_all_requirements
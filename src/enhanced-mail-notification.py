@@ -5,24 +5,33 @@
 #
 # https://github.com/mmarodin/icinga2-plugins
 #
+import collections
+import concurrent.futures
 import configparser
 import dataclasses
+import ipaddress
 import json
 import os
 import re
-import requests
-import smtplib
 import socket
 import sys
+import time
+
+from lib.Notifyd import forwardToDaemon
+# Hand the notification to notifyd when it is running, before loading any of the heavy dependencies
+forwardToDaemon(__file__)
 
+from lib.Digest import Digest
+from lib.NetboxMirror import NetboxMirror, kindFromApi
+from lib.Outbox import Outbox
+from lib.Perfdata import parsePerfdata
+from lib.RenderCache import RenderCache
 from lib.SettingsParser import SettingsParser
-from lib.Util import initLogger
+from lib.Templates import templateEnvironment
+from lib.TokenPool import TokenPool
+from lib.Util import initLogger, logger
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from loguru import logger
-from jinja2 import Template
+# requests, smtplib and email.mime are imported on the code paths that use them, digest followers exit without them
 
 # Helper to load config from file
 @dataclasses.dataclass
@@ -57,6 +66,10 @@ class SettingsNetbox(SettingsFile):
     api_ip: str = '/api/ipam/ip-addresses'
     proxy: str = ''
     timeout: str = 20
+    # Local mirror kept up to date by netbox-mirror-sync.py, leave empty to always use the api
+    mirror_file: str = ''
+    # Seconds after the last sync before the mirror is ignored
+    mirror_max_age: int = 3600
     _json_dict_key: str = 'netbox'
 
 @dataclasses.dataclass
@@ -73,6 +86,16 @@ class SettingsGrafana(SettingsFile):
     default_panel_id: str = '2'  # Usually ping
     image_height: str = '321'
     image_width: str = '640'
+    # Directory for the rendered panel cache, leave empty to render every panel
+    cache_dir: str = ''
+    # Seconds a rendered panel is reused for
+    cache_bucket: int = 300
+    cache_max_bytes: int = 104857600
+    # Maximum renders running at the same time on this host and the directory for the render slot lock files
+    render_max_inflight: int = 4
+    render_slots_dir: str = '/tmp/icinga2-grafana-render'
+    # Seconds each email waits for a render slot and the render before sending without the graph
+    render_deadline: int = 20
     _json_dict_key: str = 'grafana'
 
 @dataclasses.dataclass
@@ -112,19 +135,36 @@ class Settings(SettingsParser):
 
     table_width: str = '640'
     column_width: str = '144'
+    # Maximum performance data rows in the email, 0 for no limit
+    perfdata_max_rows: int = 1000
+
+    # Directory with the email templates and the directory for compiled templates (empty uses a private temp directory)
+    template_dir: str = f'{os.path.realpath(os.path.dirname(__file__))}/templates'
+    template_cache_dir: str = ''
+
+    # Leave empty to send directly without the outbox
+    outbox_file: str = ''
+    # Only commit to the outbox and leave sending to outbox-worker.py
+    outbox_defer: bool = False
+
+    # Seconds to coalesce notifications for the same email_to into one digest email, 0 sends each notification on its own
+    digest_window: int = 0
+    digest_file: str = '/var/lib/icinga2/enhanced-mail-digest.db'
+    # Send the digests whose leader was killed before it sent them, run from cron
+    flush_digests: bool = False
 
     print_config: bool = False
 
     def __post_init__(self):
         self._exclude_from_args.extend(self._exclude_all)
-        self._exclude_from_env.extend(self._exclude_all + ['print_config'])
+        self._exclude_from_env.extend(self._exclude_all + ['print_config', 'flush_digests'])
         self._env_prefix = "NOTIFY_ENHANCED_MAIL_"
         self.loadEnvironmentVars()
         self._args = self._init_args('Icinga2 plugin to send enhanced email notifications with links to Grafana and Netbox')
         self.loadArgs(self._args)
 
         # Debug set in the config file will override the args
-        self._include_from_file = ['debug', 'disable_log_file']
+        self._include_from_file = ['debug', 'disable_log_file', 'outbox_file', 'outbox_defer', 'template_dir', 'template_cache_dir', 'digest_window', 'digest_file']
         self.loadConfigJsonFile()
         
         # Sensible defaults after loading everything
@@ -140,7 +180,25 @@ class Settings(SettingsParser):
             self.host_display_name = self.host_displayname
         if self.service_display_name == '':
             self.service_display_name = self.service_displayname
+
+    def digestItem(self):
+        """Notification fields shown in a digest email"""
+        return {field: getattr(self, field) for field in DIGEST_FIELDS}
+
+# Notification fields stored for each notification in a digest
+DIGEST_FIELDS = [
+    'notification_type', 'host_name', 'host_display_name', 'host_address', 'host_state', 'host_output',
+    'service_name', 'service_display_name', 'service_state', 'service_output', 'long_date_time',
+    'notification_author', 'notification_comment', 'netbox_host_name', 'netbox_host_ip',
+]
     
+def isIPAddress(value):
+    try:
+        ipaddress.ip_interface(value)
+        return True
+    except ValueError:
+        return False
+
 # Classes for getting data from each external system
 class Netbox:
     """Netbox object that parses data from the Netbox api
@@ -152,8 +210,10 @@ class Netbox:
     :ivar ip_url: str : url to the host ip address for the NETBOXBASE and host_name
     """
 
-    def __init__(self, config):
+    def __init__(self, config, host_name='', host_ip=''):
         self.config = config
+        self.host_name = host_name
+        self.host_ip = host_ip
         self.host = {}
         self.host_url = ''
         self.ip = {}
@@ -164,14 +224,34 @@ class Netbox:
             self.__parse()
 
     def __parse(self):
-        """ Search netbox for
+        """ Search netbox for the host as a device and vm and for its ip address
+        the lookups run concurrently over one pooled session and lookups that can't match are skipped
 
         :return:
         """
-        nb_device = self.__searchData(config.netbox.url + config.netbox.api_device + '/?name=' + config.netbox_host_name)
-        nb_vm = self.__searchData(config.netbox.url + config.netbox.api_vm + '/?name=' + config.netbox_host_name)
-        nb_host_ip = self.__searchData(config.netbox.url + config.netbox.api_ip + '/?address=' + config.netbox_host_name)
-        nb_address_ip = self.__searchData(config.netbox.url + config.netbox.api_ip + '/?address=' + config.netbox_host_ip)
+        lookups = {}
+        if self.host_name:
+            lookups['device'] = (config.netbox.api_device, 'name', self.host_name)
+            lookups['vm'] = (config.netbox.api_vm, 'name', self.host_name)
+            # The host name can only match an ip address search if it is an ip address
+            if isIPAddress(self.host_name):
+                lookups['host_ip'] = (config.netbox.api_ip, 'address', self.host_name)
+        if isIPAddress(self.host_ip) and self.host_ip != self.host_name:
+            lookups['address_ip'] = (config.netbox.api_ip, 'address', self.host_ip)
+
+        results = self.__searchMirror(lookups)
+        remaining = {key: lookup for key, lookup in lookups.items() if key not in results}
+        if remaining:
+            self.__session = self.__initSession()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(remaining)) as executor:
+                urls = [config.netbox.url + api + '/?' + field + '=' + value for api, field, value in remaining.values()]
+                results.update(zip(remaining.keys(), executor.map(self.__searchData, urls)))
+            self.__session.close()
+
+        nb_device = results.get('device', {})
+        nb_vm = results.get('vm', {})
+        nb_host_ip = results.get('host_ip', {})
+        nb_address_ip = results.get('address_ip', {})
 
         logger.debug(json.dumps(nb_device, indent=4, sort_keys=True))
         logger.debug(json.dumps(nb_vm, indent=5, sort_keys=True))
@@ -195,20 +275,48 @@ class Netbox:
             self.ip = nb_address_ip
             self.ip_url = "{}/{}/".format(config.netbox.url + config.netbox.api_ip, nb_address_ip['id'])
 
-    def __getServerData(self, url):
-        args = {
-            'url': url,
-            'timeout': config.netbox.timeout,
-            'headers': {'Accept': 'application/json'}
-        }
+    def __searchMirror(self, lookups):
+        """Search the local Netbox mirror, lookups that miss or are stale are left for the api
+
+        :return: dict : results for the lookups found in the mirror
+        """
+        results = {}
+        if not config.netbox.mirror_file or not os.path.exists(config.netbox.mirror_file):
+            return results
+        try:
+            mirror = NetboxMirror(config.netbox.mirror_file)
+            for key, (api, field, value) in lookups.items():
+                kind = kindFromApi(api)
+                if not mirror.isFresh(kind, config.netbox.mirror_max_age):
+                    continue
+                result = mirror.search(kind, **{field: value})
+                if result is not None:
+                    results[key] = result
+            mirror.close()
+        except Exception as e:
+            logger.error(f"Error searching the Netbox mirror {config.netbox.mirror_file} with error {e}")
+        logger.debug(f"Netbox mirror results: {results}")
+        return results
+
+    def __initSession(self):
+        import requests
+        session = requests.Session()
+        # One keep-alive connection per concurrent lookup
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept': 'application/json'})
         if config.netbox.proxy:
-            args['proxies'] = {'http': config.netbox.proxy, 'https': config.netbox.proxy}
+            session.proxies.update({'http': config.netbox.proxy, 'https': config.netbox.proxy})
 
         if config.netbox.token:
-            args['headers'].update({'Authorization': 'Token ' + config.netbox.token})
+            session.headers.update({'Authorization': 'Token ' + config.netbox.token})
+        return session
+
+    def __getServerData(self, url):
         try:
             logger.debug(f"Netbox request to url: {url}")
-            response = requests.get(**args)
+            response = self.__session.get(url, timeout=float(config.netbox.timeout))
             result = response.json()
         except Exception as e:
             logger.error("Error getting netbox data from {} with error {}".format(url, e))
@@ -218,62 +326,37 @@ class Netbox:
 
     def __searchData(self, url):
         result = self.__getServerData(url)
-        if result['count'] == 1 and result['results']:
+        if result.get('count') == 1 and result['results']:
             return result['results'][0]
         else:
             return {}
 
-    def __getVal(self, obj, key1, key2=None):
-        try:
-            val = obj.get(key1, '')
-            if key2 is not None:
-                val = val.get(key2, '')
-        except:
-            return ''
-        return str(val)
+    def getVal(self, obj, key1, key2=None):
+        """Get the value from key(s) in object as a string
 
-    def addRow(self, title, obj, key1, key2=None):
-        """Generate html row containing title and value from key(s) in object
-        
          Arguments:
-        :arg title: str : Title for the row
         :arg obj : dict : netbox dict that we are parsing
         :arg key1 : str : key to get value for
 
         Keyword Arguments:
         :arg key2 : str : sub key to get value for (default: None)
 
-        :return: str : html row if keys exist else empty string
+        :return: str : value if keys exist else empty string
         """
-        logger.debug(f"title: {title}, obj type: {type(obj)}, key1: {key1}, key2: {key2}")
-        val = self.__getVal(obj, key1, key2)
-        logger.debug(f"return val: {val}")
-        if val:
-            val = '\n<tr><th width="' + config.column_width + '">' + title + ':</th><td>' + val + '</td></tr>'
-        else:
-            val = ''
-        return val
-
-    def addLinkRow(self, title, obj, key1, key2=None):
-        """Generate html row containing title, value and link from key(s) in object
-        assumes the last key contains a key value == url
-
-        Arguments:
-        :arg title: str : Title for the row
-        :arg obj : dict : netbox dict that we are parsing
-        :arg key1 : str : key to get value for
+        try:
+            val = obj.get(key1, '')
+            if key2 is not None:
+                val = val.get(key2, '')
+        except:
+            return ''
+        return str(val)
 
-        Keyword Arguments:
-        :arg key2 : str : sub key to get value for (default: None)
+    def getLink(self, obj, key1):
+        """Get the web url for a nested object, assumes the nested object contains a key url with the api url
 
-        :return: str : html row if keys exist else empty
+        :return: str : url if the key exists else empty string
         """
-        val = self.__getVal(obj, key1, key2)
-        if val:
-            val = '\n<tr><th width="' + config.column_width + '">' + title + ':</th><td><a href="' + re.sub(r"\/api\/", "/", self.__getVal(obj, key1, "url")) + '">' + val + '</a></td></tr>'
-        else:
-            val = ''
-        return val
+        return re.sub(r"\/api\/", "/", self.getVal(obj, key1, "url"))
 
 
 class Grafana:
@@ -282,8 +365,9 @@ class Grafana:
     
     :ivar png_url: str: url to the png for the GRAFANABASE, netbox_host_name and panelid
     :ivar page_url: str: url to the page for the GRAFANABASE, netbox_host_name and panelid
-    :ivar png: request.get object : contains the png for the GRAFANABASE, netbox_host_name and panelid
+    :ivar png: bytes : contains the png for the GRAFANABASE, netbox_host_name and panelid
     :ivar self.panelID: int : number representing the panelid for the service
+    :ivar unavailable: bool : True if there is a panel but it couldn't be rendered in time
 
     :ivar __icingaweb2_ini: configparser.read object : contains the icingaweb2 grafana module ini settings for the GRAFANAICINGAWEB2INI
     """
@@ -295,8 +379,11 @@ class Grafana:
         self.png_url = ''
         self.page_url = ''
         self.png = None
+        self.unavailable = False
         self.__icingaweb2_ini = None
         self.panelID = None
+        # Time limit for waiting for a render slot and rendering the panel
+        self.__deadline = time.monotonic() + float(config.grafana.render_deadline)
 
         if os.path.exists(config.grafana.icingaweb2_ini):
             self.__parseIcingaweb2INI()
@@ -320,6 +407,7 @@ class Grafana:
             self.png_url = config.grafana.url + '/render/dashboard-solo/db/' + config.grafana.dashboard + '?panelId=' + self.panelID + '&' + config.grafana.var_hostname + '=' + config.grafana_host_name + '&theme=' + config.grafana.theme + '&width=' + config.table_width + '&height=' + config.grafana.image_height
             self.page_url = config.grafana.url + '/dashboard/db/' + config.grafana.dashboard + '?fullscreen&panelId=' + self.panelID + '&' + config.grafana.var_hostname + '=' + config.grafana_host_name
             self.png = self.__getPNG()
+            self.unavailable = not self.png
 
     def __parseIcingaweb2INI(self):
         logger.debug("\nGrafana ini file: {}".format(config.grafana.icingaweb2_ini))
@@ -331,16 +419,50 @@ class Grafana:
             self.__icingaweb2_ini = None
 
     def __getPNG(self):
+        if not config.grafana.cache_dir:
+            return self.__renderPNG()
+        params = {
+            'url': config.grafana.url,
+            'dashboard': config.grafana.dashboard,
+            'panelId': self.panelID,
+            config.grafana.var_hostname: config.grafana_host_name,
+            'theme': config.grafana.theme,
+            'width': config.table_width,
+            'height': config.grafana.image_height,
+        }
+        try:
+            cache = RenderCache(config.grafana.cache_dir, bucket=config.grafana.cache_bucket, max_bytes=config.grafana.cache_max_bytes, wait_timeout=self.__remaining())
+            return cache.get(params, self.__renderPNG)
+        except Exception as e:
+            logger.error("Error using the grafana render cache {} with error {}".format(config.grafana.cache_dir, e))
+            return self.__renderPNG()
+
+    def __remaining(self):
+        return max(self.__deadline - time.monotonic(), 0)
+
+    def __renderPNG(self):
+        # Limit the renders running at the same time on this host so the renderer isn't overloaded during a storm
+        pool = TokenPool(config.grafana.render_slots_dir, config.grafana.render_max_inflight)
+        token = pool.acquire(timeout=self.__remaining())
+        if token is None:
+            logger.warning(f"No free grafana render slot within {config.grafana.render_deadline}s, sending without the graph")
+            return None
+
         headers = {'Authorization': 'Bearer ' + config.grafana.api_key}
         logger.debug("PNG url: " + self.png_url)
         logger.debug("PNG headers: {}".format(headers))
+        import requests
         try:
-            response = requests.get(self.png_url, headers=headers)
+            response = requests.get(self.png_url, headers=headers, timeout=max(self.__remaining(), 1))
             logger.debug("PNG get status code: {}".format(response.status_code))
         except Exception as e:
             logger.error("Error getting png from {} with error {}".format(self.page_url, e))
-            response = None
-        return response
+            return None
+        finally:
+            pool.release(token)
+        if not response.ok:
+            return None
+        return response.content
 
     def __searchINISections(self, display_name, name, command):
         pattern = None
@@ -375,44 +497,6 @@ class Grafana:
         return panel_id
 
 
-class IcingaCheck:
-    @classmethod
-    def parsePerfdata(cls, perfdata):
-        results = []
-        if perfdata:
-            try:
-                for metric in perfdata.split(' '):
-                    try:
-                        label, data = metric.split('=')
-                        parts = data.split(';')
-                        value = ''
-                        uom = ''
-                        for c in parts[0]:
-                            if c.isalpha():
-                                uom += c
-                            else:
-                                value += c
-
-                        pdata = cls.Perfdata(label, value, uom, *parts[1:])
-                        results.append(pdata)
-                    except Exception as e:
-                        logger.error(f"failed to parse perfdata metrics {metric}, got error {e}")
-
-            except Exception as e:
-                logger.error(f"failed to parse perfdata {perfdata}, got error {e}")
-            logger.debug(results)
-        return results
-
-    @dataclasses.dataclass
-    class Perfdata:
-        label: str = ''
-        value: str = ''
-        uom: str = ''
-        warning: str = ''
-        critical: str = ''
-        minimum: str = ''
-        maximum: str = ''
-
 config = Settings()
 config.mail = SettingsMail(_config_dict=config._config_dict)
 config.icinga = SettingsIcinga(_config_dict=config._config_dict)
@@ -423,7 +507,7 @@ config.grafana = SettingsGrafana(_config_dict=config._config_dict, image_width=c
 log_level = 'DEBUG' if config.debug else 'INFO'
 log_writeable = initLogger(log_level=log_level, log_file="/var/log/icinga2/notification-enhanced-email.log")
 
-logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+logger.opt(lazy=True).debug("{}", lambda: json.dumps(dataclasses.asdict(config), indent=2))
 logger.debug(config._args)
 
 if config.print_config:
@@ -443,147 +527,122 @@ for env in config._getArgVarList():
         cmd += f' {env[1]} "{env[2]}"'
 logger.info(cmd)
 
-# initialise objects for 3rd party info
-netbox = Netbox(config=config.netbox)
-grafana = Grafana()
-
-# Email subject
-if config.host_state:
-    email_subject = 'Host {0} - {1} is {2}'.format(config.notification_type, config.host_display_name, config.host_state)
-elif config.service_state:
-    email_subject = 'Service {0} - {1} service {2} is {3}'.format(config.notification_type, config.host_display_name, config.service_display_name, config.service_state)
+# Orphaned digests are each sent by a run of this script for the recipient, one failure doesn't stop the others
+if config.flush_digests and not config.email_to:
+    import subprocess
+    digest = Digest(config.digest_file, window=int(config.digest_window))
+    recipients = digest.orphaned()
+    digest.close()
+    failed = 0
+    for recipient in recipients:
+        result = subprocess.run([sys.executable, os.path.realpath(__file__), '--config-file', config.config_file, '--flush-digests', '--email-to', recipient])
+        if result.returncode != 0:
+            logger.error(f"Failed to send the orphaned digest for {recipient}, exit code {result.returncode}")
+            failed += 1
+    logger.info(f"Sent {len(recipients) - failed} of {len(recipients)} orphaned digests")
+    sys.exit(1 if failed else 0)
+
+# Coalesce notifications for the same recipients, only the leader of the window sends the email
+digest_items = []
+if config.flush_digests:
+    digest = Digest(config.digest_file, window=int(config.digest_window))
+    digest_items = digest.collectOrphaned(config.email_to)
+    digest.close()
+    if not digest_items:
+        logger.info(f"No orphaned digest for {config.email_to}")
+        os.sys.exit(0)
+    logger.info(f"Sending the orphaned digest of {len(digest_items)} notifications for {config.email_to}")
+elif int(config.digest_window) and config.email_to:
+    digest = Digest(config.digest_file, window=int(config.digest_window))
+    try:
+        token = digest.add(config.email_to, config.digestItem())
+    except Exception as e:
+        logger.error(f"Error adding to the digest {config.digest_file}, sending the notification on its own, with error {e}")
+    else:
+        if token is None:
+            logger.info(f"Added to the digest for {config.email_to}")
+            os.sys.exit(0)
+        time.sleep(digest.remaining(token))
+        try:
+            digest_items = digest.collect(config.email_to, token)
+        except Exception as e:
+            logger.error(f"Error collecting the digest {config.digest_file}, sending the notification on its own, with error {e}")
+        else:
+            if not digest_items:
+                logger.info(f"Digest for {config.email_to} was taken over by another notification")
+                os.sys.exit(0)
+    digest.close()
+
+templates = templateEnvironment(config.template_dir, config.template_cache_dir)
+
+if len(digest_items) > 1 or config.flush_digests:
+    # Enrichment is shared between the notifications for the same host, graphs are left out of the digest
+    netboxes = {}
+    if config.netbox.url:
+        for item in digest_items:
+            key = (item['netbox_host_name'], item['netbox_host_ip'])
+            if key not in netboxes:
+                netboxes[key] = Netbox(config=config.netbox, host_name=key[0], host_ip=key[1])
+    rows = [(item, netboxes.get((item['netbox_host_name'], item['netbox_host_ip']))) for item in digest_items]
+    grafana = None
+
+    types = collections.Counter(item['notification_type'] for item in digest_items)
+    email_subject = 'Digest - {0} notifications ({1})'.format(len(digest_items), ', '.join(f'{count} {notification_type}' for notification_type, count in types.most_common()))
+
+    plain_text_email = templates.get_template('enhanced-mail-digest.txt.j2').render(config=config, rows=rows)
+    logger.debug(f"Plain text email:\n{plain_text_email}")
+    html_email = templates.get_template('enhanced-mail-digest.html.j2').render(
+        config=config,
+        rows=rows,
+        logo=os.path.exists(config.icinga.logo_path),
+        )
+    logger.debug(html_email)
 else:
-    email_subject = 'Unknown {0} - {1} service {2} (no host or service state)'.format(config.notification_type, config.host_display_name, config.service_display_name)
-
-# Prepare mail bodylong_date
-plain_text_template = Template("""
-***** Icinga  *****
-
-Notification Type: {{ config.notification_type }}
-
-Host: {{ config.host_name }}
-Address: {{ config.host_address }}
-Service: {{ config.service_display_name }}
-State: {{ config.host_state }}{{ config.service_state }}
-
-Date/Time: {{ config.long_date_time }}
-
-Additional Info: {{ config.host_output }}{{ config.service_output }}
-
-Comment: [{{ config.notification_author }}] {{ config.notification_comment }}
-
-{% if grafana.page_url != '' %}
-Grafana: {{ grafana.page_url }}
-{% endif %}
-
-{% if netbox.host_url != '' %}
-Netbox Host: {{ netbox.host_url }}
-{% endif %}
-{% if netbox.ip_url != '' %}
-Netbox IP: {{ netbox.ip_url }}
-{% endif %}
-""")
-
-plain_text_email = plain_text_template.render(config=config, grafana=grafana, netbox=netbox)
-logger.debug(f"Plain text email:\n{plain_text_email}")
-
-# TODO: migrating this to j2 template
-html_email = '<html><head><style type="text/css">'
-html_email += '\nbody {text-align: left; font-family: calibri, sans-serif, verdana; font-size: 10pt; color: #7f7f7f;}'
-html_email += '\ntable {margin-left: auto; margin-right: auto;}'
-html_email += '\na:link {color: #0095bf; text-decoration: none;}'
-html_email += '\na:visited {color: #0095bf; text-decoration: none;}'
-html_email += '\na:hover {color: #0095bf; text-decoration: underline;}'
-html_email += '\na:active {color: #0095bf; text-decoration: underline;}'
-html_email += '\nth {font-family: calibri, sans-serif, verdana; font-size: 10pt; text-align:left; white-space: nowrap; color: #535353;}'
-html_email += '\nth.icinga {background-color: #0095bf; color: #ffffff; margin-left: 7px; margin-top: 5px; margin-bottom: 5px;}'
-html_email += '\nth.perfdata, th.perfdata a:link, th.perfdata a:visited {background-color: #0095bf; color: #ffffff; margin-left: 7px; margin-top: 5px; margin-bottom: 5px; text-align:center;}'
-html_email += '\ntd {font-family: calibri, sans-serif, verdana; font-size: 10pt; text-align:left; color: #7f7f7f;}'
-html_email += '\ntd.center {text-align:center; white-space: nowrap;}'
-html_email += '\ntd.UP {background-color: #44bb77; color: #ffffff; margin-left: 2px;}'
-html_email += '\ntd.DOWN {background-color: #ff5566; color: #ffffff; margin-left: 2px;}'
-html_email += '\ntd.UNREACHABLE {background-color: #aa44ff; color: #ffffff; margin-left: 2px;}'
-html_email += '\n</style></head><body>'
-html_email += '\n<table width=' + config.table_width + '>'
-
-if os.path.exists(config.icinga.logo_path):
-    html_email += '\n<tr><th colspan=2 class=icinga width=' + config.table_width + '><img src="cid:icinga2_logo"></th></tr>'
-
-html_email += '\n<tr><th>Hostalias:</th><td><a style="color: #0095bf; text-decoration: none;" href="' + config.icinga.url + '/monitoring/host/show?host=' + config.host_name + '">' + config.host_name + '</a></td></tr>'
-html_email += '\n<tr><th>IP Address:</th><td>' + config.host_address + '</td></tr>'
-html_email += '\n<tr><th>Status:</th><td>' + config.host_state + config.service_state + '</td></tr>'
-html_email += '\n<tr><th>Service Name:</th><td>' + config.service_display_name + '</td></tr>'
-if config.host_state:
-    html_email += '\n<tr><th>Service Data:</th><td><a style="color: #0095bf; text-decoration: none;" href="' + config.icinga.url + '/monitoring/host/services?host=' + config.host_name + '">' + config.host_output.replace('\n', '<br>') + '</a></td></tr>'
-if config.service_state:
-    html_email += '\n<tr><th>Service Data:</th><td><a style="color: #0095bf; text-decoration: none;" href="' + config.icinga.url + '/monitoring/service/show?host=' + config.host_name + '&service=' + config.service_name + '">' + config.service_output.replace('\n', '<br>') + '</a></td></tr>'
-html_email += '\n<tr><th>Event Time:</th><td>' + config.long_date_time + '</td></tr>'
-
-if config.notification_author and config.notification_comment:
-    html_email += f'\n<tr><th>Comment:</th><td>{config.notification_comment} ({config.notification_author})</td></tr>'
-
-if netbox.host:
-    html_email += '\n</table><br>'
-    html_email += '\n<table width=' + config.table_width + '>'
-    html_email += '\n<tr><th colspan=2 class=perfdata><a href="' + netbox.host_url + '">Netbox Info for ' + config.host_name + '</a></th></tr>'
-    html_email += netbox.addRow('Display Name', netbox.host, 'display_name')
-    html_email += netbox.addRow('Display Name', netbox.host, 'name')
-    html_email += netbox.addLinkRow('Cluster', netbox.host, 'cluster', 'name')
-    html_email += netbox.addLinkRow('Tennant', netbox.host, 'tennant', 'name')
-    html_email += netbox.addLinkRow('Site', netbox.host, 'site', 'name')  # Sites use the slug
-    html_email += netbox.addLinkRow('Rack', netbox.host, 'rack', 'name')
-    html_email += netbox.addRow('Position', netbox.host, 'position')
-    html_email += netbox.addRow('Primary IP', netbox.host, 'primary_ip', 'address')
-    html_email += netbox.addRow('Primary IPv4', netbox.host, 'primary_ip4', 'address')
-    html_email += netbox.addRow('Primary IPv6', netbox.host, 'primary_ip6', 'address')
-    html_email += netbox.addLinkRow('Device Type', netbox.host, 'device_type', 'model')
-    html_email += netbox.addRow('Status', netbox.host, 'status', 'label')
-
-if netbox.ip:
-    html_email += '\n</table><br>'
-    html_email += '\n<table width=' + config.table_width + '>'
-    html_email += '\n<tr><th colspan=2 class=perfdata><a href="' + netbox.ip_url + '">Netbox Info for ' + config.host_address + '</a></th></tr>'
-    html_email += netbox.addRow('Display Name', netbox.ip, 'address')
-    html_email += netbox.addRow('Status', netbox.ip, 'status', 'label')
-    html_email += netbox.addRow('Host', netbox.ip, 'virtual_machine', 'name')
-    html_email += netbox.addRow('Host', netbox.ip, 'device', 'name')
-
-if (config.performance_data and '=' in config.performance_data) or grafana.png:
-    html_email += '\n</table><br>'
-    html_email += '\n<table width=' + config.table_width + '>'
-    html_email += '\n<tr><th colspan=6 class=perfdata>Performance Data</th></tr>'
-    if config.performance_data:
-        html_email += '\n<tr><th>Label</th><th>Last Value</th><th>Warning</th><th>Critical</th><th>Min</th><th>Max</th></tr>'
-        perf_data_list = IcingaCheck.parsePerfdata(config.performance_data)
-        for perf in perf_data_list:
-            html_email += f'\n<tr><td>{perf.label}</td><td>{perf.value}{perf.uom}</td><td>{perf.warning}</td><td>{perf.critical}</td><td>{perf.minimum}</td><td>{perf.maximum}</td></tr>'
+    # initialise objects for 3rd party info
+    netbox = Netbox(config=config.netbox, host_name=config.netbox_host_name, host_ip=config.netbox_host_ip)
+    grafana = Grafana()
+
+    # Email subject
+    if config.host_state:
+        email_subject = 'Host {0} - {1} is {2}'.format(config.notification_type, config.host_display_name, config.host_state)
+    elif config.service_state:
+        email_subject = 'Service {0} - {1} service {2} is {3}'.format(config.notification_type, config.host_display_name, config.service_display_name, config.service_state)
     else:
-        html_email += '\n<tr><th width=' + config.column_width + ' colspan=1>Last Value:</th><td width=' + remaining_width + ' colspan=5>none</td></tr>'
-
-    if grafana.png:
-        html_email += '\n<tr><td colspan=6><a href="' + grafana.page_url + '"><img src="cid:grafana2_perfdata" width=' + config.table_width + ' height=' + config.grafana.image_height + '></a></td></tr>'
-
-html_email += '\n</table><br>'
-html_email += '\n<table width=' + config.table_width + '>'
-html_email += '\n<tr><td class=center>Generated by Icinga 2 with data from Icinga 2'
-if grafana.panelID:
-    html_email += ', Grafana'
-
-if netbox.host or netbox.ip:
-    html_email += ', Netbox'
-
-html_email += '</td></tr>'
-html_email += '\n</table><br>'
-html_email += '\n</body></html>'
-
-
-logger.debug(html_email)
+        email_subject = 'Unknown {0} - {1} service {2} (no host or service state)'.format(config.notification_type, config.host_display_name, config.service_display_name)
+
+    # Prepare mail body
+    plain_text_email = templates.get_template('enhanced-mail.txt.j2').render(config=config, grafana=grafana, netbox=netbox)
+    logger.debug(f"Plain text email:\n{plain_text_email}")
+
+    # Fetch one extra metric to know if the table was truncated
+    max_rows = int(config.perfdata_max_rows)
+    perfdata = list(parsePerfdata(config.performance_data, limit=max_rows + 1 if max_rows else None))
+    perfdata_truncated = bool(max_rows) and len(perfdata) > max_rows
+    logger.debug(perfdata)
+
+    html_email = templates.get_template('enhanced-mail.html.j2').render(
+        config=config,
+        grafana=grafana,
+        netbox=netbox,
+        logo=os.path.exists(config.icinga.logo_path),
+        perfdata=perfdata[:max_rows] if perfdata_truncated else perfdata,
+        perfdata_truncated=perfdata_truncated,
+        remaining_width=remaining_width
+        )
+    logger.debug(html_email)
 
 # Prepare email
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+
 msgRoot = MIMEMultipart('related')
 msgRoot['Subject'] = email_subject
 msgRoot['From'] = config.mail.from_address
-msgRoot['To'] = config.email_to
+# email_to can be a comma separated list of recipients that all get the same email, eg. the contacts grouped by the
+# path impact script. They can be from different organisations so they are only in the envelope, not the headers
+recipients = [address.strip() for address in config.email_to.split(',') if address.strip()]
+msgRoot['To'] = recipients[0] if len(recipients) == 1 else 'undisclosed-recipients:;'
 msgRoot.preamble = 'This is a multi-part message in MIME format.'
 
 msgAlternative = MIMEMultipart('alternative')
@@ -603,17 +662,36 @@ if os.path.exists(config.icinga.logo_path):
     msgImage.add_header('Content-ID', '<icinga2_logo>')
     msgRoot.attach(msgImage)
 
-if grafana.png:
+if grafana and grafana.png:
     try:
-        msgImage = MIMEImage(grafana.png.content)
+        msgImage = MIMEImage(grafana.png)
         msgImage.add_header('Content-ID', '<grafana2_perfdata>')
         msgRoot.attach(msgImage)
     except Exception as e:
         logger.error("Grafana PNG response exists but was unable to attach the content, failed with error {}".format(e))
-        logger.error(grafana.png)
-
+        logger.error(grafana.png[:100])
+
+
+# Commit to the outbox, a failed send is retried by outbox-worker.py
+if config.outbox_file:
+    payload = {
+        'server': config.mail.server,
+        'port': config.mail.port,
+        'starttls': config.mail.starttls,
+        'username': config.mail.username,
+        'password': config.mail.password,
+        'from_address': config.mail.from_address,
+        'to': recipients,
+        'message': msgRoot.as_string(),
+    }
+    sent, error = Outbox(config.outbox_file).submit('mail', payload, destination=config.email_to, send=not config.outbox_defer)
+    if not sent:
+        logger.warning(f"Mail to {config.email_to} left in the outbox {config.outbox_file} for retry: {error}")
+    os.sys.exit(0)
 
 # Send mail using SMTP
+import smtplib
+
 try:
     smtp = smtplib.SMTP(config.mail.server, config.mail.port)
     smtp.connect()
@@ -628,7 +706,7 @@ if config.mail.username and config.mail.password:
     smtp.login(config.mail.username, config.mail.password)
 
 try:
-    smtp.sendmail(config.mail.from_address, config.email_to, msgRoot.as_string())
+    smtp.sendmail(config.mail.from_address, recipients, msgRoot.as_string())
     smtp.quit()
 except Exception as e:
     logger.error(f"Cannot send mail using SMTP: {e}")
@@ -0,0 +1,135 @@
+"""Coalescing store for notifications going to the same recipients
+
+Each notification is added to a SQLite database in WAL mode shared by every notification process on the host. The
+first notification for a recipient opens a window and becomes the leader, the notifications that arrive while the
+window is open are only stored. When the window closes the leader collects everything stored for the recipient and
+sends it as one digest.
+
+A window whose leader didn't collect it within the window plus the grace period (eg. the leader was killed) is taken
+over by the next notification, which then collects the orphaned notifications too. So they are sent even if no other
+notification arrives for the recipient, enhanced-mail-notification.py --flush-digests run from cron sends every
+orphaned window with orphaned() and collectOrphaned().
+
+Usage:
+    digest = Digest('/var/lib/icinga2/enhanced-mail-digest.db', window=60)
+    token = digest.add('oncall@domain.local', {'host_name': 'switch01', 'host_state': 'DOWN'})
+    if token is not None:
+        time.sleep(60)
+        items = digest.collect('oncall@domain.local', token)
+"""
+import json
+import os
+import time
+
+from lib.Sqlite import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest_window (
+    recipient TEXT PRIMARY KEY,
+    opened REAL NOT NULL,
+    leader INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS digest_item (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    created REAL NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digest_item_recipient ON digest_item (recipient, id);
+"""
+
+
+class Digest:
+    """
+    Args:
+        path (str): full path to the digest database, created with mode 0600
+        window (int, optional): seconds a window stays open. Defaults to 60.
+        grace (int, optional): seconds after the window closes before another process takes over the window. Defaults to 60.
+    """
+    def __init__(self, path, window=60, grace=60):
+        self.path = path
+        self.window = float(window)
+        self.grace = float(grace)
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.path, SCHEMA, private=True)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def add(self, recipient, item):
+        """Store a notification for the recipient and open a window if there isn't one
+
+        Args:
+            recipient (str): recipients the notifications are coalesced for
+            item (dict): everything needed to render the notification in the digest
+
+        Returns:
+            tuple: (opened, leader) token for collect if this process leads the window, None if another process does
+        """
+        now = time.time()
+        token = None
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('INSERT INTO digest_item (recipient, created, item) VALUES (?, ?, ?)', (recipient, now, json.dumps(item)))
+            row = self.db.execute('SELECT opened FROM digest_window WHERE recipient = ?', (recipient,)).fetchone()
+            if row is None or row[0] + self.window + self.grace < now:
+                token = (now, os.getpid())
+                self.db.execute('INSERT OR REPLACE INTO digest_window (recipient, opened, leader) VALUES (?, ?, ?)', (recipient, *token))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return token
+
+    def remaining(self, token):
+        """Seconds until the window opened with the token closes"""
+        return max(token[0] + self.window - time.time(), 0)
+
+    def collect(self, recipient, token):
+        """Close the window and take everything stored for the recipient
+
+        Args:
+            recipient (str): recipients the notifications are coalesced for
+            token (tuple): token returned by add
+
+        Returns:
+            list: stored items in the order they arrived, empty if the window was taken over by another process
+        """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute('SELECT opened, leader FROM digest_window WHERE recipient = ?', (recipient,)).fetchone()
+            if row is None or tuple(row) != tuple(token):
+                self.db.execute('ROLLBACK')
+                return []
+            rows = self.db.execute('SELECT id, item FROM digest_item WHERE recipient = ? ORDER BY id', (recipient,)).fetchall()
+            self.db.execute('DELETE FROM digest_item WHERE recipient = ? AND id <= ?', (recipient, rows[-1][0] if rows else 0))
+            self.db.execute('DELETE FROM digest_window WHERE recipient = ?', (recipient,))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return [json.loads(row[1]) for row in rows]
+
+    def orphaned(self):
+        """Recipients of windows that weren't collected within the window plus the grace period"""
+        cutoff = time.time() - self.window - self.grace
+        return [row[0] for row in self.db.execute('SELECT recipient FROM digest_window WHERE opened < ? ORDER BY opened', (cutoff,))]
+
+    def collectOrphaned(self, recipient):
+        """Take over the orphaned window of the recipient and take everything stored for it
+
+        Returns:
+            list: stored items in the order they arrived, empty if the window isn't orphaned (anymore)
+        """
+        row = self.db.execute('SELECT opened, leader FROM digest_window WHERE recipient = ?', (recipient,)).fetchone()
+        if row is None or row[0] + self.window + self.grace >= time.time():
+            return []
+        # collect checks the window again, a notification taking it over at the same time gets the items instead
+        return self.collect(recipient, row)
@@ -0,0 +1,68 @@
+"""Cross process locks based on fcntl.flock, the lock is released by the kernel if the holding process dies
+
+Usage:
+    with FileLock('/tmp/example.lock', timeout=10):
+        do_something()
+
+    lock = FileLock('/tmp/example.lock')
+    if lock.acquire(blocking=False):
+        try:
+            do_something()
+        finally:
+            lock.release()
+"""
+import fcntl
+import os
+import time
+
+
+class FileLock:
+    def __init__(self, path, timeout=None, poll_interval=0.05):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def acquire(self, blocking=True, timeout=None):
+        """Acquire the lock
+
+        Args:
+            blocking (bool, optional): wait for the lock. Defaults to True.
+            timeout (float, optional): seconds to wait, waits forever when None. Defaults to None.
+
+        Returns:
+            bool: True if the lock was acquired
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o660)
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        while True:
+            try:
+                if blocking and deadline is None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._fd = fd
+                return True
+            except BlockingIOError:
+                if not blocking or time.monotonic() >= deadline:
+                    os.close(fd)
+                    return False
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def __enter__(self):
+        if not self.acquire(timeout=self.timeout):
+            raise TimeoutError(f"Timed out after {self.timeout}s waiting for lock {self.path}")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,149 @@
+"""Local snapshot of the Netbox path plugin impact assessment for every device and virtual machine
+
+netbox-mirror-sync.py takes the snapshot, netbox-path-impact-notification.py looks the impacted paths up in it first
+and only asks the impact API when the object isn't in the snapshot or the snapshot is stale, so notifications don't
+depend on Netbox answering during the outage they are about.
+
+The snapshot is an adjacency list from each object to the paths it impacts. Paths are stored as the JSON returned by the
+impact API, so a lookup returns the same list of paths as the API. The object directions in a path depend on the object
+that was assessed so paths are only shared between objects when the API returned exactly the same content.
+Types are the impact API type, eg. 'dcim.devices'.
+
+Usage:
+    graph = ImpactGraph('/var/lib/icinga2/netbox-impact.db')
+    if graph.isFresh(max_age=7200):
+        paths = graph.impacted('dcim.devices', 42)
+"""
+import hashlib
+import json
+import time
+
+from lib.Sqlite import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (type, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS impacts (
+    type TEXT NOT NULL,
+    object_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    path_id INTEGER NOT NULL,
+    PRIMARY KEY (type, object_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sync (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_sync REAL NOT NULL
+);
+"""
+
+
+class ImpactGraph:
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.path, SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def age(self):
+        """Seconds since the snapshot was taken, None if there is no snapshot"""
+        row = self.db.execute('SELECT last_sync FROM sync WHERE id = 1').fetchone()
+        if row is None:
+            return None
+        return time.time() - row[0]
+
+    def isFresh(self, max_age):
+        age = self.age()
+        return age is not None and age <= float(max_age)
+
+    def impacted(self, object_type, object_id):
+        """Paths impacted by the object
+
+        Returns:
+            list: the paths as returned by the impact api, None if the object isn't in the snapshot
+        """
+        if self.db.execute('SELECT 1 FROM objects WHERE type = ? AND id = ?', (object_type, int(object_id))).fetchone() is None:
+            return None
+        rows = self.db.execute('SELECT paths.data FROM impacts JOIN paths ON paths.id = impacts.path_id '
+                               'WHERE impacts.type = ? AND impacts.object_id = ? ORDER BY impacts.position',
+                               (object_type, int(object_id)))
+        return [json.loads(row[0]) for row in rows]
+
+    def store(self, impacts):
+        """Replace the snapshot, readers keep the previous snapshot until it is committed
+
+        The impacts are all read before the database is locked, so the write lock is only held for the local swap and
+        not while the assessments are pulled from Netbox.
+
+        Args:
+            impacts (iterable): tuples of (type, object id, list of paths returned by the impact api), paths is None to
+                keep the object's previous assessment, eg. when pulling it failed
+
+        Returns:
+            tuple: number of objects refreshed, unique paths written and objects that kept their previous assessment.
+                Nothing is written when no object was refreshed, so the snapshot doesn't look fresh after a sync that
+                couldn't pull any assessment.
+        """
+        path_data = {}
+        objects = []
+        keep = []
+        for object_type, object_id, paths in impacts:
+            if paths is None:
+                keep.append((object_type, int(object_id)))
+                continue
+            keys = []
+            for path in paths:
+                data = json.dumps(path, sort_keys=True)
+                key = hashlib.sha1(data.encode('utf-8')).hexdigest()
+                path_data.setdefault(key, data)
+                keys.append(key)
+            objects.append((object_type, int(object_id), keys))
+
+        refreshed = len(objects)
+        if not refreshed and keep:
+            return 0, 0, len(keep)
+
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            kept = 0
+            for object_type, object_id in keep:
+                if self.db.execute('SELECT 1 FROM objects WHERE type = ? AND id = ?', (object_type, object_id)).fetchone() is None:
+                    continue
+                rows = self.db.execute('SELECT paths.key, paths.data FROM impacts JOIN paths ON paths.id = impacts.path_id '
+                                       'WHERE impacts.type = ? AND impacts.object_id = ? ORDER BY impacts.position',
+                                       (object_type, object_id)).fetchall()
+                for key, data in rows:
+                    path_data.setdefault(key, data)
+                objects.append((object_type, object_id, [key for key, _ in rows]))
+                kept += 1
+
+            self.db.execute('DELETE FROM impacts')
+            self.db.execute('DELETE FROM objects')
+            self.db.execute('DELETE FROM paths')
+            path_ids = {key: self.db.execute('INSERT INTO paths (key, data) VALUES (?, ?)', (key, data)).lastrowid for key, data in path_data.items()}
+            for object_type, object_id, keys in objects:
+                self.db.execute('INSERT OR REPLACE INTO objects (type, id) VALUES (?, ?)', (object_type, object_id))
+                self.db.executemany('INSERT INTO impacts (type, object_id, position, path_id) VALUES (?, ?, ?, ?)',
+                                    [(object_type, object_id, position, path_ids[key]) for position, key in enumerate(keys)])
+            self.db.execute('INSERT OR REPLACE INTO sync (id, last_sync) VALUES (1, ?)', (time.time(),))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return refreshed, len(path_ids), kept
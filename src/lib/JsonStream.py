@@ -0,0 +1,104 @@
+"""Incremental parser for a large json array read in chunks, eg. a streamed http response
+
+The elements of the top level array are decoded one at a time with json.JSONDecoder.raw_decode as the chunks arrive, so
+only the element being decoded and the unread part of the buffer are held in memory instead of the whole document.
+When an element is incomplete more chunks are read until the buffer has at least doubled before decoding it again,
+which keeps the parsing linear for elements much larger than a chunk, and the size of the previous element is read before
+decoding the next one so elements of similar sizes are usually decoded once.
+
+Usage:
+    response = requests.get(url, stream=True)
+    for item in iterArray(response.iter_content(chunk_size=65536)):
+        print(item['name'])
+"""
+import codecs
+import json
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER = '0123456789.eE+-'
+
+
+def iterArray(chunks, encoding='utf-8'):
+    """Yield the elements of the json array in the chunks
+
+    Args:
+        chunks: iterable of bytes or str
+        encoding: encoding of bytes chunks
+
+    Raises:
+        ValueError: the document isn't a json array or is truncated
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = iter(chunks)
+    buffer = ''
+    position = 0
+    eof = False
+
+    def read(minimum=1):
+        """Append chunks to the buffer until at least minimum characters were added, False at the end of the chunks"""
+        nonlocal buffer, position, eof
+        # Drop the consumed part of the buffer so it doesn't grow with the document
+        parts = [buffer[position:]]
+        position = 0
+        added = 0
+        while added < minimum and not eof:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+                chunk = text_decoder.decode(b'', final=True)
+            elif isinstance(chunk, bytes):
+                chunk = text_decoder.decode(chunk)
+            parts.append(chunk)
+            added += len(chunk)
+        buffer = ''.join(parts)
+        return added > 0
+
+    def skip(characters):
+        """Move past the characters, reading more when the buffer runs out
+
+        Returns:
+            str: the next character or '' at the end of the chunks
+        """
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not read():
+                return ''
+
+    if skip(_WHITESPACE) != '[':
+        raise ValueError('Expected a json array')
+    position += 1
+    if skip(_WHITESPACE) == ']':
+        return
+
+    # Size of the previous element, the elements of an array are usually similar so that much is read before decoding
+    expected = 0
+    while True:
+        if len(buffer) - position < expected and not eof:
+            read(expected - (len(buffer) - position))
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+            # A number at the end of the buffer may continue in the next chunk, eg. 12 of 12.5e3
+            if not eof and isinstance(item, (int, float)) and (end == len(buffer) or buffer[end] in _NUMBER):
+                raise json.JSONDecodeError('Incomplete element', buffer, end)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ValueError(f'Invalid json array: {e}') from None
+            read(max(len(buffer) - position, 1))
+            continue
+        expected = end - position
+        position = end
+        yield item
+
+        next_character = skip(_WHITESPACE)
+        if next_character == ']':
+            return
+        if next_character != ',':
+            raise ValueError('Invalid json array: expected , or ] after an element')
+        position += 1
+        if skip(_WHITESPACE) == '':
+            raise ValueError('Invalid json array: truncated')
@@ -0,0 +1,115 @@
+"""Client side of the per-host log collector (log-collector.py)
+
+In the socket and pid log modes (see lib/Util.initLogger) the notification scripts don't write, rotate or compress the
+shared log files themselves. Each formatted log line is sent as one unix datagram to the collector, which appends it
+to the log file and is the only process that rotates and compresses the log files. Sends never block: if the collector
+isn't running, its socket buffer is full or the line is too large for a datagram, the line is appended to a spool file
+of the process instead. In pid mode every line goes to the spool file. The collector merges the spool files of exited
+processes into the log files.
+
+A datagram is the log file name, a NUL byte and the utf-8 log line.
+Spool files are named <log file name>.<pid>, eg. notification-slack.log.1234.
+"""
+import errno
+import os
+import socket
+
+DEFAULT_SOCKET_PATH = '/run/icinga2/log-collector.sock'
+DEFAULT_SPOOL_DIR = '/var/log/icinga2/spool'
+
+
+def socketPath():
+    return os.getenv('NOTIFY_LOG_SOCKET', DEFAULT_SOCKET_PATH)
+
+
+def spoolDir():
+    return os.getenv('NOTIFY_LOG_SPOOL_DIR', DEFAULT_SPOOL_DIR)
+
+
+def isLogName(name):
+    """Only plain .log file names are accepted, the collector never writes outside its log directory"""
+    return bool(name) and name == os.path.basename(name) and not name.startswith('.') and name.endswith('.log')
+
+
+def encodeLine(name, line):
+    return name.encode('utf-8') + b'\0' + line.encode('utf-8', 'replace')
+
+
+def decodeLine(data):
+    """
+    Returns:
+        tuple: (log file name, log line bytes), the name is None if the datagram isn't valid
+    """
+    name, separator, line = data.partition(b'\0')
+    name = name.decode('utf-8', 'replace')
+    if not separator or not isLogName(name):
+        return None, b''
+    return name, line
+
+
+def parseSpoolName(file_name):
+    """
+    Returns:
+        tuple: (log file name, pid) or (None, None) if it isn't a spool file
+    """
+    name, _, pid = file_name.rpartition('.')
+    if not pid.isdigit() or not isLogName(name):
+        return None, None
+    return name, int(pid)
+
+
+class SpoolSink:
+    """loguru sink appending to this process's spool file, nothing else writes to the file so there are no races
+
+    Args:
+        name (str): log file name the lines belong to, eg. notification-slack.log
+        spool_dir (str, optional): Defaults to NOTIFY_LOG_SPOOL_DIR or /var/log/icinga2/spool.
+    """
+    def __init__(self, name, spool_dir=None):
+        self.name = name
+        self.spool_dir = spool_dir or spoolDir()
+        self._fd = None
+        self._pid = None
+
+    def __call__(self, message):
+        self.write(str(message))
+
+    def write(self, line):
+        # A forked child (notifyd) gets its own spool file
+        if self._fd is None or self._pid != os.getpid():
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._pid = os.getpid()
+            self._fd = os.open(os.path.join(self.spool_dir, f'{self.name}.{self._pid}'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        os.write(self._fd, line.encode('utf-8', 'replace'))
+
+
+class DatagramSink:
+    """loguru sink sending each line to the collector without blocking, lines the collector can't take right now are
+    spooled
+
+    Args:
+        name (str): log file name the lines belong to, eg. notification-slack.log
+        socket_path (str, optional): Defaults to NOTIFY_LOG_SOCKET or /run/icinga2/log-collector.sock.
+        spool_dir (str, optional): Defaults to NOTIFY_LOG_SPOOL_DIR or /var/log/icinga2/spool.
+    """
+    def __init__(self, name, socket_path=None, spool_dir=None):
+        self.name = name
+        self.socket_path = socket_path or socketPath()
+        self.spool = SpoolSink(name, spool_dir)
+        self._sock = None
+
+    def __call__(self, message):
+        line = str(message)
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._sock.setblocking(False)
+                self._sock.connect(self.socket_path)
+            self._sock.send(encodeLine(self.name, line))
+        except OSError as e:
+            # No collector, a full socket buffer or a line larger than a datagram, reconnect next time if the
+            # collector was missing or restarted
+            if self._sock is not None and not isinstance(e, BlockingIOError) and e.errno != errno.EMSGSIZE:
+                self._sock.close()
+                self._sock = None
+            self.spool.write(line)
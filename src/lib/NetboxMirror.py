@@ -0,0 +1,153 @@
+"""Local SQLite mirror of Netbox devices, virtual machines and ip addresses
+
+netbox-mirror-sync.py keeps the mirror up to date, the notification scripts search it first and only fall back to
+the Netbox API when the object isn't in the mirror or the mirror is stale.
+
+Objects are stored as the JSON returned by the Netbox REST API so callers get the same dict as an API search.
+Kinds are the API path without the /api/ prefix, eg. 'dcim/devices'.
+
+Usage:
+    mirror = NetboxMirror('/var/lib/icinga2/netbox-mirror.db')
+    if mirror.isFresh('dcim/devices', max_age=3600):
+        device = mirror.search('dcim/devices', name='switch01')
+"""
+import json
+import time
+
+from lib.Sqlite import connect
+
+KINDS = ['dcim/devices', 'virtualization/virtual-machines', 'ipam/ip-addresses']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT,
+    host TEXT,
+    address TEXT,
+    last_updated TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS objects_name ON objects (kind, name);
+CREATE INDEX IF NOT EXISTS objects_host ON objects (kind, host);
+CREATE TABLE IF NOT EXISTS sync (
+    kind TEXT PRIMARY KEY,
+    last_sync REAL NOT NULL,
+    last_full_sync REAL NOT NULL,
+    last_updated TEXT NOT NULL DEFAULT ''
+);
+"""
+
+
+def kindFromApi(api_path):
+    """Convert an api path from the config (eg. /api/dcim/devices) to a mirror kind (eg. dcim/devices)"""
+    kind = api_path.strip('/')
+    if kind.startswith('api/'):
+        kind = kind[len('api/'):]
+    return kind
+
+
+class NetboxMirror:
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.path, SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def age(self, kind=None):
+        """Seconds since the kind (or the oldest kind when not set) was last synced, None if it has never been synced"""
+        if kind is None:
+            row = self.db.execute('SELECT MIN(last_sync), COUNT(*) FROM sync').fetchone()
+            if not row[1] or row[1] < len(KINDS):
+                return None
+        else:
+            row = self.db.execute('SELECT last_sync FROM sync WHERE kind = ?', (kind,)).fetchone()
+            if row is None:
+                return None
+        return time.time() - row[0]
+
+    def isFresh(self, kind, max_age):
+        age = self.age(kind)
+        return age is not None and age <= float(max_age)
+
+    def search(self, kind, name=None, address=None):
+        """Search the mirror the same way as the Netbox API name or address filter
+
+        Returns:
+            dict: the object if there is exactly one match, {} if there are multiple matches or None if there is no match
+        """
+        if name is not None:
+            rows = self.db.execute('SELECT data FROM objects WHERE kind = ? AND name = ? LIMIT 2', (kind, name)).fetchall()
+        elif address is not None:
+            # The api matches any prefix length unless one is given
+            if '/' in address:
+                rows = self.db.execute('SELECT data FROM objects WHERE kind = ? AND host = ? AND address = ? LIMIT 2', (kind, address.split('/')[0], address)).fetchall()
+            else:
+                rows = self.db.execute('SELECT data FROM objects WHERE kind = ? AND host = ? LIMIT 2', (kind, address)).fetchall()
+        else:
+            return None
+
+        if len(rows) == 1:
+            return json.loads(rows[0][0])
+        if len(rows) > 1:
+            return {}
+        return None
+
+    def ids(self, kind):
+        """Ids of every object of the kind in the mirror"""
+        return [row[0] for row in self.db.execute('SELECT id FROM objects WHERE kind = ? ORDER BY id', (kind,))]
+
+    def lastUpdated(self, kind):
+        """last_updated value of the newest object from the previous sync, used for incremental pulls"""
+        row = self.db.execute('SELECT last_updated FROM sync WHERE kind = ?', (kind,)).fetchone()
+        return row[0] if row else ''
+
+    def lastFullSync(self, kind):
+        row = self.db.execute('SELECT last_full_sync FROM sync WHERE kind = ?', (kind,)).fetchone()
+        return row[0] if row else 0
+
+    def store(self, kind, objects, full=False):
+        """Write objects pulled from the api, a full sync replaces every object of the kind so deleted objects are removed
+
+        Args:
+            kind (str): mirror kind eg. 'dcim/devices'
+            objects (iterable): api result dicts
+            full (bool, optional): objects is the complete list for the kind. Defaults to False.
+
+        Returns:
+            int: number of objects written
+        """
+        now = time.time()
+        last_updated = '' if full else self.lastUpdated(kind)
+        # Pull every page before locking the mirror, notifications opening it (the schema script takes the write lock) would wait on the api otherwise
+        rows = []
+        for obj in objects:
+            address = obj.get('address')
+            obj_updated = obj.get('last_updated') or ''
+            rows.append((kind, obj['id'], obj.get('name'), address.split('/')[0] if address else None, address, obj_updated, json.dumps(obj)))
+            last_updated = max(last_updated, obj_updated)
+        last_full_sync = now if full else self.lastFullSync(kind)
+
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            if full:
+                self.db.execute('DELETE FROM objects WHERE kind = ?', (kind,))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO objects (kind, id, name, host, address, last_updated, data) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO sync (kind, last_sync, last_full_sync, last_updated) VALUES (?, ?, ?, ?)',
+                            (kind, now, last_full_sync, last_updated))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return len(rows)
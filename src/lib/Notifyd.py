@@ -0,0 +1,108 @@
+"""Thin client and wire protocol for the resident notification daemon (notifyd.py)
+
+The notification scripts call forwardToDaemon() before importing their heavy dependencies. If a notifyd is listening
+the invocation (script name, arguments, environment and working directory) is handed over and the script exits with
+the exit code, stdout and stderr of the run inside the daemon. If no daemon is reachable the script carries on and runs
+in process exactly as it always has.
+
+Messages are a 4 byte big endian length followed by a utf-8 JSON document.
+"""
+import base64
+import json
+import os
+import socket
+import struct
+import sys
+
+DEFAULT_SOCKET_PATH = '/run/icinga2/notifyd.sock'
+# Set in the daemon's forked children so a script run by the daemon doesn't try to forward itself again
+CHILD_ENV = 'NOTIFYD_CHILD'
+# Set to any value to skip the daemon and always run in process
+DISABLE_ENV = 'NOTIFYD_DISABLE'
+# Set to any value to return as soon as the daemon accepts the notification instead of waiting for the result
+NOWAIT_ENV = 'NOTIFYD_NOWAIT'
+CONNECT_TIMEOUT = 2
+
+
+def socketPath():
+    return os.getenv('NOTIFYD_SOCKET_PATH', DEFAULT_SOCKET_PATH)
+
+
+def sendMessage(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def _recvExactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError(f"Connection closed after {len(data)} of {size} bytes")
+        data += chunk
+    return data
+
+
+def recvMessage(sock):
+    size = struct.unpack('>I', _recvExactly(sock, 4))[0]
+    return json.loads(_recvExactly(sock, size).decode('utf-8'))
+
+
+def encodeOutput(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def decodeOutput(data):
+    return base64.b64decode(data.encode('ascii'))
+
+
+def forwardToDaemon(script):
+    """Forward this invocation to notifyd if it is running, exits with the daemon's result on success
+
+    Args:
+        script (str): __file__ of the calling notification script
+
+    Returns:
+        bool: False if the notification wasn't forwarded and the caller should run it in process
+    """
+    if os.getenv(CHILD_ENV) or os.getenv(DISABLE_ENV):
+        return False
+    path = socketPath()
+    if not os.path.exists(path):
+        return False
+
+    request = {
+        'script': os.path.basename(script),
+        'argv': sys.argv[1:],
+        'env': dict(os.environ),
+        'cwd': os.getcwd(),
+        'pid': os.getpid(),
+        'wait': not os.getenv(NOWAIT_ENV),
+    }
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(path)
+        sendMessage(sock, request)
+    except OSError:
+        # Nothing was handed over so it is safe to run the notification in process instead
+        sock.close()
+        return False
+
+    # From here on the daemon owns the notification, falling back would risk sending it twice
+    try:
+        sock.settimeout(None)
+        response = recvMessage(sock)
+    except (OSError, ValueError) as e:
+        print(f"Error: notifyd accepted the notification but the result was lost: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        sock.close()
+
+    sys.stdout.flush()
+    sys.stdout.buffer.write(decodeOutput(response.get('stdout', '')))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.stderr.buffer.write(decodeOutput(response.get('stderr', '')))
+    sys.stderr.flush()
+    sys.exit(response.get('exit_code', 1))
@@ -0,0 +1,319 @@
+"""Durable outbox for rendered notification payloads
+
+Payloads are committed to a SQLite database in WAL mode before anything is sent. The notification script can then try
+to send straight away (or leave it for the worker when deferred) and anything that fails stays in the outbox until
+outbox-worker.py delivers it, retrying with exponential backoff and jitter.
+
+Usage:
+    outbox = Outbox('/var/lib/icinga2/notification-outbox.db')
+    sent, error = outbox.submit('slack', {'url': webhook_url, 'json': payload}, destination=webhook_url)
+"""
+import json
+import random
+import sqlite3
+import sys
+import time
+
+from lib.Sqlite import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    backend TEXT NOT NULL,
+    destination TEXT NOT NULL DEFAULT '',
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    claimed_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (state, backend, next_attempt);
+"""
+
+
+class OutboxRetry(Exception):
+    """Raised by a sender when the backend asked us to come back later, eg. HTTP 429 with a Retry-After header
+    attempt is False when nothing was sent, eg. the local rate limit had no free slot, so it doesn't count towards max_attempts
+    """
+    def __init__(self, message, delay=None, attempt=True):
+        super().__init__(message)
+        self.delay = delay
+        self.attempt = attempt
+
+
+class OutboxReject(Exception):
+    """Raised by a sender when retrying can't help, eg. HTTP 400 for a malformed payload"""
+
+
+def sendSlack(payload):
+    import requests
+    bucket = None
+    if payload.get('rate_limit'):
+        from lib.RateLimit import TokenBucket
+        rate_limit = payload['rate_limit']
+        try:
+            bucket = TokenBucket(rate_limit['file'], rate=rate_limit.get('rate', 1), burst=rate_limit.get('burst', 1))
+            wait = bucket.reserve(payload['url'], max_wait=rate_limit.get('max_wait'))
+        except (sqlite3.Error, OSError) as e:
+            # A broken rate limit database mustn't stop the post, eg. when run by hand as another user
+            print(f"Warning: unable to use the Slack rate limit {rate_limit['file']}, posting without it: {e}", file=sys.stderr)
+            bucket = None
+            wait = 0
+        if wait is None:
+            raise OutboxRetry('Rate limited, no free slot for the webhook', delay=bucket.wait(payload['url']), attempt=False)
+        time.sleep(wait)
+    response = requests.post(url=payload['url'], headers=payload.get('headers', {'Content-Type': 'application/json'}), json=payload['json'], timeout=payload.get('timeout', 10))
+    try:
+        checkResponse(response, [200, 201, 300, 301])
+    except OutboxRetry as e:
+        # Every sender on the host waits out the Retry-After, not just this one
+        if bucket is not None:
+            try:
+                bucket.block(payload['url'], e.delay if e.delay is not None else 1 / bucket.rate)
+            except (sqlite3.Error, OSError) as block_error:
+                print(f"Warning: unable to block the Slack rate limit {rate_limit['file']}: {block_error}", file=sys.stderr)
+        raise
+
+
+def sendPushover(payload):
+    import requests
+    response = requests.post(payload['url'], data=payload['data'], headers=payload.get('headers', {}), timeout=payload.get('timeout', 10))
+    checkResponse(response, [200])
+
+
+def sendMail(payload):
+    import smtplib
+    smtp = smtplib.SMTP(payload['server'], payload['port'], timeout=payload.get('timeout', 30))
+    try:
+        if payload.get('starttls'):
+            smtp.starttls()
+        if payload.get('username') and payload.get('password'):
+            smtp.login(payload['username'], payload['password'])
+        # Older payloads have the recipients as a comma separated string
+        recipients = payload['to'].split(',') if isinstance(payload['to'], str) else payload['to']
+        smtp.sendmail(payload['from_address'], [recipient.strip() for recipient in recipients if recipient.strip()], payload['message'])
+    finally:
+        try:
+            smtp.quit()
+        except smtplib.SMTPException:
+            pass
+
+
+def checkResponse(response, success_codes):
+    """Raise the outbox exception for an HTTP response that isn't one of the success codes"""
+    if response.status_code in success_codes:
+        return
+    message = f"Response code: {response.status_code}, response text: {response.text}"
+    if response.status_code == 429:
+        retry_after = response.headers.get('Retry-After')
+        raise OutboxRetry(message, float(retry_after) if retry_after and retry_after.isdigit() else None)
+    if 400 <= response.status_code < 500 and response.status_code not in [408, 425]:
+        raise OutboxReject(message)
+    raise Exception(message)
+
+
+# backend name -> function that sends the payload and raises on failure
+SENDERS = {
+    'mail': sendMail,
+    'pushover': sendPushover,
+    'slack': sendSlack,
+}
+
+
+class Outbox:
+    """SQLite backed outbox shared by every notification process on the host
+
+    Args:
+        path (str): full path to the outbox database, created with mode 0600 as payloads can contain credentials
+        max_attempts (int, optional): attempts before an entry is marked dead. Defaults to 10.
+        backoff_base (int, optional): seconds to wait after the first failure, doubled for each attempt. Defaults to 30.
+        backoff_max (int, optional): longest wait between attempts in seconds. Defaults to 3600.
+        lease (int, optional): seconds a claimed entry is reserved for the claiming process. Defaults to 300.
+    """
+    def __init__(self, path, max_attempts=10, backoff_base=30, backoff_max=3600, lease=300):
+        self.path = path
+        self.max_attempts = int(max_attempts)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.lease = float(lease)
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.path, SCHEMA, private=True)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def backoff(self, attempts):
+        """Exponential backoff with jitter, the delay is picked between half and all of the exponential value"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(attempts - 1, 0)))
+        return random.uniform(delay / 2, delay)
+
+    def put(self, backend, payload, destination='', claim=False):
+        """Commit a payload to the outbox
+
+        Args:
+            backend (str): name of the sender in SENDERS
+            payload (dict): everything the sender needs to deliver the notification
+            destination (str, optional): webhook, user or address the payload is for. Defaults to ''.
+            claim (bool, optional): reserve the entry for this process so the worker doesn't send it at the same time. Defaults to False.
+
+        Returns:
+            int: outbox id
+        """
+        now = time.time()
+        cursor = self.db.execute(
+            'INSERT INTO outbox (backend, destination, payload, created, next_attempt, claimed_until) VALUES (?, ?, ?, ?, ?, ?)',
+            (backend, destination, json.dumps(payload), now, now, now + self.lease if claim else 0))
+        return cursor.lastrowid
+
+    def claim(self, backend=None, limit=1, destination=None):
+        """Reserve entries that are due for sending
+
+        Returns:
+            list: list of tuples (id, backend, destination, payload, attempts)
+        """
+        now = time.time()
+        query = "SELECT id, backend, destination, payload, attempts FROM outbox WHERE state = 'pending' AND next_attempt <= ? AND claimed_until < ?"
+        params = [now, now]
+        if backend is not None:
+            query += ' AND backend = ?'
+            params.append(backend)
+        if destination is not None:
+            query += ' AND destination = ?'
+            params.append(destination)
+        query += ' ORDER BY next_attempt, id LIMIT ?'
+        params.append(int(limit))
+
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.db.execute(query, params).fetchall()
+            self.db.executemany('UPDATE outbox SET claimed_until = ? WHERE id = ?', [(now + self.lease, row[0]) for row in rows])
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return [(row[0], row[1], row[2], json.loads(row[3]), row[4]) for row in rows]
+
+    def complete(self, outbox_id):
+        self.db.execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
+
+    def fail(self, outbox_id, error, delay=None, dead=False, attempt=True):
+        """Record a failed attempt and schedule the next one, entries are marked dead after max_attempts
+        With attempt False the entry is only rescheduled, for a send that was never tried
+        """
+        attempts = self.db.execute('SELECT attempts FROM outbox WHERE id = ?', (outbox_id,)).fetchone()
+        if attempts is None:
+            return
+        attempts = attempts[0] + (1 if attempt else 0)
+        if dead or attempts >= self.max_attempts:
+            self.db.execute("UPDATE outbox SET state = 'dead', attempts = ?, claimed_until = 0, last_error = ? WHERE id = ?", (attempts, str(error), outbox_id))
+            return
+        if delay is None:
+            delay = self.backoff(attempts)
+        self.db.execute('UPDATE outbox SET attempts = ?, next_attempt = ?, claimed_until = 0, last_error = ? WHERE id = ?',
+                        (attempts, time.time() + delay, str(error), outbox_id))
+
+    @staticmethod
+    def send(backend, payload):
+        """Send a payload with its backend sender without touching the database, safe to call from worker threads
+
+        Returns:
+            Exception: the failure or None if the payload was sent
+        """
+        try:
+            SENDERS[backend](payload)
+        except Exception as e:
+            return e
+        return None
+
+    def record(self, outbox_id, error):
+        """Remove a sent entry or schedule the retry for a failed one
+
+        Returns:
+            tuple: (bool, str) the boolean value is success/failure, the string is the error
+        """
+        if error is None:
+            self.complete(outbox_id)
+            return (True, '')
+        if isinstance(error, OutboxRetry):
+            self.fail(outbox_id, error, delay=error.delay, attempt=error.attempt)
+        elif isinstance(error, OutboxReject):
+            self.fail(outbox_id, error, dead=True)
+        else:
+            self.fail(outbox_id, error)
+        return (False, str(error))
+
+    def deliver(self, outbox_id, backend, payload):
+        """Send a claimed entry, removing it on success or scheduling a retry on failure
+
+        Returns:
+            tuple: (bool, str) the boolean value is success/failure, the string is the error
+        """
+        return self.record(outbox_id, self.send(backend, payload))
+
+    def submit(self, backend, payload, destination='', send=True):
+        """Commit a payload and, unless deferred, try to send it straight away
+        A failed send is left in the outbox for the worker to retry
+
+        Returns:
+            tuple: (bool, str) the boolean value is sent/not sent, the string is the error
+        """
+        outbox_id = self.put(backend, payload, destination, claim=send)
+        if not send:
+            return (False, 'deferred to the outbox worker')
+        return self.deliver(outbox_id, backend, payload)
+
+    def collapse(self, backend, destination, threshold, merge, key=None):
+        """Replace the pending entries for a destination with one entry when there are more than threshold of them,
+        eg. a summary post instead of a backlog of Slack posts
+
+        Args:
+            backend (str): name of the sender in SENDERS
+            destination (str): destination of the entries
+            threshold (int): most pending entries left as they are
+            merge (callable): function taking a list of payloads and returning the payload that replaces them
+            key (callable, optional): function taking a payload and returning its group, only entries in the same group are merged. Defaults to None.
+
+        Returns:
+            int: number of entries replaced
+        """
+        now = time.time()
+        replaced = 0
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            # Claimed entries are being sent and are left alone
+            rows = self.db.execute("SELECT id, payload FROM outbox WHERE state = 'pending' AND backend = ? AND destination = ? AND claimed_until < ? ORDER BY id",
+                                   (backend, destination, now)).fetchall()
+            groups = {}
+            for outbox_id, payload in rows:
+                payload = json.loads(payload)
+                groups.setdefault(key(payload) if key else None, []).append((outbox_id, payload))
+            for entries in groups.values():
+                if len(entries) <= int(threshold):
+                    continue
+                self.db.execute('INSERT INTO outbox (backend, destination, payload, created, next_attempt) VALUES (?, ?, ?, ?, ?)',
+                                (backend, destination, json.dumps(merge([payload for _, payload in entries])), now, now))
+                self.db.executemany('DELETE FROM outbox WHERE id = ?', [(outbox_id,) for outbox_id, _ in entries])
+                replaced += len(entries)
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return replaced
+
+    def stats(self):
+        """Count entries by backend and state
+
+        Returns:
+            dict: {(backend, state): count}
+        """
+        rows = self.db.execute('SELECT backend, state, COUNT(*) FROM outbox GROUP BY backend, state').fetchall()
+        return {(row[0], row[1]): row[2] for row in rows}
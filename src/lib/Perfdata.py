@@ -0,0 +1,95 @@
+"""Parser for Icinga/Nagios plugin performance data
+
+Handles the full plugin perfdata format: 'label'=value[UOM];[warn];[crit];[min];[max]
+- labels in single quotes can contain spaces and '=' and use '' for a literal quote, eg. 'C:\\ Used'=12GB
+- values can use scientific notation, eg. 1.5e-3s, or be U for unknown
+- thresholds can be ranges, eg. @10:20 or ~:5
+
+The text is scanned once with a regex and metrics are yielded lazily as compact __slots__ records.
+
+Usage:
+    for perf in parsePerfdata("rta=0.5ms;100;200;0 'C:\\ Used'=12GB;;;0;100", limit=100):
+        print(perf.label, perf.value, perf.uom)
+"""
+import re
+
+_METRIC = re.compile(r"""
+    (?:'(?P<quoted>(?:[^']|'')*)'|(?P<label>[^\s=']+))
+    =
+    (?P<value>U|[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)?
+    (?P<uom>[^;\s]*)
+    (?:;(?P<warning>[^;\s]*))?
+    (?:;(?P<critical>[^;\s]*))?
+    (?:;(?P<minimum>[^;\s]*))?
+    (?:;(?P<maximum>[^;\s]*))?
+    ;*
+    (?=\s|$)
+    """, re.VERBOSE)
+_SPACE = re.compile(r'\s+')
+_NEXT = re.compile(r'\S*\s*')
+
+
+class Perfdata:
+    __slots__ = ('label', 'value', 'uom', 'warning', 'critical', 'minimum', 'maximum')
+
+    def __init__(self, label='', value='', uom='', warning='', critical='', minimum='', maximum=''):
+        self.label = label
+        self.value = value
+        self.uom = uom
+        self.warning = warning
+        self.critical = critical
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __repr__(self):
+        return f"Perfdata(label={self.label!r}, value={self.value!r}, uom={self.uom!r}, warning={self.warning!r}, critical={self.critical!r}, minimum={self.minimum!r}, maximum={self.maximum!r})"
+
+    def __eq__(self, other):
+        if not isinstance(other, Perfdata):
+            return NotImplemented
+        return all(getattr(self, slot) == getattr(other, slot) for slot in self.__slots__)
+
+
+def parsePerfdata(perfdata, limit=None, errors=None):
+    """Generator yielding a Perfdata record for each metric in the performance data
+
+    Args:
+        perfdata (str): performance data from the check result
+        limit (int, optional): stop after this many metrics, no limit when None or 0. Defaults to None.
+        errors (list, optional): malformed metrics are appended to this list, they are skipped either way. Defaults to None.
+    """
+    if not perfdata:
+        return
+    count = 0
+    position = 0
+    length = len(perfdata)
+    space = _SPACE.match(perfdata, position)
+    if space:
+        position = space.end()
+    while position < length:
+        if limit and count >= limit:
+            return
+        match = _METRIC.match(perfdata, position)
+        if match is None:
+            # Skip to the next whitespace separated token
+            skipped = _NEXT.match(perfdata, position)
+            if errors is not None:
+                errors.append(skipped.group().strip())
+            position = skipped.end()
+            continue
+        quoted = match.group('quoted')
+        yield Perfdata(
+            quoted.replace("''", "'") if quoted is not None else match.group('label'),
+            match.group('value') or '',
+            match.group('uom'),
+            match.group('warning') or '',
+            match.group('critical') or '',
+            match.group('minimum') or '',
+            match.group('maximum') or '',
+        )
+        count += 1
+        position = match.end()
+        space = _SPACE.match(perfdata, position)
+        if space:
+            position = space.end()
+
@@ -0,0 +1,105 @@
+"""Host wide token bucket rate limit shared by every notification process, eg. Slack's one post per second per webhook
+
+Buckets are rows in a SQLite database in WAL mode keyed by the destination. A sender reserves the next free slot in
+the bucket in one transaction and then sleeps until the slot, so concurrent senders are spread out in the order they
+asked instead of all retrying at once. A 429 Retry-After from the destination blocks the bucket for every sender.
+
+Usage:
+    bucket = TokenBucket('/var/lib/icinga2/slack-rate-limit.db', rate=1, burst=3)
+    wait = bucket.reserve(webhook_url, max_wait=10)
+    if wait is not None:
+        time.sleep(wait)
+        post()
+"""
+import time
+
+from lib.Sqlite import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second up to burst tokens
+
+    Args:
+        path (str): full path to the database shared by the processes on the host
+        rate (float, optional): tokens added each second. Defaults to 1.
+        burst (int, optional): most tokens the bucket holds, the number of sends allowed at once after a quiet period. Defaults to 1.
+    """
+    def __init__(self, path, rate=1.0, burst=1):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.path, SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _state(self, key, now):
+        """Tokens in the bucket now and the time it is blocked until, must be called in a transaction"""
+        row = self.db.execute('SELECT tokens, updated, blocked_until FROM buckets WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return self.burst, 0
+        tokens, updated, blocked_until = row
+        return min(self.burst, tokens + max(now - updated, 0) * self.rate), blocked_until
+
+    def reserve(self, key, max_wait=None):
+        """Reserve the next slot in the bucket
+
+        Args:
+            key (str): destination the bucket is for, eg. the webhook url
+            max_wait (float, optional): don't reserve a slot further away than this many seconds. Defaults to None, always reserve.
+
+        Returns:
+            float: seconds to wait before sending, None if the next slot is further away than max_wait
+        """
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            tokens, blocked_until = self._state(key, now)
+            # Tokens below zero are slots already reserved by other senders
+            wait = max((1 - tokens) / self.rate if tokens < 1 else 0, blocked_until - now, 0)
+            if max_wait is not None and wait > float(max_wait):
+                self.db.execute('ROLLBACK')
+                return None
+            self.db.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)',
+                            (key, tokens - 1, now, blocked_until))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return wait
+
+    def wait(self, key):
+        """Seconds until the next free slot without reserving it"""
+        now = time.time()
+        tokens, blocked_until = self._state(key, now)
+        return max((1 - tokens) / self.rate if tokens < 1 else 0, blocked_until - now, 0)
+
+    def block(self, key, seconds):
+        """Stop every sender using the bucket for seconds, eg. from a Retry-After header, and drop reserved slots"""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            _, blocked_until = self._state(key, now)
+            self.db.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)',
+                            (key, 0, now, max(blocked_until, now + float(seconds))))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
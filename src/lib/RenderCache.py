@@ -0,0 +1,131 @@
+"""On disk cache for rendered Grafana panels shared by every notification process on the host
+
+An entry is fresh while it was rendered in the current time bucket (eg. the current 5 minutes). When an entry is
+missing or stale only one process renders it (single-flight), other processes asking for the same panel at the same
+time are served the stale entry, or wait for the render when there is no entry yet. The cache is kept under a size
+limit by removing the least recently used entries.
+
+Usage:
+    cache = RenderCache('/var/cache/icinga2/grafana', bucket=300, max_bytes=104857600)
+    png = cache.get({'panelId': '2', 'var-hostname': 'switch01'}, render_function)
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from lib.FileLock import FileLock
+
+
+class RenderCache:
+    """
+    Args:
+        cache_dir (str): directory for the cached images, created if it doesn't exist
+        bucket (int, optional): seconds a render stays fresh, aligned to the clock so every process agrees. Defaults to 300.
+        max_bytes (int, optional): total size of the cached images before the least recently used are removed. Defaults to 104857600.
+        wait_timeout (int, optional): seconds to wait for another process rendering a missing entry. Defaults to 30.
+    """
+    def __init__(self, cache_dir, bucket=300, max_bytes=104857600, wait_timeout=30):
+        self.cache_dir = cache_dir
+        self.bucket = max(int(bucket), 1)
+        self.max_bytes = int(max_bytes)
+        self.wait_timeout = float(wait_timeout)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.png')
+
+    def _isFresh(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        now = time.time()
+        return mtime >= now - (now % self.bucket)
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            # Record the access for LRU eviction, keep the mtime as it is the render time
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, params, render):
+        """Get the image for the render params from the cache or by calling render
+
+        Args:
+            params (dict): everything that identifies the image eg. dashboard, panelId, hostname, theme and size
+            render (function): called without arguments to render the image, returns bytes or None on failure
+
+        Returns:
+            bytes: the image or None if there is no image
+        """
+        path = self._path(self.key(params))
+        if self._isFresh(path):
+            return self._read(path)
+
+        lock = FileLock(f'{path}.lock')
+        if lock.acquire(blocking=False):
+            try:
+                # Another process may have finished rendering while we were checking
+                if self._isFresh(path):
+                    return self._read(path)
+                data = render()
+                if data:
+                    self._write(path, data)
+                    self.evict()
+                    return data
+                # Rendering failed, an old image is better than none
+                return self._read(path)
+            finally:
+                lock.release()
+
+        # Someone else is rendering, use the stale entry if there is one otherwise wait for their render
+        data = self._read(path)
+        if data is not None:
+            return data
+        if lock.acquire(timeout=self.wait_timeout):
+            lock.release()
+            return self._read(path)
+        return None
+
+    def evict(self):
+        """Remove the least recently used images until the cache is under max_bytes
+        Lock files are left in place, removing one another process has open would break the single-flight
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.png'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for atime, size, path in sorted(entries):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -1,8 +1,92 @@
 import argparse
 import dataclasses
+import hashlib
 import json
+import marshal
 import os
 import sys
+import tempfile
+from stat import S_ISDIR
+
+# Parsed config files and other per-user caches (see readCache) are kept here as marshal snapshots, the directory is only
+# used when it is private to the user
+CONFIG_CACHE_DIR = os.getenv('NOTIFY_CONFIG_CACHE_DIR', os.path.join(tempfile.gettempdir(), f'icinga2-config-cache-{os.geteuid()}'))
+
+# class -> tuples of (attribute, switch suffix, environment var suffix) for its public fields, computed once per class
+_FIELD_TABLES = {}
+# (class, description, switches and types) -> argparse parser, built the first time arguments need parsing
+_PARSERS = {}
+
+
+def _privateCacheDir():
+    """Create the snapshot directory, False if it could be read or written by another user"""
+    try:
+        os.makedirs(CONFIG_CACHE_DIR, mode=0o700, exist_ok=True)
+        stat = os.lstat(CONFIG_CACHE_DIR)
+    except OSError:
+        return False
+    return S_ISDIR(stat.st_mode) and stat.st_uid == os.geteuid() and not stat.st_mode & 0o077
+
+
+def _readSnapshot(snapshot_path, key):
+    """Value from the snapshot if it was written by this user for the same key, eg. the version of the config file, otherwise None"""
+    try:
+        fd = os.open(snapshot_path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd, 'rb') as file:
+        stat = os.fstat(fd)
+        # The snapshots contain the passwords from the config files
+        if stat.st_uid != os.geteuid() or stat.st_mode & 0o077:
+            return None
+        try:
+            snapshot_key, config = marshal.loads(file.read())
+        except (EOFError, ValueError, TypeError):
+            return None
+    return config if tuple(snapshot_key) == key else None
+
+
+def _writeSnapshot(snapshot_path, key, value):
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=CONFIG_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(marshal.dumps((key, value)))
+        os.replace(tmp_path, snapshot_path)
+    except (OSError, ValueError):
+        pass
+
+
+def readCache(name, key):
+    """Value saved by writeCache under the name, None if there is none for the key or it isn't private to the user"""
+    if not CONFIG_CACHE_DIR:
+        return None
+    return _readSnapshot(os.path.join(CONFIG_CACHE_DIR, name), tuple(key))
+
+
+def writeCache(name, key, value):
+    """Save a value that marshal can serialize in the private cache directory, skipped if the directory isn't private"""
+    if CONFIG_CACHE_DIR and _privateCacheDir():
+        _writeSnapshot(os.path.join(CONFIG_CACHE_DIR, name), tuple(key), value)
+
+
+def loadJsonConfig(path):
+    """Parse a JSON config file, later runs are served from a marshal snapshot until the file's size, mtime or inode change
+
+    Raises:
+        OSError: the config file can't be read
+        json.JSONDecodeError: the config file isn't valid JSON
+    """
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + '.marshal'
+    config = readCache(name, key)
+    if config is not None:
+        return config
+
+    with open(path, 'r') as file:
+        config = json.load(file)
+    writeCache(name, key, config)
+    return config
 
 
 @dataclasses.dataclass
@@ -70,6 +154,25 @@ class SettingsParser:
     _json_dict_key: str = None
     config_file: str = ''
     _config_dict: dict = ''
+    # Config file keys used by other scripts sharing the file, not reported as unknown
+    _ignore_config_keys: list = dataclasses.field(default_factory=list)
+
+    @classmethod
+    def _fieldTable(cls):
+        """Public fields of the class with their switch and environment var suffixes, computed once per class
+        instead of deep copying every value with dataclasses.asdict each time the settings are read
+
+        Returns:
+            tuple: tuples of (class attribute, switch suffix, environment var suffix)
+        """
+        table = _FIELD_TABLES.get(cls)
+        if table is None:
+            table = tuple((field.name, field.name.replace('_', '-'), field.name.upper()) for field in dataclasses.fields(cls) if not field.name.startswith('_'))
+            _FIELD_TABLES[cls] = table
+        return table
+
+    def _filterFields(self, exclude, include):
+        return [field for field in self._fieldTable() if field[0] not in exclude and (not include or field[0] in include)]
 
     # implied args format (class var, switch, value) (foo_bar, --foo-bar, value)
     def _getArgVarList(self):
@@ -78,14 +181,7 @@ class SettingsParser:
         Returns:
             list: list of tuples (class attribute, switch, value)
         """        
-        _list = []
-        for key, value in dataclasses.asdict(self).items():
-            if key in self._exclude_from_args or key.startswith('_'):
-                continue
-            if self._include_from_args and key not in self._include_from_args:
-                continue
-            _list.append((key, f'--{self._args_prefix}{key.replace("_", "-")}', value))
-        return _list
+        return [(key, f'--{self._args_prefix}{switch}', getattr(self, key)) for key, switch, _ in self._filterFields(self._exclude_from_args, self._include_from_args)]
 
     def loadArgs(self, args):
         """Iterates through the list of valid Class attributes arguments and if found in the 'args' parameter will set the Class attribute to the arg's value 
@@ -105,14 +201,7 @@ class SettingsParser:
         Returns:
             list: list of tuples (class attribute, json key, value)
         """        
-        _list = []
-        for key, value in dataclasses.asdict(self).items():
-            if key in self._exclude_from_file or key.startswith('_'):
-                continue
-            if self._include_from_file and key not in self._include_from_file:
-                continue
-            _list.append((key, key, value))
-        return _list
+        return [(key, key, getattr(self, key)) for key, _, _ in self._filterFields(self._exclude_from_file, self._include_from_file)]
 
     def loadConfigDict(self):
         """Load configuration from a Dictonary file then iterates through the list of valid Class attributes json keys and updates values if the Class attribute keys exist in the json
@@ -125,6 +214,36 @@ class SettingsParser:
             if key[1] in config:
                 # Set class var with config key value
                 setattr(self, key[0], config[key[1]])
+        for warning in self.checkConfigKeys(config):
+            print(f"Warning: {warning}", file=sys.stderr)
+
+    def checkConfigKeys(self, config):
+        """Find the keys in the config that aren't settings of the class or aren't read from the config file, eg. typos
+
+        Args:
+            config (dict): the config dictionary, or the section of it for the _json_dict_key
+
+        Returns:
+            list: a message for each key
+        """
+        fields = [field[0] for field in self._fieldTable()]
+        read = {key for key, _, _ in self._getConfigVarList()}
+        where = f"the '{self._json_dict_key}' section of the config file" if self._json_dict_key else f"the config file {self.config_file}"
+        warnings = []
+        for key, value in config.items():
+            if key in read or key in self._ignore_config_keys:
+                continue
+            if key in fields:
+                # Nested sections are read by their own settings class
+                if not self._json_dict_key and isinstance(value, dict):
+                    continue
+                warnings.append(f"'{key}' in {where} is ignored, it can only be set as an argument or environment variable")
+                continue
+            import difflib
+            match = difflib.get_close_matches(key, fields, n=1)
+            suggestion = f", did you mean '{match[0]}'?" if match else ''
+            warnings.append(f"Unknown key '{key}' in {where}{suggestion}")
+        return warnings
 
     def loadConfigJsonFile(self):
         """Iterates through the list of valid Class attributes json keys and updates values if the Class attribute keys exist in the config dictionary
@@ -133,9 +252,8 @@ class SettingsParser:
             print(f"Error: The file '{self.config_file}' does not exist.")
             sys.exit(1)
         try:
-            with open(self.config_file, 'r') as file:
-                self._config_dict = json.load(file)
-                self.loadConfigDict()
+            self._config_dict = loadJsonConfig(self.config_file)
+            self.loadConfigDict()
         except IOError as e:
             print(f"Error: Failed to open '{self.config_file}': {e}")
             sys.exit(1)
@@ -150,14 +268,7 @@ class SettingsParser:
         Returns:
             list: list of tuples (class attribute, environment var, value)
         """        
-        _list = []
-        for key, value in dataclasses.asdict(self).items():
-            if key in self._exclude_from_env or key.startswith('_'):
-                continue
-            if self._include_from_env and key not in self._include_from_env:
-                continue
-            _list.append((key, f'{self._env_prefix}{key.upper()}', value))
-        return _list
+        return [(key, f'{self._env_prefix}{env}', getattr(self, key)) for key, _, env in self._filterFields(self._exclude_from_env, self._include_from_env)]
 
     def loadEnvironmentVars(self):
         """Iterates through the list of valid Class attributes environment vars and tries to read them from the environment
@@ -180,11 +291,66 @@ class SettingsParser:
             else:
                 print(var[1])
 
+    def describeArgs(self):
+        """Machine readable description of the arguments, printed as JSON by --describe-args so other scripts don't have to parse --help
+
+        Returns:
+            list: list of dicts with the class attribute (name), switch and type of each argument
+        """
+        return [{'name': arg[0], 'switch': arg[1], 'type': type(arg[2]).__name__} for arg in self._getArgVarList()]
+
+    @classmethod
+    def _getParser(cls, description, arg_list):
+        """argparse parser for the arguments, cached as building it costs more than parsing"""
+        key = (cls, description, tuple((arg[1], type(arg[2])) for arg in arg_list))
+        parser = _PARSERS.get(key)
+        if parser is None:
+            parser = argparse.ArgumentParser(description=description)
+            parser.add_argument('--describe-args', action="store_true", help="print the arguments as JSON and exit")
+            for arg in arg_list:
+                if type(arg[2]) == bool:
+                    parser.add_argument(arg[1], action="store_true")
+                else:
+                    parser.add_argument(arg[1], type=type(arg[2]))
+            _PARSERS[key] = parser
+        return parser
+
+    @staticmethod
+    def _parseSimpleArgs(arg_list, args, argv):
+        """Parse arguments in the plain '--switch value' form the notification commands use without building the argparse parser
+
+        Returns:
+            bool: False for anything else, eg. --help, --switch=value, unknown switches or values that aren't valid for the type, left to argparse
+        """
+        switches = {arg[1]: (arg[0], type(arg[2])) for arg in arg_list}
+        switches['--describe-args'] = ('describe_args', bool)
+        i = 0
+        while i < len(argv):
+            if argv[i] not in switches:
+                return False
+            name, kind = switches[argv[i]]
+            if kind == bool:
+                setattr(args, name, True)
+                i += 1
+                continue
+            # argparse treats a value starting with - as the next switch
+            if i + 1 >= len(argv) or argv[i + 1].startswith('-'):
+                return False
+            try:
+                setattr(args, name, kind(argv[i + 1]))
+            except ValueError:
+                return False
+            i += 2
+        return True
+
     def _init_args(self, description):
-        parser = argparse.ArgumentParser(description=description)
-        for arg in self._getArgVarList():
-            if type(arg[2]) == bool:
-                parser.add_argument(arg[1], action="store_true")
-            else:
-                parser.add_argument(arg[1], type=type(arg[2]), default=arg[2])
-        return parser.parse_args()
\ No newline at end of file
+        arg_list = self._getArgVarList()
+        # The defaults are set up front, argparse only overwrites the arguments that are given
+        args = argparse.Namespace(describe_args=False, **{arg[0]: False if type(arg[2]) == bool else arg[2] for arg in arg_list})
+        # The parser is only built for arguments the simple parser can't handle
+        if not self._parseSimpleArgs(arg_list, args, sys.argv[1:]):
+            self._getParser(description, arg_list).parse_args(namespace=args)
+        if args.describe_args:
+            print(json.dumps({'arguments': self.describeArgs()}))
+            sys.exit(0)
+        return args
\ No newline at end of file
@@ -0,0 +1,32 @@
+"""Connections to the SQLite state files of the notification scripts (ticket index, digest, outbox, ...)
+
+Every file is opened the same way: in autocommit mode so transactions are started explicitly with BEGIN IMMEDIATE,
+in WAL mode so readers don't wait on writers, and waiting up to 30 seconds for another process's write lock.
+
+Usage:
+    self._db = connect('/var/lib/icinga2/notification-outbox.db', SCHEMA, private=True)
+"""
+import os
+import sqlite3
+
+
+def connect(path, schema, private=False):
+    """Open the file, creating its directory and tables if they don't exist
+
+    Args:
+        path (str): database file
+        schema (str): CREATE ... IF NOT EXISTS statements run on every connect
+        private (bool, optional): create the file readable only by the user, eg. it stores message contents. Defaults to False.
+
+    Returns:
+        sqlite3.Connection: connection in autocommit mode
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        if private:
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(schema)
+    return db
@@ -0,0 +1,44 @@
+"""Jinja2 templates for the notification scripts
+
+Templates are loaded from disk so the layout can be customised without editing the scripts. Compiled templates are
+kept in a Jinja2 bytecode cache so each notification doesn't compile them again.
+
+Usage:
+    templates = templateEnvironment('/etc/icinga2/scripts/templates')
+    html = templates.get_template('enhanced-mail.html.j2').render(config=config)
+"""
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def templateEnvironment(template_dir, cache_dir=''):
+    """Create the template environment for a template directory, created once per process
+
+    Args:
+        template_dir (str): directory containing the templates
+        cache_dir (str, optional): directory for compiled templates, Jinja2 picks a private temp directory when empty. Defaults to ''.
+
+    Returns:
+        jinja2.Environment: environment to get templates from
+    """
+    import jinja2
+
+    class BytecodeCache(jinja2.FileSystemBytecodeCache):
+        # A cache we can't write to shouldn't stop the notification
+        def dump_bytecode(self, bucket):
+            try:
+                super().dump_bytecode(bucket)
+            except OSError:
+                pass
+
+    try:
+        bytecode_cache = BytecodeCache(cache_dir or None)
+    except Exception:
+        bytecode_cache = None
+
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_dir),
+        bytecode_cache=bytecode_cache,
+        trim_blocks=True,
+        lstrip_blocks=True,
+    )
@@ -0,0 +1,85 @@
+"""Local index of the RT ticket for each Icinga host and service
+
+request-tracker-notification.py records the ticket it creates and updates its state on acknowledge and recovery, so
+finding the ticket for a notification doesn't need a request to the Icinga API. The Icinga comment added with each
+ticket is still the source of truth and is used to rebuild an entry that is missing from the index.
+
+The index is a SQLite database in WAL mode so the concurrent notification processes on the host can share it.
+
+Usage:
+    index = TicketIndex('/var/lib/icinga2/rt-ticket-index.db')
+    index.put('switch01', 'ping', '1234')
+    ticket_id, state = index.get('switch01', 'ping')
+"""
+import time
+
+from lib.Sqlite import connect
+
+OPEN = 'open'
+ACKNOWLEDGED = 'acknowledged'
+RECOVERED = 'recovered'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    host TEXT NOT NULL,
+    service TEXT NOT NULL DEFAULT '',
+    ticket_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (host, service)
+) WITHOUT ROWID;
+"""
+
+
+class TicketIndex:
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = connect(self.path, SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, host, service=''):
+        """Get the ticket for a host or service
+
+        Returns:
+            tuple: (ticket_id, state) or None if the host or service isn't in the index
+        """
+        row = self.db.execute('SELECT ticket_id, state FROM tickets WHERE host = ? AND service = ?', (host, service or '')).fetchone()
+        if row is None:
+            return None
+        return (row[0], row[1])
+
+    def put(self, host, service, ticket_id, state=OPEN):
+        """Record the ticket for a host or service, replacing the previous ticket"""
+        self.db.execute('INSERT OR REPLACE INTO tickets (host, service, ticket_id, state, updated) VALUES (?, ?, ?, ?, ?)',
+                        (host, service or '', str(ticket_id), state, time.time()))
+
+    def setState(self, host, service, state):
+        """Update the state of the ticket for a host or service
+
+        Returns:
+            bool: False if the host or service isn't in the index
+        """
+        cursor = self.db.execute('UPDATE tickets SET state = ?, updated = ? WHERE host = ? AND service = ?',
+                                 (state, time.time(), host, service or ''))
+        return cursor.rowcount > 0
+
+    def entries(self):
+        """Every ticket in the index
+
+        Returns:
+            list: list of tuples (host, service, ticket_id, state)
+        """
+        return [tuple(row) for row in self.db.execute('SELECT host, service, ticket_id, state FROM tickets ORDER BY host, service')]
+
+    def remove(self, host, service=''):
+        self.db.execute('DELETE FROM tickets WHERE host = ? AND service = ?', (host, service or ''))
@@ -0,0 +1,51 @@
+"""Host wide counting semaphore made from a pool of lock files
+
+Each slot is a FileLock, a process holds a slot while it works and the kernel frees the slot if the process dies.
+
+Usage:
+    pool = TokenPool('/tmp/icinga2-grafana-render', size=4)
+    token = pool.acquire(timeout=10)
+    if token is not None:
+        try:
+            do_something()
+        finally:
+            pool.release(token)
+"""
+import os
+import random
+import time
+
+from lib.FileLock import FileLock
+
+
+class TokenPool:
+    def __init__(self, directory, size, poll_interval=0.05):
+        self.directory = directory
+        self.size = max(int(size), 1)
+        self.poll_interval = poll_interval
+        os.makedirs(self.directory, exist_ok=True)
+
+    def acquire(self, timeout=None):
+        """Wait for a free slot
+
+        Args:
+            timeout (float, optional): seconds to wait, waits forever when None. Defaults to None.
+
+        Returns:
+            FileLock: the held slot or None if no slot was free in time
+        """
+        deadline = None if timeout is None else time.monotonic() + float(timeout)
+        # Start at a random slot so waiting processes don't all try the same lock first
+        start = random.randrange(self.size)
+        slots = [(start + i) % self.size for i in range(self.size)]
+        while True:
+            for slot in slots:
+                lock = FileLock(os.path.join(self.directory, f'slot-{slot}.lock'))
+                if lock.acquire(blocking=False):
+                    return lock
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def release(self, token):
+        token.release()
@@ -18,29 +18,106 @@ def _safe_log_file(log_file):
     return (log_file, writable)
 
 
-def initLogger(log_disable_file = False, log_level = "INFO", log_file = "/var/log/icinga2/notification_script.log", rotate = '1 day', retention = '2 days'):
+class _LazyLogger:
+    """Stands in for the loguru logger and imports loguru on first use, so early exits like --help and
+    --describe-args don't pay for importing it"""
+    def __init__(self):
+        self._logger = None
+
+    def __getattr__(self, name):
+        if self._logger is None:
+            from loguru import logger
+            self._logger = logger
+        return getattr(self._logger, name)
+
+
+logger = _LazyLogger()
+
+
+def correlationId():
+    """Id shared by every log line of a notification, taken from NOTIFY_LOG_CORRELATION_ID if set. A new id is put in
+    the environment so scripts run by this one, eg. the path impact notifications, log with the same id"""
+    import os
+    import uuid
+    if not os.getenv('NOTIFY_LOG_CORRELATION_ID'):
+        os.environ['NOTIFY_LOG_CORRELATION_ID'] = uuid.uuid4().hex[:16]
+    return os.environ['NOTIFY_LOG_CORRELATION_ID']
+
+
+def _jsonFormat(record):
+    """loguru format function for one JSON document per line"""
+    import json
+    import traceback
+    document = {
+        'time': record['time'].isoformat(timespec='milliseconds'),
+        'pid': record['process'].id,
+        'level': record['level'].name,
+        'function': record['function'],
+        'line': record['line'],
+        'correlation_id': record['extra'].get('correlation_id', ''),
+        'message': record['message'],
+    }
+    if record['exception'] is not None:
+        document['exception'] = ''.join(traceback.format_exception(*record['exception']))
+    record['extra']['json'] = json.dumps(document)
+    return '{extra[json]}\n'
+
+
+def initLogger(log_disable_file = False, log_level = "INFO", log_file = "/var/log/icinga2/notification_script.log", rotate = '1 day', retention = '2 days', mode = None):
+    """Set up the log sink, the mode and format are taken from the environment so every script can be switched over
+    without changing its config
+
+    NOTIFY_LOG_MODE:
+        file (default): append to log_file, rotated and compressed by the process that logs when it is due
+        socket: send each line to log-collector.py over a unix datagram socket (NOTIFY_LOG_SOCKET), falling back to
+            a spool file of the process when the collector can't take it
+        pid: append to a spool file of the process in NOTIFY_LOG_SPOOL_DIR, merged into log_file by log-collector.py
+    NOTIFY_LOG_FORMAT: text (default) or json, json lines include the correlation id
+
+    Args:
+        mode (str, optional): overrides NOTIFY_LOG_MODE, the collector itself always logs in file mode. Defaults to None.
+
+    Returns:
+        bool: False if logging fell back to stdout because the log file or spool isn't writable
+    """
+    import os
     from loguru import logger
+    mode = mode or os.getenv('NOTIFY_LOG_MODE', 'file')
+    logger.configure(extra={'correlation_id': correlationId()})
     format = "<blue>{time:YYYY-MM-DD HH:mm:ss.SSS}</blue> <yellow>({process.id})</yellow> <level>{level}</level>: {message}"
     if log_level == "DEBUG" and not log_disable_file:
         format = "<blue>{time:YYYY-MM-DD HH:mm:ss.SSS}</blue> <yellow>({process.id})</yellow> <cyan>{function}</cyan>:<cyan>{line}</cyan> <level>{level}</level>: {message}"
     else:
         logger.remove()
+    colorize = True
+    if os.getenv('NOTIFY_LOG_FORMAT', 'text') == 'json':
+        format = _jsonFormat
+        colorize = False
     if log_disable_file:
         return True
-    log_file, writable = _safe_log_file(log_file)
     try:
-        logger.add(log_file,
-                colorize=True,
-                format=format,
-                level=log_level,
-                rotation=rotate,
-                retention=retention,
-                compression="gz"
-                )
+        if mode in ('socket', 'pid'):
+            from lib.LogCollector import DatagramSink, SpoolSink, spoolDir
+            name = os.path.basename(log_file)
+            writable = os.access(spoolDir(), os.W_OK) or os.access(os.path.dirname(spoolDir()), os.W_OK)
+            if not writable:
+                raise PermissionError(f"Spool directory {spoolDir()} isn't writable")
+            sink = DatagramSink(name) if mode == 'socket' else SpoolSink(name)
+            logger.add(sink, colorize=colorize, format=format, level=log_level)
+        else:
+            log_file, writable = _safe_log_file(log_file)
+            logger.add(log_file,
+                    colorize=colorize,
+                    format=format,
+                    level=log_level,
+                    rotation=rotate,
+                    retention=retention,
+                    compression="gz"
+                    )
     except Exception as e:
         import sys
         logger.add(sys.stdout,
-                colorize=True,
+                colorize=colorize,
                 format=format,
                 level=log_level,
                 )
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+'''Per-host log collector for the notification scripts, the one process that writes, rotates and compresses their logs
+
+Scripts logging in the socket or pid mode (NOTIFY_LOG_MODE, see lib/Util.initLogger and lib/LogCollector.py) send
+their log lines here over a unix datagram socket or leave them in spool files. Lines are appended to the log files in
+log_dir, which are rotated every rotation_interval seconds and compressed in the background, so a notification never
+waits on a gzip or races other processes rotating the same file. Spool files of processes that have exited are merged
+into the log files every sweep_interval seconds, their lines are appended after the lines already received.
+'''
+
+import dataclasses
+import datetime
+import glob
+import gzip
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from lib.LogCollector import DEFAULT_SOCKET_PATH, DEFAULT_SPOOL_DIR, decodeLine, parseSpoolName
+from lib.SettingsParser import SettingsParser
+from lib.Util import initLogger, logger
+
+# Larger lines don't fit in a datagram and are spooled by the client
+MAX_DATAGRAM = 262144
+
+
+@dataclasses.dataclass
+class Settings(SettingsParser):
+    debug: bool = False
+    disable_log_file: bool = False
+
+    socket_path: str = DEFAULT_SOCKET_PATH
+    # octal file mode for the socket, the icinga2 user needs write access
+    socket_mode: str = '660'
+    spool_dir: str = DEFAULT_SPOOL_DIR
+    log_dir: str = '/var/log/icinga2'
+    # seconds, the same as the 1 day rotation and 2 days retention of the file log mode
+    rotation_interval: int = 86400
+    retention: int = 172800
+    sweep_interval: int = 10
+
+    print_config: bool = False
+
+    def __post_init__(self):
+        try:
+            self._exclude_from_args.extend(['config_file'])
+            self._exclude_from_env.extend(['config_file', 'print_config'])
+            self._env_prefix = "LOG_COLLECTOR_"
+            self.loadEnvironmentVars()
+            self._args = self._init_args('Collect, rotate and compress the notification script logs')
+            self.loadArgs(self._args)
+            self.rotation_interval = max(int(self.rotation_interval), 60)
+            self.retention = int(self.retention)
+            self.sweep_interval = max(int(self.sweep_interval), 1)
+
+        except Exception as e:
+            print(f"Failed to initialize {e}")
+            print(traceback.format_exc())
+            sys.exit()
+
+
+def compress(path):
+    try:
+        with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.unlink(path)
+    except OSError as e:
+        logger.error(f"Unable to compress {path}: {e}")
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user
+        return True
+    return True
+
+
+class LogFile:
+    """A log file only the collector writes to, rotated at the start of every rotation interval"""
+    def __init__(self, path, rotation_interval, retention):
+        self.path = path
+        self.rotation_interval = rotation_interval
+        self.retention = retention
+        self._fd = None
+        self._period = None
+
+    def rotateIfDue(self):
+        period = int(time.time() // self.rotation_interval)
+        if period == self._period:
+            return
+        # The file may be left over from an earlier period when the collector starts
+        if os.path.exists(self.path) and int(os.stat(self.path).st_mtime // self.rotation_interval) < period:
+            self.rotate()
+        self._period = period
+
+    def write(self, data):
+        self.rotateIfDue()
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        os.write(self._fd, data)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def rotate(self):
+        """Rename the log file the same way loguru does and compress it in the background"""
+        self.close()
+        base, ext = os.path.splitext(self.path)
+        rotated = f"{base}.{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S_%f')}{ext}"
+        try:
+            os.rename(self.path, rotated)
+        except OSError as e:
+            logger.error(f"Unable to rotate {self.path}: {e}")
+            return
+        threading.Thread(target=compress, args=(rotated,), daemon=True).start()
+        self.removeExpired()
+
+    def removeExpired(self):
+        base, ext = os.path.splitext(self.path)
+        cutoff = time.time() - self.retention
+        for path in glob.glob(f"{glob.escape(base)}.*{ext}.gz"):
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+class Collector:
+    def __init__(self, config):
+        self.config = config
+        self.files = {}
+
+    def write(self, name, data):
+        if name not in self.files:
+            self.files[name] = LogFile(os.path.join(self.config.log_dir, name), self.config.rotation_interval, self.config.retention)
+        try:
+            self.files[name].write(data)
+        except OSError as e:
+            logger.error(f"Unable to write to {name}: {e}")
+
+    def rotate(self):
+        """Rotate the files nothing has been written to since the interval started"""
+        for log_file in self.files.values():
+            try:
+                log_file.rotateIfDue()
+            except OSError as e:
+                logger.error(f"Unable to rotate {log_file.path}: {e}")
+
+    def sweep(self):
+        """Merge the spool files of processes that have exited
+
+        Returns:
+            int: number of spool files merged
+        """
+        merged = 0
+        try:
+            file_names = os.listdir(self.config.spool_dir)
+        except FileNotFoundError:
+            return 0
+        for file_name in file_names:
+            name, pid = parseSpoolName(file_name)
+            if name is None or alive(pid):
+                continue
+            path = os.path.join(self.config.spool_dir, file_name)
+            try:
+                with open(path, 'rb') as file:
+                    data = file.read()
+                if data:
+                    self.write(name, data)
+                os.unlink(path)
+                merged += 1
+            except OSError as e:
+                logger.error(f"Unable to merge spool file {path}: {e}")
+        return merged
+
+    def close(self):
+        for log_file in self.files.values():
+            log_file.close()
+
+
+if __name__ == "__main__":
+    config = Settings()
+
+    if config.print_config:
+        logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+        config.printArguments()
+        config.printEnvironmentVars()
+        sys.exit(0)
+
+    # Init logging, the collector can't send its own logs to itself
+    log_level = 'DEBUG' if config.debug else 'INFO'
+    log_writeable = initLogger(log_disable_file=config.disable_log_file, log_level=log_level, log_file="/var/log/icinga2/log-collector.log", mode='file')
+
+    os.makedirs(config.spool_dir, exist_ok=True)
+    if os.path.exists(config.socket_path):
+        os.unlink(config.socket_path)
+    os.makedirs(os.path.dirname(config.socket_path), exist_ok=True)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(config.socket_path)
+    os.chmod(config.socket_path, int(config.socket_mode, 8))
+    # A bigger buffer absorbs bursts during a storm, clients spool what doesn't fit
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.settimeout(1)
+
+    # Close the log files and remove the socket when systemd stops the collector
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    collector = Collector(config)
+    logger.info(f"log collector listening on {config.socket_path}, merged {collector.sweep()} spool files")
+    next_sweep = time.monotonic() + config.sweep_interval
+    try:
+        while True:
+            try:
+                name, line = decodeLine(sock.recv(MAX_DATAGRAM))
+                if name is not None:
+                    collector.write(name, line)
+            except socket.timeout:
+                pass
+            if time.monotonic() >= next_sweep:
+                merged = collector.sweep()
+                if merged:
+                    logger.debug(f"Merged {merged} spool files")
+                collector.rotate()
+                next_sweep = time.monotonic() + config.sweep_interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.unlink(config.socket_path)
+        collector.close()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+'''Keeps a local mirror of Netbox devices, virtual machines and ip addresses for the notification scripts
+
+Run it from cron or a systemd timer. Each run pulls the objects changed since the previous run using the
+last_updated filter, a full pull is done every full_sync_interval seconds to remove deleted objects.
+With --check it runs as an Icinga check plugin reporting the age of the mirror.
+'''
+
+import dataclasses
+import json
+import os
+import sys
+import time
+import traceback
+
+from lib.ImpactGraph import ImpactGraph
+from lib.NetboxMirror import KINDS, NetboxMirror
+from lib.SettingsParser import SettingsParser
+from lib.Util import initLogger, logger
+
+# Kinds with an impact assessment in the path plugin
+IMPACT_KINDS = ['dcim/devices', 'virtualization/virtual-machines']
+
+# Helper to load config from file
+@dataclasses.dataclass
+class SettingsFile(SettingsParser):
+    def __post_init__(self):
+        self.loadConfigDict()
+
+@dataclasses.dataclass
+class SettingsNetbox(SettingsFile):
+    # INFO: no trailing / on the url. eg: http://netbox.domain.local
+    url: str = ''
+    token: str = 'abcdefghijklmnopqrstuvwxyz1234567890'
+    proxy: str = ''
+    timeout: str = 60
+    page_size: int = 1000
+    mirror_file: str = '/var/lib/icinga2/netbox-mirror.db'
+    # seconds between full pulls
+    full_sync_interval: int = 86400
+    # Snapshot of the path plugin impact assessment of every device and virtual machine, leave empty to not take one
+    impact_file: str = ''
+    api_impact: str = '/api/plugins/netbox-path/impact'
+    # seconds between impact snapshots
+    impact_sync_interval: int = 3600
+    _json_dict_key: str = 'netbox'
+
+@dataclasses.dataclass
+class Settings(SettingsParser):
+    netbox: object = None
+    _exclude_all: list = dataclasses.field(default_factory=lambda: ['netbox'])
+
+    config_file: str = f'{os.path.realpath(os.path.dirname(__file__))}/config/netbox-mirror-sync.json'
+    debug: bool = False
+    disable_log_file: bool = False
+
+    # Pull everything even if the last full pull is recent
+    full: bool = False
+    # Report the mirror age as an Icinga check instead of syncing
+    check: bool = False
+    warning: int = 900
+    critical: int = 3600
+
+    print_config: bool = False
+
+    def __post_init__(self):
+        try:
+            self._exclude_from_args.extend(self._exclude_all)
+            self._exclude_from_env.extend(self._exclude_all + ['print_config'])
+            self._env_prefix = "NETBOX_MIRROR_"
+            self.loadEnvironmentVars()
+            self._args = self._init_args('Sync Netbox devices, virtual machines and ip addresses to a local mirror')
+            self.loadArgs(self._args)
+
+            # Debug set in the config file will override the args
+            self._include_from_file = ['debug', 'disable_log_file']
+            self.loadConfigJsonFile()
+
+        except Exception as e:
+            print(f"Failed to initialize {e}")
+            print(traceback.format_exc())
+            sys.exit()
+
+
+def pull(session, kind, last_updated=''):
+    """Generator yielding every object of the kind from the Netbox api, following the pagination"""
+    params = {'limit': config.netbox.page_size, 'ordering': 'last_updated'}
+    if last_updated:
+        params['last_updated__gte'] = last_updated
+    url = f'{config.netbox.url}/api/{kind}/'
+    while url:
+        logger.debug(f"Netbox request to url: {url} params: {params}")
+        response = session.get(url, params=params, timeout=float(config.netbox.timeout))
+        response.raise_for_status()
+        result = response.json()
+        yield from result['results']
+        # The next url already contains the query parameters
+        url = result.get('next')
+        params = None
+
+
+def pullImpacts(session, mirror):
+    """Generator yielding the impact assessment of every device and virtual machine in the mirror, the paths are None
+    for objects whose assessment couldn't be pulled so the snapshot keeps their previous assessment"""
+    for kind in IMPACT_KINDS:
+        object_type = kind.replace('/', '.')
+        for object_id in mirror.ids(kind):
+            url = f'{config.netbox.url}{config.netbox.api_impact}'
+            params = {'id': object_id, 'type': object_type}
+            logger.debug(f"Netbox request to url: {url} params: {params}")
+            try:
+                response = session.get(url, params=params, timeout=float(config.netbox.timeout))
+                response.raise_for_status()
+                paths = response.json()
+                if not isinstance(paths, list):
+                    raise ValueError(f"unexpected response {paths}")
+            except Exception as e:
+                logger.warning(f"Failed to pull the impact assessment of {object_type} {object_id}, keeping the previous assessment: {e}")
+                paths = None
+            yield object_type, object_id, paths
+
+
+def check(mirror):
+    """Icinga check plugin output for the age of the oldest synced kind"""
+    age = mirror.age()
+    if age is None:
+        print(f"CRITICAL - Netbox mirror {config.netbox.mirror_file} has not been fully synced")
+        return 2
+    perfdata = f"age={int(age)}s;{config.warning};{config.critical};0"
+    if age > float(config.critical):
+        print(f"CRITICAL - Netbox mirror is {int(age)}s old | {perfdata}")
+        return 2
+    if age > float(config.warning):
+        print(f"WARNING - Netbox mirror is {int(age)}s old | {perfdata}")
+        return 1
+    print(f"OK - Netbox mirror is {int(age)}s old | {perfdata}")
+    return 0
+
+
+if __name__ == "__main__":
+    config = Settings()
+    config.netbox = SettingsNetbox(_config_dict=config._config_dict)
+
+    if config.print_config:
+        logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+        config.printArguments()
+        config.printEnvironmentVars()
+        sys.exit(0)
+
+    mirror = NetboxMirror(config.netbox.mirror_file)
+    if config.check:
+        sys.exit(check(mirror))
+
+    # Init logging
+    log_level = 'DEBUG' if config.debug else 'INFO'
+    log_writeable = initLogger(log_disable_file=config.disable_log_file, log_level=log_level, log_file="/var/log/icinga2/netbox-mirror-sync.log")
+
+    # Only the sync needs requests, --check stays cheap
+    import requests
+    session = requests.Session()
+    session.headers.update({'Accept': 'application/json'})
+    if config.netbox.proxy:
+        session.proxies.update({'http': config.netbox.proxy, 'https': config.netbox.proxy})
+    if config.netbox.token:
+        session.headers.update({'Authorization': 'Token ' + config.netbox.token})
+
+    failed = False
+    for kind in KINDS:
+        full = config.full or time.time() - mirror.lastFullSync(kind) > float(config.netbox.full_sync_interval)
+        try:
+            count = mirror.store(kind, pull(session, kind, '' if full else mirror.lastUpdated(kind)), full=full)
+            logger.info(f"Synced {count} {kind} from Netbox ({'full' if full else 'incremental'})")
+        except Exception as e:
+            logger.error(f"Failed to sync {kind} from Netbox: {e}")
+            failed = True
+
+    # Objects whose assessment can't be pulled keep their previous assessment in the snapshot
+    if config.netbox.impact_file and not failed:
+        graph = ImpactGraph(config.netbox.impact_file)
+        age = graph.age()
+        if config.full or age is None or age > float(config.netbox.impact_sync_interval):
+            try:
+                objects, paths, kept = graph.store(pullImpacts(session, mirror))
+                if kept and not objects:
+                    logger.error(f"Failed to pull the impact assessment of all {kept} objects, keeping the previous snapshot")
+                    failed = True
+                else:
+                    logger.info(f"Took the impact snapshot of {objects} objects with {paths} impacted paths, {kept} objects kept their previous assessment")
+            except Exception as e:
+                logger.error(f"Failed to take the impact snapshot from Netbox, keeping the previous snapshot: {e}")
+                failed = True
+
+    sys.exit(1 if failed else 0)
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import dataclasses
+import hashlib
 import json
 import os
-import requests
 import subprocess
 import sys
+import time
 import traceback
 
-from lib.SettingsParser import SettingsParser
-from lib.Util import initLogger
+from lib.Notifyd import forwardToDaemon
+# Hand the notification to notifyd when it is running, before loading any of the heavy dependencies
+forwardToDaemon(__file__)
 
-from loguru import logger
+from lib.ImpactGraph import ImpactGraph
+from lib.JsonStream import iterArray
+from lib.NetboxMirror import NetboxMirror
+from lib.SettingsParser import SettingsParser, readCache, writeCache
+from lib.Util import initLogger, logger
 
 # Helper to load config from file
 @dataclasses.dataclass
@@ -30,6 +37,14 @@ class SettingsNetbox(SettingsFile):
     api_impact: str = ''
     proxy: str = ''
     timeout: str = 20
+    # Local mirror kept up to date by netbox-mirror-sync.py, leave empty to always use the api
+    mirror_file: str = ''
+    # Seconds after the last sync before the mirror is ignored
+    mirror_max_age: int = 3600
+    # Impact snapshot taken by netbox-mirror-sync.py, leave empty to always use the impact api
+    impact_file: str = ''
+    # Seconds after the last snapshot before it is ignored
+    impact_max_age: int = 7200
     _json_dict_key: str = 'netbox'
 
 @dataclasses.dataclass
@@ -58,6 +73,11 @@ class Settings(SettingsParser):
 
     object_type: str = ''
     notification_script: str = ''
+    # Number of contacts notified at once and the seconds each notification script run is allowed
+    max_concurrency: int = 4
+    contact_timeout: int = 60
+    # Objects listed for each impacted path, the rest are summarised as "+N more objects", 0 lists them all
+    max_objects: int = 50
 
     print_config: bool = False
 
@@ -71,7 +91,7 @@ class Settings(SettingsParser):
             self.loadArgs(self._args)
 
             # Debug set in the config file will override the args
-            self._include_from_file = ['debug', 'disable_log_file']
+            self._include_from_file = ['debug', 'disable_log_file', 'max_concurrency', 'contact_timeout', 'max_objects']
             self.loadConfigJsonFile()
             self.object_type = self.object_type.replace('.', '/')
 
@@ -102,7 +122,9 @@ class Netbox:
         Search netbox for host
         :return:
         """
-        nb_object = self.__searchData(f'{self.config.netbox.url}/api/{self.config.object_type}/?name={self.config.host_name}')
+        nb_object = self.__searchMirror(self.config.object_type, self.config.host_name)
+        if nb_object is None:
+            nb_object = self.__searchData(f'{self.config.netbox.url}/api/{self.config.object_type}/?name={self.config.host_name}')
         logger.debug(json.dumps(nb_object, indent=4, sort_keys=True))
         if nb_object:
             self.host = nb_object
@@ -110,12 +132,60 @@ class Netbox:
         else:
             logger.warning("Found no objects that match")
 
+    def __searchMirror(self, kind, name):
+        """Search the local Netbox mirror
+
+        :return: dict : the object, {} for multiple matches or None if the api needs to be searched
+        """
+        mirror_file = self.config.netbox.mirror_file
+        if not mirror_file or not os.path.exists(mirror_file):
+            return None
+        try:
+            mirror = NetboxMirror(mirror_file)
+            result = mirror.search(kind, name=name) if mirror.isFresh(kind, self.config.netbox.mirror_max_age) else None
+            mirror.close()
+        except Exception as e:
+            logger.error(f"Error searching the Netbox mirror {mirror_file} with error {e}")
+            result = None
+        logger.debug(f"Netbox mirror result: {result}")
+        return result
+
+    def __searchImpactGraph(self):
+        """Search the local impact snapshot
+
+        :return: list : the impacted paths or None if the impact api needs to be asked
+        """
+        impact_file = self.config.netbox.impact_file
+        if not impact_file or not os.path.exists(impact_file):
+            return None
+        try:
+            graph = ImpactGraph(impact_file)
+            result = graph.impacted(self.type, self.host['id']) if graph.isFresh(self.config.netbox.impact_max_age) else None
+            graph.close()
+        except Exception as e:
+            logger.error(f"Error searching the impact snapshot {impact_file} with error {e}")
+            result = None
+        logger.debug(f"Impact snapshot result: {'miss' if result is None else f'{len(result)} impacted paths'}")
+        return result
+
     def getImpactAssessment(self):
+        """Impacted paths from the impact assessment api, the response is parsed as it is read as it can list
+        thousands of objects and contacts for core links
+
+        :return: generator : each impacted path as it is parsed
+        """
+        paths = self.__searchImpactGraph()
+        if paths is not None:
+            yield from paths
+            return
+
+        import requests
         args = {
             'url': f'{self.config.netbox.url}{self.config.netbox.api_impact}',
             'params': { 'id': self.host['id'], 'type': self.type },
             'timeout': self.config.netbox.timeout,
-            'headers': {'Accept': 'application/json'}
+            'headers': {'Accept': 'application/json'},
+            'stream': True
         }
         if self.config.netbox.proxy:
             args['proxies'] = {'http': self.config.netbox.proxy, 'https': self.config.netbox.proxy}
@@ -123,17 +193,19 @@ class Netbox:
         if self.config.netbox.token:
             args['headers'].update({'Authorization': 'Token ' + self.config.netbox.token})
 
+        count = 0
         try:
             logger.debug(f"Netbox request to url: {args['url']}")
-            response = requests.get(**args)
-            result = response.json()
+            with requests.get(**args) as response:
+                for path in iterArray(response.iter_content(chunk_size=65536)):
+                    count += 1
+                    yield path
         except Exception as e:
             logger.error("Error getting netbox data from {} with error {}".format(args['url'], e))
-            result = {'count': 0}
-        logger.debug(f"Netbox result: {result}")
-        return result
+        logger.debug(f"Netbox result: {count} impacted paths")
 
     def __getServerData(self, url):
+        import requests
         args = {
             'url': url,
             'timeout': self.config.netbox.timeout,
@@ -162,6 +234,40 @@ class Netbox:
             return {}
         
 def parse_script_args(script: str) -> list:
+    """Arguments the notification script accepts, cached in the private cache directory by the script path until the
+    script changes so the script is only run when it changes"""
+    try:
+        path = os.path.realpath(script)
+        stat = os.stat(path)
+    except OSError as e:
+        logger.error(f"Error reading notification script {script}: {e}")
+        return []
+
+    name = 'script-args-' + hashlib.sha1(path.encode('utf-8')).hexdigest() + '.marshal'
+    key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    arguments = readCache(name, key)
+    if arguments is not None:
+        return arguments
+
+    arguments = describe_script_args(script)
+    if arguments is None:
+        arguments = help_script_args(script)
+    if arguments:
+        writeCache(name, key, arguments)
+    return arguments
+
+def describe_script_args(script: str) -> list:
+    """Arguments from the JSON manifest printed by --describe-args, None if the script doesn't support it"""
+    try:
+        result = subprocess.run([script, '--describe-args'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            return None
+        return [argument['name'] for argument in json.loads(result.stdout)['arguments']]
+    except Exception as e:
+        logger.debug(f"Notification script {script} has no argument manifest: {e}")
+        return None
+
+def help_script_args(script: str) -> list:
     try:
         result = subprocess.run([script, '--help'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
         lines = result.stdout.splitlines()
@@ -181,6 +287,64 @@ def parse_script_args(script: str) -> list:
         logger.error(f"Error parsing notification script arguments: {e}")
         return []
 
+def path_message(path: dict, max_objects: int) -> str:
+    """Message listing the objects of an impacted path, objects past max_objects are only counted"""
+    lines = [f"Impacted Path: {path['name']}"]
+    hidden = 0
+    for object in path['objects']:
+        if len(object['direction']) != 0:
+            continue
+        if max_objects and len(lines) > max_objects:
+            hidden += 1
+        else:
+            lines.append(f"Object: {object['name']} - {object['type']} - {object['description']}")
+    if hidden:
+        lines.append(f"+{hidden} more objects")
+    return '\n'.join(lines)
+
+def group_contacts(impacted_paths, max_objects: int = 0) -> list:
+    """Merge the impacted paths of each contact into one message, then group the contacts that get the same message
+
+    :return: list : tuples of (comma separated emails, message) in the order the contacts were first seen
+    """
+    # email -> path messages, a contact on several paths gets all of them in one message
+    contact_paths = {}
+    for path in impacted_paths:
+        message = path_message(path, max_objects)
+        for contact in path['contacts']:
+            email = (contact.get('email') or '').strip()
+            if not email:
+                continue
+            # dict as an ordered set of the contact's path messages
+            contact_paths.setdefault(email.lower(), (email, {}))[1][message] = None
+
+    # message -> emails, contacts with the same paths share one notification script run
+    groups = {}
+    for email, paths in contact_paths.values():
+        groups.setdefault('\n'.join(paths), []).append(email)
+    return [(','.join(emails), message) for message, emails in groups.items()]
+
+def notify_contact(arguments: list, email: str, message: str, timeout: int) -> dict:
+    """Run the notification script for one contact or group of contacts
+
+    :return: dict : the contact emails, whether it succeeded, the seconds it took and the error if it failed
+    """
+    command = arguments + ['--email-to', email, '--host-output', message]
+    command_string = '" "'.join(command)
+    logger.debug(f'running notification command: "{command_string}"')
+    start = time.perf_counter()
+    error = ''
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=timeout)
+        logger.debug(f'{email}: {result.returncode}, {result.stdout}, {result.stderr}')
+        if result.returncode != 0:
+            error = f"exited {result.returncode}: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else ''}"
+    except subprocess.TimeoutExpired:
+        error = f"timed out after {timeout}s"
+    except Exception as e:
+        error = str(e)
+    return {'email': email, 'success': not error, 'latency': time.perf_counter() - start, 'error': error}
+
 if __name__ == "__main__":
     config = Settings()
     config.netbox = SettingsNetbox(_config_dict=config._config_dict)
@@ -196,12 +360,12 @@ if __name__ == "__main__":
     log_writeable = initLogger(log_level=log_level, log_file="/var/log/icinga2/notification-netbox-path.log")
 
 
-    logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+    logger.opt(lazy=True).debug("{}", lambda: json.dumps(dataclasses.asdict(config), indent=2))
 
     netbox = Netbox(config)
     impacted_paths = netbox.getImpactAssessment()
 
-    excluded_settings = [ 'config_file', 'object_type', 'notification_script', 'host_output' ]
+    excluded_settings = [ 'config_file', 'object_type', 'notification_script', 'host_output', 'max_concurrency', 'contact_timeout', 'max_objects' ]
 
     arguments = [ config.notification_script ]
     script_arguments = parse_script_args(config.notification_script)
@@ -221,18 +385,25 @@ if __name__ == "__main__":
 
     logger.debug(f"Arguments: {arguments}")
 
-    for path in impacted_paths:
-        message = f"Impacted Path: {path['name']}\n"
-        for object in path['objects']:
-            if len(object['direction']) == 0:
-                message += f"Object: {object['name']} - {object['type']} - {object['description']}"
-        for contact in path['contacts']:            
-            try:
-                command_string = '" "'.join(arguments + ['--email-to', contact['email'], '--host-output',  message])
-                command_string = f'"{command_string}"'
-                logger.debug(f"running notification command: {command_string}")
-                result = subprocess.run(arguments + ['--email-to', contact["email"], '--host-output',  message], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-                logger.debug(f'{result.returncode}, {result.stdout}, {result.stderr}')
-            except Exception as e:
-                logger.error(f"Error running notification script: {e}")
-                sys.exit(1)
+    notifications = group_contacts(impacted_paths, int(config.max_objects))
+    logger.debug(f"Notifying {sum(email.count(',') + 1 for email, _ in notifications)} contacts with {len(notifications)} notification script runs")
+
+    # Notify the contacts in parallel, a failed or slow contact doesn't hold up or stop the others
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(int(config.max_concurrency), 1)) as executor:
+        futures = [executor.submit(notify_contact, arguments, email, message, int(config.contact_timeout)) for email, message in notifications]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if not result['success']:
+                logger.error(f"Error running notification script for {result['email']}: {result['error']}")
+            results.append(result)
+
+    # The summary is printed for Icinga and anyone running the script by hand, and logged
+    failed = [result for result in results if not result['success']]
+    summary = [f"Ran {len(results) - len(failed)} of {len(results)} notifications successfully, {len(failed)} failed"]
+    for result in sorted(results, key=lambda result: result['email']):
+        summary.append(f"  {result['email']}: {'ok' if result['success'] else 'failed'} in {result['latency']:.2f}s{' - ' + result['error'] if result['error'] else ''}")
+    for line in summary:
+        print(line)
+        logger.info(line)
+    sys.exit(1 if failed else 0)
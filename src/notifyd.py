@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+'''Resident notification daemon that keeps the notification script dependencies loaded and runs forwarded notifications
+
+The notification scripts are thin clients when this daemon is running (see lib/Notifyd.py). Each forwarded
+notification is run in a child forked from this warm process with the client's arguments, environment and working
+directory, so results, exit codes and logs are the same as a single-shot run without paying for a fresh interpreter.
+'''
+
+import dataclasses
+import importlib
+import json
+import os
+import runpy
+import socketserver
+import sys
+import tempfile
+import traceback
+
+from lib.Notifyd import CHILD_ENV, DEFAULT_SOCKET_PATH, encodeOutput, recvMessage, sendMessage
+from lib.SettingsParser import SettingsParser
+from lib.Util import initLogger, logger
+
+SCRIPT_DIR = os.path.realpath(os.path.dirname(__file__))
+
+# Only scripts in this list that live next to the daemon can be run through the socket
+SCRIPTS = [
+    'enhanced-mail-notification.py',
+    'netbox-path-impact-notification.py',
+    'pushover-notification.py',
+    'request-tracker-notification.py',
+    'slack-notification.py',
+]
+
+# Imported once by the daemon so every forked child starts with them already loaded
+PRELOAD = [
+    'configparser',
+    'email.mime.image',
+    'email.mime.multipart',
+    'email.mime.text',
+    'jinja2',
+    'loguru',
+    'requests',
+    'rt.rest2',
+    'smtplib',
+    'subprocess',
+    'textwrap',
+    'urllib3',
+]
+
+
+@dataclasses.dataclass
+class Settings(SettingsParser):
+    debug: bool = False
+    disable_log_file: bool = False
+
+    socket_path: str = DEFAULT_SOCKET_PATH
+    # octal file mode for the socket, the icinga2 user needs write access
+    socket_mode: str = '660'
+    max_children: int = 64
+
+    print_config: bool = False
+
+    def __post_init__(self):
+        try:
+            self._exclude_from_args.extend(['config_file'])
+            self._exclude_from_env.extend(['config_file', 'print_config'])
+            self._env_prefix = "NOTIFYD_"
+            self.loadEnvironmentVars()
+            self._args = self._init_args('Resident daemon for Icinga2 notification scripts')
+            self.loadArgs(self._args)
+            self.max_children = int(self.max_children)
+
+        except Exception as e:
+            print(f"Failed to initialize {e}")
+            print(traceback.format_exc())
+            sys.exit()
+
+
+def preload():
+    for module in PRELOAD:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            # Not every install has the requirements for every script
+            logger.debug(f"Unable to preload {module}: {e}")
+
+
+def exitCode(code):
+    """Convert a SystemExit code the same way the interpreter does"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def runScript(script, argv, env, cwd):
+    """Run a notification script in this (forked) process as if it was started from the command line
+
+    Returns:
+        tuple: (exit code, stdout bytes, stderr bytes)
+    """
+    stdout = tempfile.TemporaryFile()
+    stderr = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(stdout.fileno(), 1)
+    os.dup2(stderr.fileno(), 2)
+
+    os.environ.clear()
+    os.environ.update(env)
+    os.environ[CHILD_ENV] = '1'
+    try:
+        os.chdir(cwd)
+    except OSError:
+        os.chdir(SCRIPT_DIR)
+    sys.argv = [script] + argv
+
+    # Start from loguru's default state like a fresh interpreter would
+    logger.remove()
+    logger.add(sys.stderr)
+
+    code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        code = exitCode(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    logger.remove()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout.seek(0)
+    stderr.seek(0)
+    return (code, stdout.read(), stderr.read())
+
+
+class NotificationHandler(socketserver.BaseRequestHandler):
+    # Runs in the child forked by the server for each connection
+    def handle(self):
+        try:
+            request = recvMessage(self.request)
+        except (OSError, ValueError) as e:
+            logger.error(f"Unable to read notification request: {e}")
+            return
+
+        name = request.get('script', '')
+        script = os.path.join(SCRIPT_DIR, name)
+        if name not in SCRIPTS or not os.path.exists(script):
+            logger.error(f"Refusing to run unknown notification script {name}")
+            sendMessage(self.request, {'exit_code': 3, 'stdout': '', 'stderr': encodeOutput(f"notifyd: unknown notification script {name}\n".encode())})
+            return
+
+        logger.info(f"Running {name} for pid {request.get('pid', 'unknown')} with {len(request.get('argv', []))} arguments")
+        if not request.get('wait', True):
+            sendMessage(self.request, {'exit_code': 0, 'stdout': '', 'stderr': ''})
+            self.request.close()
+
+        # runScript points fd 2 at the run's output, keep the daemon's stderr for reporting
+        daemon_stderr = os.dup(2)
+        code, stdout, stderr = runScript(script, request.get('argv', []), request.get('env', {}), request.get('cwd', SCRIPT_DIR))
+
+        if request.get('wait', True):
+            try:
+                sendMessage(self.request, {'exit_code': code, 'stdout': encodeOutput(stdout), 'stderr': encodeOutput(stderr)})
+            except OSError as e:
+                # The logger was reset by runScript
+                os.write(daemon_stderr, f"notifyd: unable to return the result of {name}: {e}\n".encode('utf-8', 'replace'))
+        os.close(daemon_stderr)
+
+
+class NotificationServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+if __name__ == "__main__":
+    config = Settings()
+
+    if config.print_config:
+        logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+        config.printArguments()
+        config.printEnvironmentVars()
+        sys.exit(0)
+
+    # Init logging
+    log_level = 'DEBUG' if config.debug else 'INFO'
+    log_writeable = initLogger(log_disable_file=config.disable_log_file, log_level=log_level, log_file="/var/log/icinga2/notifyd.log")
+
+    preload()
+
+    if os.path.exists(config.socket_path):
+        os.unlink(config.socket_path)
+    os.makedirs(os.path.dirname(config.socket_path), exist_ok=True)
+
+    NotificationServer.max_children = config.max_children
+    with NotificationServer(config.socket_path, NotificationHandler) as server:
+        os.chmod(config.socket_path, int(config.socket_mode, 8))
+        logger.info(f"notifyd listening on {config.socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(config.socket_path)
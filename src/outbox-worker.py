@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+'''Drains the notification outbox, retrying failed Slack, Pushover and email notifications with backoff'''
+
+import concurrent.futures
+import dataclasses
+import json
+import sys
+import time
+import traceback
+
+from lib.Outbox import Outbox, SENDERS
+from lib.SettingsParser import SettingsParser
+from lib.Util import initLogger, logger
+
+
+@dataclasses.dataclass
+class Settings(SettingsParser):
+    debug: bool = False
+    disable_log_file: bool = False
+
+    outbox_file: str = '/var/lib/icinga2/notification-outbox.db'
+    max_attempts: int = 10
+    backoff_base: int = 30
+    backoff_max: int = 3600
+    poll_interval: int = 5
+
+    # Maximum concurrent sends for each backend
+    mail_concurrency: int = 2
+    pushover_concurrency: int = 4
+    slack_concurrency: int = 1
+
+    # Drain what is due then exit, for running from cron instead of as a service
+    once: bool = False
+
+    print_config: bool = False
+
+    def __post_init__(self):
+        try:
+            self._exclude_from_args.extend(['config_file'])
+            self._exclude_from_env.extend(['config_file', 'print_config'])
+            self._env_prefix = "NOTIFY_OUTBOX_"
+            self.loadEnvironmentVars()
+            self._args = self._init_args('Deliver and retry notifications queued in the notification outbox')
+            self.loadArgs(self._args)
+
+        except Exception as e:
+            print(f"Failed to initialize {e}")
+            print(traceback.format_exc())
+            sys.exit()
+
+    def concurrency(self, backend):
+        return max(int(getattr(self, f'{backend}_concurrency', 1)), 1)
+
+
+def drain(outbox, executors, once=False):
+    """Claim and send the due entries of every backend, each backend's executor is refilled as soon as one of its sends
+    finishes so a slow backend doesn't hold up the others
+
+    Args:
+        once (bool, optional): return when nothing is due or being sent. Defaults to False.
+
+    Returns:
+        int: number of entries processed
+    """
+    futures = {}
+    inflight = dict.fromkeys(executors, 0)
+    processed = 0
+    while True:
+        for backend, executor in executors.items():
+            free = config.concurrency(backend) - inflight[backend]
+            if free <= 0:
+                continue
+            for outbox_id, backend, destination, payload, attempts in outbox.claim(backend=backend, limit=free):
+                logger.debug(f"Sending outbox entry {outbox_id} ({backend} to {destination}), attempt {attempts + 1}")
+                futures[executor.submit(Outbox.send, backend, payload)] = (outbox_id, backend, destination)
+                inflight[backend] += 1
+
+        if not futures:
+            if once:
+                return processed
+            time.sleep(int(config.poll_interval))
+            continue
+
+        # Wake up for entries of idle backends that became due while the others are sending
+        done, _ = concurrent.futures.wait(futures, timeout=int(config.poll_interval), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            outbox_id, backend, destination = futures.pop(future)
+            inflight[backend] -= 1
+            processed += 1
+            success, error = outbox.record(outbox_id, future.result())
+            if success:
+                logger.success(f"Delivered outbox entry {outbox_id} ({backend} to {destination})")
+            else:
+                logger.warning(f"Failed to deliver outbox entry {outbox_id} ({backend} to {destination}): {error}")
+
+
+if __name__ == "__main__":
+    config = Settings()
+
+    if config.print_config:
+        logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+        config.printArguments()
+        config.printEnvironmentVars()
+        sys.exit(0)
+
+    # Init logging
+    log_level = 'DEBUG' if config.debug else 'INFO'
+    log_writeable = initLogger(log_disable_file=config.disable_log_file, log_level=log_level, log_file="/var/log/icinga2/notification-outbox.log")
+
+    outbox = Outbox(config.outbox_file, max_attempts=config.max_attempts, backoff_base=config.backoff_base, backoff_max=config.backoff_max)
+    executors = {backend: concurrent.futures.ThreadPoolExecutor(max_workers=config.concurrency(backend)) for backend in SENDERS}
+
+    try:
+        drain(outbox, executors, once=config.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+        for (backend, state), count in outbox.stats().items():
+            logger.info(f"Outbox {backend} {state}: {count}")
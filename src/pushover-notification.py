@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import dataclasses
 import json
-import requests
 import sys
+import threading
+import time
 import traceback
 import textwrap
 
-from lib.SettingsParser import SettingsParser
-from lib.Util import initLogger
+from lib.Notifyd import forwardToDaemon
+# Hand the notification to notifyd when it is running, before loading any of the heavy dependencies
+forwardToDaemon(__file__)
 
-from loguru import logger
+from lib.Outbox import Outbox, OutboxRetry, checkResponse
+from lib.SettingsParser import SettingsParser
+from lib.Util import initLogger, logger
 
 
 @dataclasses.dataclass
@@ -37,8 +42,21 @@ class Settings(SettingsParser):
     notification_date_time: str = ''
 
     pushover_token: str = ''
+    # Comma separated user or group keys, a key can be followed by :device to send to some of its devices, eg. ukey1,ukey2:phone+tablet,gkey1
     pushover_user: str = ''
     pushover_sound: str = ''
+    # Recipients sent to at once over the shared connection pool
+    pushover_concurrency: int = 4
+    pushover_timeout: int = 10
+    # Retries for connection errors, anything after the request was sent is retried by the outbox
+    pushover_retries: int = 2
+    # Warn when the application has fewer messages left this month
+    pushover_limit_warning: int = 500
+
+    # Leave empty to send directly without the outbox
+    outbox_file: str = ''
+    # Only commit to the outbox and leave sending to outbox-worker.py
+    outbox_defer: bool = False
 
     print_config: bool = False
 
@@ -57,11 +75,37 @@ class Settings(SettingsParser):
             sys.exit()
 
 
-def send_notification(token, user, message, sound = ''):
-    url = "https://api.pushover.net/1/messages.json"
-    headers = {
-        "Content-type": "application/x-www-form-urlencoded",
-    }
+# Pushover messages left for the application this month, from the X-Limit-App-Remaining header of the last response
+app_remaining = None
+app_remaining_lock = threading.Lock()
+
+
+def get_session(pool_size, retries):
+    '''Keep-alive session shared by the recipients, only retries connection errors where the message wasn't sent, the
+    outbox retries the rest so a message Pushover accepted isn't posted twice'''
+    import requests
+    import urllib3
+    session = requests.session()
+    retry = urllib3.util.Retry(total=retries, connect=retries, read=0, status=0, other=0, backoff_factor=0.5, allowed_methods=None, raise_on_status=False)
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=retry))
+    return session
+
+
+def parse_recipients(users):
+    '''Split the pushover_user setting into (key, devices) tuples, duplicates are removed
+
+    Returns:
+        list: list of tuples (user or group key, comma separated devices or '')
+    '''
+    recipients = []
+    for recipient in users.split(','):
+        key, _, devices = recipient.strip().partition(':')
+        if key and (key, devices.replace('+', ',')) not in recipients:
+            recipients.append((key, devices.replace('+', ',')))
+    return recipients
+
+
+def notification_payload(token, user, message, sound = '', device = ''):
     payload = {
         "token": token,
         "user": user,
@@ -70,13 +114,77 @@ def send_notification(token, user, message, sound = ''):
     # Add sound if specified
     if sound:
         payload["sound"] = sound
+    if device:
+        payload["device"] = device
+
+    return {
+        "url": "https://api.pushover.net/1/messages.json",
+        "headers": {
+            "Content-type": "application/x-www-form-urlencoded",
+        },
+        "data": payload,
+    }
+
+
+def send_notification(session, request, timeout):
+    '''Send one recipient's notification, skipped once the application has no messages left
 
-    logger.debug(f"Sending to {user} message: [{message}] with sound: {sound}")
-    response = requests.post(url, data=payload, headers=headers)
+    Returns:
+        Exception: the failure or None if the notification was sent
+    '''
+    global app_remaining
+    if app_remaining is not None and app_remaining <= 0:
+        return OutboxRetry("Pushover application message limit reached", delay=3600, attempt=False)
 
-    if response.status_code != 200:
-        logger.error(f"Failed to send notification for token: {token}, user: {user}, response ({response.status_code}): {response.text}")
-        raise Exception(f"Failed to send notification: {response.text}")
+    logger.debug(f"Sending to {request['data']['user']} devices: {request['data'].get('device', 'all')}")
+    try:
+        response = session.post(request["url"], data=request["data"], headers=request["headers"], timeout=timeout)
+    except Exception as e:
+        return e
+    remaining = response.headers.get('X-Limit-App-Remaining')
+    with app_remaining_lock:
+        if response.status_code == 429:
+            app_remaining = 0
+        elif remaining and remaining.isdigit():
+            app_remaining = int(remaining) if app_remaining is None else min(app_remaining, int(remaining))
+    try:
+        checkResponse(response, [200])
+    except Exception as e:
+        return e
+    return None
+
+
+def send_notifications(recipients, message, outbox=None):
+    '''Send to every recipient at once over one pooled session
+    With the outbox each notification is committed first and failures are left in it for outbox-worker.py
+
+    Returns:
+        list: list of dicts with the recipient, whether it was sent, the seconds it took and the error if it failed
+    '''
+    requests_by_recipient = {recipient: notification_payload(config.pushover_token, recipient[0], message, config.pushover_sound, recipient[1]) for recipient in recipients}
+    outbox_ids = {}
+    if outbox is not None:
+        for recipient, request in requests_by_recipient.items():
+            outbox_ids[recipient] = outbox.put('pushover', request, destination=':'.join(filter(None, recipient)), claim=not config.outbox_defer)
+        if config.outbox_defer:
+            return [{'recipient': recipient, 'success': False, 'latency': 0, 'error': 'deferred to the outbox worker'} for recipient in recipients]
+
+    concurrency = max(min(int(config.pushover_concurrency), len(recipients)), 1)
+    session = get_session(concurrency, int(config.pushover_retries))
+
+    def send(recipient):
+        start = time.perf_counter()
+        error = send_notification(session, requests_by_recipient[recipient], float(config.pushover_timeout))
+        return recipient, error, time.perf_counter() - start
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for recipient, error, latency in executor.map(send, recipients):
+            # The outbox database is only used from this thread
+            if outbox is not None:
+                outbox.record(outbox_ids[recipient], error)
+            results.append({'recipient': ':'.join(filter(None, recipient)), 'success': error is None, 'latency': latency, 'error': str(error) if error else ''})
+    return results
 
 
 if __name__ == "__main__":
@@ -92,7 +200,7 @@ if __name__ == "__main__":
     log_level = 'DEBUG' if config.debug else 'INFO'
     log_writeable = initLogger(log_level=log_level, log_file="/var/log/icinga2/notification-pushover.log")
 
-    logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+    logger.opt(lazy=True).debug("{}", lambda: json.dumps(dataclasses.asdict(config), indent=2))
 
     try:
         # Create the message
@@ -123,7 +231,21 @@ if __name__ == "__main__":
 
     try:
         # Send the notification
-        send_notification(config.pushover_token, config.pushover_user, message, config.pushover_sound)
+        recipients = parse_recipients(config.pushover_user)
+        outbox = Outbox(config.outbox_file) if config.outbox_file else None
+        results = send_notifications(recipients, message, outbox)
+
+        failed = [result for result in results if not result['success']]
+        for result in results:
+            if result['success']:
+                logger.info(f"  {result['recipient']}: sent in {result['latency']:.2f}s")
+            elif outbox is not None:
+                logger.warning(f"  {result['recipient']}: left in the outbox {config.outbox_file} for retry after {result['latency']:.2f}s: {result['error']}")
+            else:
+                logger.error(f"  {result['recipient']}: failed in {result['latency']:.2f}s: {result['error']}")
+        logger.info(f"Sent to {len(results) - len(failed)} of {len(results)} Pushover recipients")
+        if app_remaining is not None and app_remaining < int(config.pushover_limit_warning):
+            logger.warning(f"Pushover application has {app_remaining} messages left this month")
 
     except Exception as e:
         logger.error(f"Pushover send error: {e}")
@@ -1,32 +1,51 @@
 #!/usr/bin/env python3
 '''Icinga2 plugin to create and track RT tickets when services and hosts go critical'''
 
+import concurrent.futures
 import dataclasses
+import functools
+import hashlib
 import json
 import os
 import re
-import requests
 import sys
 import socket
+import threading
 import traceback
 
-from rt.rest2 import Rt
 from datetime import datetime
 
-from lib.SettingsParser import SettingsParser
-from lib.Util import initLogger
+from lib.FileLock import FileLock
+from lib.Notifyd import forwardToDaemon
+from lib.SettingsParser import SettingsParser, readCache, writeCache
+from lib.TicketIndex import TicketIndex, OPEN, ACKNOWLEDGED, RECOVERED
+from lib.Util import initLogger, logger
 
-from loguru import logger
-
-
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-# Disabled proxies for requests to localhost
-os.environ['NO_PROXY'] = 'localhost'
+# requests and rt are only imported when a client is first used so importing this script and early exits stay cheap
 
 RT_REGEX = re.compile(r'(# Ticket )(\w+)( created)')
 TICKETID_REGEX = re.compile(r'(#)([0-9]+)(\])')
-SESSION = requests.session()
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+# The icinga and RT calls run in threads, the clients are only created once
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''Shared icinga session, created on first use'''
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            import urllib3
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            session = requests.session()
+            # Keep-alive connections for the icinga calls that run at the same time
+            session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=4))
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=4))
+            _session = session
+    return _session
 
 @dataclasses.dataclass
 class SettingsFile(SettingsParser):
@@ -80,6 +99,13 @@ class Settings(SettingsParser):
     rt_requestor: str = ''
     rt_queue: str = ''
 
+    # Local index of the ticket for each host and service, leave empty to find tickets from the Icinga comments
+    ticket_index_file: str = ''
+    # Directory for the per host/service lock files that stop concurrent notifications creating duplicate tickets, leave empty to disable
+    lock_dir: str = '/run/icinga2/rt-locks'
+    # Seconds to wait for another notification for the same host/service before carrying on without the lock
+    lock_timeout: int = 30
+
     print_config: bool = False
 
     def __post_init__(self):
@@ -92,7 +118,7 @@ class Settings(SettingsParser):
             self.loadArgs(self._args)
 
             # These set in the config file will override the args
-            self._include_from_file = ['debug', 'disable_log_file']
+            self._include_from_file = ['debug', 'disable_log_file', 'ticket_index_file', 'lock_dir', 'lock_timeout']
 
             self.loadConfigJsonFile()
 
@@ -119,7 +145,7 @@ class Icinga:
             'Content-Type': 'application/json; charset=utf-8'
         }
         try:
-            result = SESSION.get(
+            result = get_session().get(
                 self.base_url + url_path,
                 auth=(self.username, self.password),
                 verify=False,
@@ -139,22 +165,14 @@ class Icinga:
         }
 
         try:
-            if payload:
-                result = SESSION.post(
-                    self.base_url + url_path,
-                    auth=(self.username, self.password),
-                    verify=False,
-                    headers=headers,
-                    json=payload,
-                    timeout=15
-                    )
-            else:
-                result = SESSION.post(
-                            self.base_url + url_path,
-                            auth=(self.username, self.password),
-                            verify=False,
-                            headers=headers
-                            )
+            result = get_session().post(
+                self.base_url + url_path,
+                auth=(self.username, self.password),
+                verify=False,
+                headers=headers,
+                json=payload,
+                timeout=15
+                )
             return result
         except Exception as e:
             logger.error(f"Icinga POST Request to {self.base_url + url_path} with payload {payload} failed with error {e}")
@@ -174,6 +192,36 @@ class Icinga:
         return result
 
 
+    def get_author_comments_icinga(self):
+        '''Get every icinga comment added by this user in one request'''
+        body = {
+            'filter': 'comment.author=="{}"'.format(self.username),
+            'attrs': ['__name', 'author', 'host_name', 'service_name', 'text']
+        }
+
+        res = self._get("/v1/objects/comments", body)
+
+        result = json.loads(res.text)['results']
+        return result
+
+
+    def get_problems_icinga(self):
+        '''Get every host that isn't UP and every service that isn't OK, one request for hosts and one for services
+
+        Returns:
+            dict: (hostname, servicename) -> acknowledged, the servicename is empty for hosts
+        '''
+        problems = {}
+        res = self._get("/v1/objects/hosts", {'filter': 'host.state!=0', 'attrs': ['name', 'acknowledgement']})
+        for host in json.loads(res.text)['results']:
+            problems[(host['attrs']['name'], '')] = bool(host['attrs']['acknowledgement'])
+
+        res = self._get("/v1/objects/services", {'filter': 'service.state!=0', 'attrs': ['host_name', 'name', 'acknowledgement']})
+        for service in json.loads(res.text)['results']:
+            problems[(service['attrs']['host_name'], service['attrs']['name'])] = bool(service['attrs']['acknowledgement'])
+        return problems
+
+
     def add_comment_icinga(self, hostname, servicename, comment_text):
         '''Create comment on an icinga service or host'''
         logger.debug(f'Adding Icinga comment for host {hostname}, service {servicename} with text {comment_text}')
@@ -195,30 +243,69 @@ class Icinga:
         return res
 
 
-    def delete_comments_icinga(self, comments):
-        '''Delete icinga comments associated with the current user and service/host'''
-        for comment in comments:
-            if comment['attrs']['author'] == self.username:
-                url = f"/v1/actions/remove-comment?comment={comment['attrs']['__name']}"
-                res = self._post(url)
-                logger.debug(json.dumps(res.text))
-        return
+    def delete_comments_icinga(self, hostname, servicename):
+        '''Delete icinga comments associated with the current user and service/host in one request'''
+        filters = 'host.name=="{}"'.format(hostname)
+        filters += '&&service.name=="{}"'.format(servicename)
+        filters += '&&comment.author=="{}"'.format(self.username)
+
+        body = {
+            'type': 'Comment',
+            'filter': filters
+        }
+
+        res = self._post("/v1/actions/remove-comment", body)
+        if res is not None:
+            logger.debug(json.dumps(res.text))
+        return res
+
+
+    def delete_comments_by_name_icinga(self, names):
+        '''Delete icinga comments by their full names in one request'''
+        body = {
+            'type': 'Comment',
+            'filter': 'comment.__name in names',
+            'filter_vars': {'names': list(names)}
+        }
+
+        res = self._post("/v1/actions/remove-comment", body)
+        if res is not None:
+            logger.debug(json.dumps(res.text))
+        return res
 
 
 class RequestTracker:
-    def __init__(self) -> None:
-        self.rt = None
+    def __init__(self, config) -> None:
+        self.config = config
+        self._rt = None
+        self._rt_lock = threading.Lock()
         self.ticket_id = None
-        self._initRT()
+        self.message = None
+
+    @property
+    def rt(self):
+        '''RT client, created on first use'''
+        with self._rt_lock:
+            if self._rt is None:
+                self._initRT()
+        return self._rt
 
     def _initRT(self):
+        import requests
+        from rt.rest2 import Rt
+        config = self.config
         if config.rt.proxy:
-            self.rt = Rt(url=f"{config.rt.url}/REST/2.0/", http_auth=requests.auth.HTTPBasicAuth(config.rt.username, config.rt.password), proxy=config.rt.proxy)
+            self._rt = Rt(url=f"{config.rt.url}/REST/2.0/", http_auth=requests.auth.HTTPBasicAuth(config.rt.username, config.rt.password), proxy=config.rt.proxy)
         else:
-            self.rt = Rt(url=f"{config.rt.url}/REST/2.0/", http_auth=requests.auth.HTTPBasicAuth(config.rt.username, config.rt.password))
-        logger.debug(f"Initalized rt {self.rt}")
+            self._rt = Rt(url=f"{config.rt.url}/REST/2.0/", http_auth=requests.auth.HTTPBasicAuth(config.rt.username, config.rt.password))
+        logger.debug(f"Initalized rt {self._rt}")
 
     def ticketMessage(self):
+        '''Message for the ticket and its comments, only rendered once'''
+        if self.message is not None:
+            return self.message
+        config = self.config
+        nodename, host_ip = get_host_identity()
         additional_output = self.parseMultiLineField(f"{config.service_output}{config.host_output}")
         state = f"{config.service_state}{config.host_state}"
 
@@ -230,9 +317,10 @@ class RequestTracker:
         message += f" State: {state}\n \n"
         message += f" Additional Info: {additional_output}\n \n"
         message += f" Comment: [{config.notification_author}] {config.notification_comment}\n \n"
-        message += f" Generated: by {os.uname().nodename} ({get_host_ip()}) @ {datetime.now().isoformat()}\n"
+        message += f" Generated: by {nodename} ({host_ip}) @ {datetime.now().isoformat()}\n"
 
         logger.debug(f"Ticket message\n{message}")
+        self.message = message
         return message
 
     def parseMultiLineField(self, field_data):
@@ -254,10 +342,10 @@ class RequestTracker:
         result = None
         try:
             result = self.rt.create_ticket(
-                queue=config.rt_queue, 
+                queue=self.config.rt_queue, 
                 subject=subject, 
                 content=self.ticketMessage(),
-                requestor=[config.rt_requestor]
+                requestor=[self.config.rt_requestor]
                 )
             self.setTicket(result)
         except Exception as e:
@@ -272,7 +360,7 @@ class RequestTracker:
             text = f"{text}\n{self.parseMultiLineField(message)}"
         if self.ticket_id is not None:
             try:
-                self.rt.comment(ticket_id=self.ticket_id, content=self.ticketMessage())
+                self.rt.comment(ticket_id=self.ticket_id, content=text)
             except Exception as e:
                 logger.error(f"Error adding comment to existing ticket {self.ticket_id}: {e}")
         else:
@@ -294,76 +382,203 @@ class RequestTracker:
         else:
             logger.warning("Can't edit on ticket without valid ticket number")
 
-def get_host_ip():
+    def searchTickets(self, query, fields=('Status', 'Queue'), page_size=100):
+        '''Generator yielding the tickets matching a TicketSQL query, one request per page of results'''
+        page = 1
+        while True:
+            response = self.rt.session.get(f"{self.rt.url}tickets", params={'query': query, 'fields': ','.join(fields), 'page': page, 'per_page': page_size})
+            response.raise_for_status()
+            result = response.json()
+            yield from result.get('items', [])
+            # Newer RT versions leave out pages for non-superusers, a short page is the last one
+            pages = result.get('pages')
+            if (pages is not None and page >= pages) or (pages is None and result.get('count', 0) < page_size):
+                break
+            page += 1
+
+def find_ticket(config, icinga, ticket_index):
+    '''Find the ticket for the host/service in the index, falling back to the icinga comment and rebuilding the index entry
+
+    Returns:
+        tuple: (ticket_id, state) ticket_id is None if there is no ticket
+    '''
+    if ticket_index is not None:
+        try:
+            entry = ticket_index.get(config.host_name, config.service_name)
+            if entry is not None:
+                logger.debug(f"Ticket index entry: {entry}")
+                return entry
+        except Exception as e:
+            logger.error(f"Error reading the ticket index {config.ticket_index_file} with error {e}")
+
+    comments = icinga.get_comments_icinga(config.host_name, config.service_name)
+    logger.debug(f"Comments: {comments}")
+    ticket_id = None
+    if comments:
+        # extract id from comment
+        match = TICKETID_REGEX.search(comments[0]['attrs']['text'])
+        if match:
+            ticket_id = match.group(2)
+            update_ticket_index(config, ticket_index, ticket_id, OPEN)
+    return (ticket_id, OPEN)
+
+
+def update_ticket_index(config, ticket_index, ticket_id, state):
+    '''Record the ticket state for the host/service, the icinga comment is used to rebuild it if this fails'''
+    if ticket_index is None or ticket_id is None:
+        return
     try:
-        # Connect to an external address (doesn't need to succeed)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
-    except Exception:
-        return "failed to get ip"  # fallback
-
+        ticket_index.put(config.host_name, config.service_name, ticket_id, state)
+    except Exception as e:
+        logger.error(f"Error updating the ticket index {config.ticket_index_file} with error {e}")
 
 
+def ticket_lock_path(lock_dir, host_name, service_name):
+    name = hashlib.sha256(f"{host_name}\0{service_name}".encode('utf-8')).hexdigest()
+    return os.path.join(lock_dir, f"{name}.lock")
 
-config = Settings()
-config.rt = SettingsRT(_config_dict=config._config_dict)
-config.icinga = SettingsIcinga(_config_dict=config._config_dict)
 
-# I should comment this better
-if not config.rt_queue:
-    config.rt_queue = config.rt.queue
+def lock_ticket(config):
+    '''Lock the host/service so only one notification at a time looks up and creates its ticket
+    the kernel releases the lock if the process dies
 
-rt = RequestTracker()
-
-# Init Icinga
-icinga = Icinga(base_url=config.icinga.url, username=config.icinga.username, password=config.icinga.password)
-
-# Init logging
-log_level = 'DEBUG' if config.debug else 'INFO'
-log_writeable = initLogger(log_level=log_level, log_file="/var/log/icinga2/notification-request-tracker.log")
+    Returns:
+        FileLock: the held lock or None if locking is disabled or timed out
+    '''
+    if not config.lock_dir:
+        return None
+    try:
+        os.makedirs(config.lock_dir, mode=0o700, exist_ok=True)
+        lock = FileLock(ticket_lock_path(config.lock_dir, config.host_name, config.service_name))
+        if lock.acquire(timeout=float(config.lock_timeout)):
+            return lock
+        logger.warning(f"Timed out after {config.lock_timeout}s waiting for the ticket lock for host {config.host_name}, service {config.service_name}")
+    except Exception as e:
+        logger.error(f"Error locking the ticket for host {config.host_name}, service {config.service_name} in {config.lock_dir} with error {e}")
+    return None
 
-if config.print_config:
-    logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
-    config.printArguments()
-    config.printEnvironmentVars()
-    sys.exit(0)
 
-logger.info(dataclasses.asdict(config))
+def get_host_ip():
+    try:
+        # Connect to an external address (doesn't need to succeed)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except Exception:
+        return "failed to get ip"  # fallback
 
-comments = icinga.get_comments_icinga(config.host_name, config.service_name)
 
-logger.debug(f"Comments: {comments}")
+@functools.lru_cache(maxsize=None)
+def get_host_identity():
+    '''Nodename and ip of this host, resolved once per boot and cached in the private cache directory
 
-if comments:
-    # extract id from comment
-    rt.setTicket(TICKETID_REGEX.search(comments[0]['attrs']['text']).group(2))
+    Returns:
+        tuple: (nodename, ip)
+    '''
+    try:
+        with open(BOOT_ID_FILE) as file:
+            boot_id = file.read().strip()
+    except OSError:
+        boot_id = ''
+
+    if boot_id:
+        identity = readCache('rt-host-identity.marshal', (boot_id,))
+        if identity is not None:
+            return tuple(identity)
+
+    nodename, host_ip = os.uname().nodename, get_host_ip()
+    if boot_id:
+        writeCache('rt-host-identity.marshal', (boot_id,), (nodename, host_ip))
+    return (nodename, host_ip)
+
+def main():
+    # Hand the notification to notifyd when it is running, before loading any of the heavy dependencies
+    forwardToDaemon(__file__)
+
+    # Disabled proxies for requests to localhost
+    os.environ['NO_PROXY'] = 'localhost'
+
+    config = Settings()
+    config.rt = SettingsRT(_config_dict=config._config_dict)
+    config.icinga = SettingsIcinga(_config_dict=config._config_dict)
+
+    # Tickets go to the queue from the args or env, otherwise the queue in the config file
+    if not config.rt_queue:
+        config.rt_queue = config.rt.queue
+
+    # Init logging
+    log_level = 'DEBUG' if config.debug else 'INFO'
+    initLogger(log_level=log_level, log_file="/var/log/icinga2/notification-request-tracker.log")
+
+    if config.print_config:
+        logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+        config.printArguments()
+        config.printEnvironmentVars()
+        sys.exit(0)
+
+    logger.info(dataclasses.asdict(config))
+
+    acknowledged = config.notification_type == "ACKNOWLEDGEMENT"
+    down = config.service_state == "CRITICAL" or config.host_state == "DOWN"
+    up = config.service_state == "OK" or config.host_state == "UP"
+    if not (acknowledged or down or up):
+        logger.info(f"Doing nothing becuase the service state ({config.service_state}) isn't CRITICAL or DOWN and the host state ({config.host_state}) isn't OK or UP")
+        return
 
-if config.notification_type != "ACKNOWLEDGEMENT":
-    if config.service_state == "CRITICAL" or config.host_state == "DOWN":
-        logger.info(f"Host: {config.host_name}, Service: {config.service_name} went down")
-        # No existing comments
-        if rt.ticket_id is None:
-            logger.info("Creating new RT ticket and comment ID")
+    # The clients only connect when they are first used
+    rt = RequestTracker(config)
+    icinga = Icinga(base_url=config.icinga.url, username=config.icinga.username, password=config.icinga.password)
+    ticket_index = TicketIndex(config.ticket_index_file) if config.ticket_index_file else None
 
-            rt.createTicket(f"{config.host_displayname} {config.service_displayname} went {config.host_state}{config.service_state}")
-            if rt.ticket_id is not None:
-                icinga.add_comment_icinga(
-                    config.host_name,
-                    config.service_name,
-                    f'[{config.rt.name} #{str(rt.ticket_id)}] - ticket created in RT')
-            else:
-                logger.warning(f"Didn't get valid Ticket for {config.host_displayname} {config.service_displayname} went {config.host_state}{config.service_state}, icinga comment skipped")
+    # Held until the ticket and its icinga comment exist so concurrent notifications reuse the ticket
+    ticket_lock = lock_ticket(config)
+    created = False
+    try:
+        ticket_id, ticket_state = find_ticket(config, icinga, ticket_index)
+        # A recovered ticket is only kept in the index so the next notification doesn't have to ask icinga
+        if ticket_id is not None and ticket_state != RECOVERED:
+            rt.setTicket(ticket_id)
+
+        if acknowledged:
+            logger.info(f"Author {config.notification_author} acknowledged the problem")
+            update_ticket_index(config, ticket_index, rt.ticket_id, ACKNOWLEDGED)
+        elif down:
+            logger.info(f"Host: {config.host_name}, Service: {config.service_name} went down")
+            # No existing comments
+            if rt.ticket_id is None:
+                logger.info("Creating new RT ticket and comment ID")
+
+                rt.createTicket(f"{config.host_displayname} {config.service_displayname} went {config.host_state}{config.service_state}")
+                created = True
+                if rt.ticket_id is not None:
+                    update_ticket_index(config, ticket_index, rt.ticket_id, OPEN)
+                    icinga.add_comment_icinga(
+                        config.host_name,
+                        config.service_name,
+                        f'[{config.rt.name} #{str(rt.ticket_id)}] - ticket created in RT')
+                else:
+                    logger.warning(f"Didn't get valid Ticket for {config.host_displayname} {config.service_displayname} went {config.host_state}{config.service_state}, icinga comment skipped")
         else:
+            logger.info(f"Host: {config.host_name}, Service: {config.service_name} back up")
+            icinga.delete_comments_icinga(config.host_name, config.service_name)
+            update_ticket_index(config, ticket_index, rt.ticket_id, RECOVERED)
+    finally:
+        if ticket_lock is not None:
+            ticket_lock.release()
+
+    # Updating the ticket in RT doesn't change which ticket the host/service has, other notifications don't wait for it
+    if acknowledged:
+        rt.commentTicket(f"Author {config.notification_author} acknowledged the problem")
+    elif down:
+        if not created:
             logger.info("Get comment and comment on RT")
             rt.commentTicket()
-    elif config.service_state == "OK" or config.host_state == "UP":
-        logger.info(f"Host: {config.host_name}, Service: {config.service_name} back up")
-        rt.commentTicket()
-        rt.editTicketSubject(f"RECOVERED - {config.host_displayname} {config.service_displayname} went {config.host_state}{config.service_state}")
-        icinga.delete_comments_icinga(comments)
     else:
-        logger.info(f"Doing nothing becuase the service state ({config.service_state}) isn't CRITICAL or DOWN and the host state ({config.host_state}) isn't OK or UP")
-else:
-    logger.info(f"Author {config.notification_author} acknowledged the problem")
-    rt.commentTicket(f"Author {config.notification_author} acknowledged the problem")
+        # The ticket comment and subject change don't depend on each other
+        rt.ticketMessage()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(rt.commentTicket)
+            executor.submit(rt.editTicketSubject, f"RECOVERED - {config.host_displayname} {config.service_displayname} went {config.host_state}{config.service_state}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+'''Reconciles the RT tickets tracked by request-tracker-notification.py with RT and Icinga in bulk
+
+Run it from cron or a systemd timer. Each run makes one paged RT search per queue for the active tickets, one Icinga
+query for the comments added by the notifier and one query each for the hosts and services with problems, then:
+- removes the Icinga comments and index entries for tickets that were closed in RT, eg. by a human, so the next
+  problem notification creates a new ticket instead of commenting on a dead one
+- rebuilds the ticket index from the Icinga comments
+- adds the Icinga comment back for open tickets in the index that lost their comment
+- reports open tickets for hosts and services that are no longer a problem
+
+The RT and Icinga clients are reused from request-tracker-notification.py with the same config file.
+'''
+
+import contextlib
+import dataclasses
+import importlib.util
+import json
+import os
+import sys
+import traceback
+
+from lib.FileLock import FileLock
+from lib.SettingsParser import SettingsParser
+from lib.TicketIndex import TicketIndex, OPEN, ACKNOWLEDGED, RECOVERED
+from lib.Util import initLogger, logger
+
+# Load the notifier as a module, its name isn't a valid module name
+spec = importlib.util.spec_from_file_location('request_tracker_notification', f'{os.path.realpath(os.path.dirname(__file__))}/request-tracker-notification.py')
+notification = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(notification)
+
+# Number of ticket ids or comment names sent in one request
+BATCH_SIZE = 100
+
+@dataclasses.dataclass
+class Settings(SettingsParser):
+    rt: object = None
+    icinga: object = None
+    _exclude_all: list = dataclasses.field(default_factory=lambda: ['rt', 'icinga'])
+
+    config_file: str = f'{os.path.realpath(os.path.dirname(__file__))}/config/request-tracker-notification.json'
+    debug: bool = False
+    disable_log_file: bool = False
+
+    # Comma separated queues the notifier creates tickets in, defaults to the queue in the config file
+    queues: str = ''
+    ticket_index_file: str = ''
+    # Lock directory of the notifier, objects a notification is working on are left for the next run
+    lock_dir: str = '/run/icinga2/rt-locks'
+    page_size: int = 100
+    # Only report what would be repaired
+    dry_run: bool = False
+
+    print_config: bool = False
+
+    def __post_init__(self):
+        try:
+            self._exclude_from_args.extend(self._exclude_all)
+            self._exclude_from_env.extend(self._exclude_all + ['print_config'])
+            self._env_prefix = "NOTIFY_RT_RECONCILE_"
+            self.loadEnvironmentVars()
+            self._args = self._init_args('Reconcile the RT tickets tracked by the RT notifier with RT and Icinga')
+            self.loadArgs(self._args)
+
+            # These set in the config file will override the args
+            self._include_from_file = ['debug', 'disable_log_file', 'ticket_index_file', 'lock_dir']
+            # The config file is shared with the notifier
+            self._ignore_config_keys.extend(field[0] for field in notification.Settings._fieldTable())
+            self.loadConfigJsonFile()
+
+        except Exception as e:
+            print(f"Failed to initialize {e}")
+            print(traceback.format_exc())
+            sys.exit()
+
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+@contextlib.contextmanager
+def object_lock(host_name, service_name):
+    '''Take the notifier's lock for the host/service without waiting
+
+    Yields:
+        bool: False if a notification holds the lock
+    '''
+    if not config.lock_dir:
+        yield True
+        return
+    os.makedirs(config.lock_dir, mode=0o700, exist_ok=True)
+    lock = FileLock(notification.ticket_lock_path(config.lock_dir, host_name, service_name))
+    acquired = lock.acquire(blocking=False)
+    try:
+        yield acquired
+    finally:
+        lock.release()
+
+
+def active_tickets(rt, queues, ticket_ids):
+    '''Find which of the tickets are active, one paged search per queue then one search per batch for tickets in other queues
+
+    Returns:
+        set: ids of the active tickets
+    '''
+    active = set()
+    for queue in queues:
+        for ticket in rt.searchTickets(f"Queue = '{queue}' AND Status = '__Active__'", page_size=int(config.page_size)):
+            active.add(str(ticket['id']))
+    logger.info(f"Found {len(active)} active tickets in queues {', '.join(queues)}")
+
+    # The queue can be set per notification so tickets may be in other queues
+    others = sorted(set(ticket_ids) - active)
+    for batch in batches(others):
+        ids = ' OR '.join(f"id = '{ticket_id}'" for ticket_id in batch)
+        for ticket in rt.searchTickets(f"({ids}) AND Status = '__Active__'", page_size=int(config.page_size)):
+            active.add(str(ticket['id']))
+    return active
+
+
+def reconcile(rt, icinga, ticket_index):
+    '''Repair the comments and the ticket index
+
+    Returns:
+        dict: count of each repair
+    '''
+    counts = {'closed': 0, 'indexed': 0, 'commented': 0, 'recovered': 0}
+
+    # (host, service) -> [(ticket_id, comment name), ...] for every comment the notifier added, an object can have
+    # several from before notifications were locked
+    comments = {}
+    unmatched = []
+    for comment in icinga.get_author_comments_icinga():
+        attrs = comment['attrs']
+        match = notification.TICKETID_REGEX.search(attrs['text'])
+        if match:
+            comments.setdefault((attrs['host_name'], attrs['service_name']), []).append((match.group(2), attrs['__name']))
+        else:
+            unmatched.append(attrs['__name'])
+    if unmatched:
+        logger.warning(f"Ignoring {len(unmatched)} comments without a ticket id: {unmatched}")
+
+    entries = {(host, service): (ticket_id, state) for host, service, ticket_id, state in ticket_index.entries()} if ticket_index else {}
+    problems = icinga.get_problems_icinga()
+    queues = [queue.strip() for queue in (config.queues or config.rt.queue).split(',') if queue.strip()]
+    ticket_ids = {ticket_id for object_comments in comments.values() for ticket_id, _ in object_comments}
+    ticket_ids.update(ticket_id for ticket_id, state in entries.values() if state != RECOVERED)
+    active = active_tickets(rt, queues, ticket_ids)
+
+    # Every comment for a closed ticket, and the comment for the open ticket of each object
+    stale = []
+    open_comments = {}
+    for key, object_comments in comments.items():
+        for ticket_id, name in object_comments:
+            if ticket_id not in active:
+                logger.info(f"Ticket {ticket_id} for host {key[0]}, service {key[1]} was closed in RT, removing the comment {name}")
+                stale.append((key, ticket_id, name))
+            elif key in open_comments:
+                if open_comments[key] != ticket_id:
+                    logger.warning(f"Host {key[0]}, service {key[1]} has comments for open tickets {open_comments[key]} and {ticket_id}, indexing {open_comments[key]}")
+            else:
+                open_comments[key] = ticket_id
+    counts['closed'] = len(stale)
+    if not config.dry_run:
+        for batch in batches(name for _, _, name in stale):
+            icinga.delete_comments_by_name_icinga(batch)
+
+    for key, ticket_id in open_comments.items():
+        state = ACKNOWLEDGED if problems.get(key) else OPEN
+        entry = entries.get(key)
+        if ticket_index is not None and (entry is None or entry[0] != ticket_id):
+            logger.info(f"Indexing ticket {ticket_id} for host {key[0]}, service {key[1]}")
+            counts['indexed'] += 1
+            if not config.dry_run:
+                ticket_index.put(key[0], key[1], ticket_id, state)
+        if key not in problems:
+            logger.warning(f"Ticket {ticket_id} is open but host {key[0]}, service {key[1]} is no longer a problem")
+            counts['recovered'] += 1
+
+    # Index entries for open tickets that lost their comment, or whose ticket was closed
+    for key, (ticket_id, state) in entries.items():
+        if state == RECOVERED or key in open_comments:
+            continue
+        if ticket_id not in active:
+            logger.info(f"Ticket {ticket_id} for host {key[0]}, service {key[1]} was closed in RT, removing it from the index")
+            # Already counted with its comment
+            if key not in comments:
+                counts['closed'] += 1
+            if not config.dry_run:
+                ticket_index.remove(key[0], key[1])
+        elif config.dry_run:
+            logger.info(f"Would add the missing comment for ticket {ticket_id} to host {key[0]}, service {key[1]}")
+            counts['commented'] += 1
+        else:
+            with object_lock(key[0], key[1]) as locked:
+                # A notification may have added the comment since the comments were fetched
+                if not locked or ticket_index.get(key[0], key[1]) != (ticket_id, state) or icinga.get_comments_icinga(key[0], key[1]):
+                    logger.debug(f"Skipping host {key[0]}, service {key[1]} it was updated by a notification")
+                    continue
+                logger.info(f"Adding the missing comment for ticket {ticket_id} to host {key[0]}, service {key[1]}")
+                icinga.add_comment_icinga(key[0], key[1], f'[{config.rt.name} #{ticket_id}] - ticket created in RT')
+                counts['commented'] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    config = Settings()
+    config.rt = notification.SettingsRT(_config_dict=config._config_dict)
+    config.icinga = notification.SettingsIcinga(_config_dict=config._config_dict)
+
+    if config.print_config:
+        logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+        config.printArguments()
+        config.printEnvironmentVars()
+        sys.exit(0)
+
+    # Init logging
+    log_level = 'DEBUG' if config.debug else 'INFO'
+    initLogger(log_disable_file=config.disable_log_file, log_level=log_level, log_file="/var/log/icinga2/request-tracker-reconcile.log")
+
+    # Disabled proxies for requests to localhost
+    os.environ['NO_PROXY'] = 'localhost'
+
+    rt = notification.RequestTracker(config)
+    icinga = notification.Icinga(base_url=config.icinga.url, username=config.icinga.username, password=config.icinga.password)
+    ticket_index = TicketIndex(config.ticket_index_file) if config.ticket_index_file else None
+
+    try:
+        counts = reconcile(rt, icinga, ticket_index)
+    except Exception as e:
+        logger.error(f"Failed to reconcile RT tickets: {e}")
+        logger.debug(traceback.format_exc())
+        sys.exit(1)
+    logger.info(f"Reconciled RT tickets{' (dry run)' if config.dry_run else ''}: {counts['closed']} closed in RT, {counts['indexed']} indexed, {counts['commented']} comments added, {counts['recovered']} open for recovered objects")
+    sys.exit(0)
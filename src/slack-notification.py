@@ -2,17 +2,23 @@
 
 import dataclasses
 import json
-import requests
 import sys
+import time
 import traceback
 import urllib.parse
 
+from lib.Notifyd import forwardToDaemon
+# Hand the notification to notifyd when it is running, before loading any of the heavy dependencies
+forwardToDaemon(__file__)
+
+from lib.Outbox import Outbox, OutboxRetry
 from lib.SettingsParser import SettingsParser
-from lib.Util import initLogger
+from lib.Util import initLogger, logger
 
 from datetime import datetime
-from loguru import logger
 
+# Notifications listed in a summary post, the rest are counted
+SUMMARY_LINES = 50
 
 @dataclasses.dataclass
 class Settings(SettingsParser):
@@ -46,6 +52,21 @@ class Settings(SettingsParser):
     slack_layout_footer: bool = False
     slack_layout_host_and_service: bool = False
 
+    # Host wide rate limit for each webhook shared with outbox-worker.py, Slack allows about one post per second
+    # Leave the file empty to disable the rate limit
+    slack_rate_limit_file: str = '/var/lib/icinga2/slack-rate-limit.db'
+    slack_rate: float = 1.0
+    slack_burst: int = 3
+    # Seconds to wait for the rate limit or a Retry-After before the post is left in the outbox
+    slack_max_wait: int = 10
+    # Posts for a channel waiting in the outbox before they are replaced by one summary post
+    slack_summary_threshold: int = 10
+
+    # Leave empty to send directly without the outbox
+    outbox_file: str = ''
+    # Only commit to the outbox and leave sending to outbox-worker.py
+    outbox_defer: bool = False
+
     print_config: bool = False
 
     def __post_init__(self):
@@ -148,14 +169,74 @@ class Slack:
         logger.debug(payload)
         return payload
 
+    def message(self):
+        """Outbox payload for the post, the rate limit goes with it so outbox-worker.py keeps to the same limit"""
+        message = {'url': config.slack_webhook_url, 'headers': self.headers, 'json': self.payload(), 'timeout': 10}
+        if config.slack_rate_limit_file:
+            message['rate_limit'] = {
+                'file': config.slack_rate_limit_file,
+                'rate': float(config.slack_rate),
+                'burst': int(config.slack_burst),
+                'max_wait': float(config.slack_max_wait),
+            }
+        return message
+
+    @staticmethod
+    def summary(messages):
+        """Merge queued outbox payloads into one summary post, used when the backlog for a channel is over slack_summary_threshold"""
+        lines = []
+        for message in messages:
+            # A previous summary keeps the notifications it replaced
+            lines.extend(message.get('summary') or [attachment.get('fallback', '') for attachment in message['json'].get('attachments', [])])
+        text = '\n'.join(lines[:SUMMARY_LINES])
+        if len(lines) > SUMMARY_LINES:
+            text += f"\n+{len(lines) - SUMMARY_LINES} more notifications"
+        summary = dict(messages[-1])
+        summary['summary'] = lines
+        summary['json'] = {
+            'channel': messages[-1]['json'].get('channel'),
+            'username': messages[-1]['json'].get('username'),
+            'attachments': [{
+                'fallback': f"{len(lines)} notifications",
+                'color': '#7F7F7F',
+                'title': f"{len(lines)} notifications were queued while Slack was rate limited",
+                'text': f"```{text}```",
+            }],
+        }
+        return summary
+
     def post(self):
-        response = requests.post(url=config.slack_webhook_url, headers=self.headers, json=self.payload())
-        if response.status_code not in [200, 201, 300, 301]:
-            logger.error(
-                f"Post to slack url {config.slack_webhook_url} failed.\n Response code: {response.status_code}\n Response text: \n{response.text}")
+        if config.outbox_file:
+            self.queue()
+            return
+        message = self.message()
+        error = Outbox.send('slack', message)
+        # Without the outbox there is no queue to leave the post in, wait out a short Retry-After and try once more
+        if isinstance(error, OutboxRetry) and error.delay is not None and error.delay <= float(config.slack_max_wait):
+            logger.info(f"Slack is rate limited, retrying in {error.delay:.1f}s")
+            time.sleep(error.delay)
+            error = Outbox.send('slack', message)
+        if isinstance(error, OutboxRetry):
+            logger.warning(f"Dropped the post to slack url {config.slack_webhook_url}, it was still rate limited after waiting up to {config.slack_max_wait}s: {error}")
+            logger.warning("Set outbox_file to queue posts while Slack is rate limited instead of dropping them")
+        elif error is not None:
+            logger.error(f"Post to slack url {config.slack_webhook_url} failed: {error}")
         else:
             logger.success(f"Successfully posted to Slack")
 
+    def queue(self):
+        outbox = Outbox(config.outbox_file)
+        sent, error = outbox.submit('slack', self.message(), destination=config.slack_webhook_url, send=not config.outbox_defer)
+        if sent:
+            logger.success(f"Successfully posted to Slack")
+            return
+        logger.warning(f"Post to slack url {config.slack_webhook_url} left in the outbox {config.outbox_file} for retry: {error}")
+        # Replace a backlog for the channel with one summary post rather than catching up one post per second
+        replaced = outbox.collapse('slack', config.slack_webhook_url, int(config.slack_summary_threshold), self.summary,
+                                   key=lambda message: message['json'].get('channel'))
+        if replaced:
+            logger.info(f"Replaced {replaced} posts waiting in the outbox for {config.slack_channel} with a summary post")
+
 
 if __name__ == "__main__":
     config = Settings()
@@ -170,7 +251,7 @@ if __name__ == "__main__":
     log_level = 'DEBUG' if config.debug else 'INFO'
     log_writeable = initLogger(log_level=log_level, log_file="/var/log/icinga2/notification-slack.log")
 
-    logger.debug(json.dumps(dataclasses.asdict(config), indent=2))
+    logger.opt(lazy=True).debug("{}", lambda: json.dumps(dataclasses.asdict(config), indent=2))
 
     slack = Slack()
     slack.post()